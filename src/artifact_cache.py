@@ -0,0 +1,223 @@
+import argparse
+import datetime
+import functools
+import gzip
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import sys
+
+import catboost
+import pandas as pd
+
+from src.constants import *
+
+
+def file_fingerprint(path):
+    """ Size and modification time of an input file, a changed file gives a new cache key.
+    """
+    stat = os.stat(path)
+    return {'file': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+@functools.lru_cache(maxsize=None)
+def module_fingerprint(module):
+    """ Hash of the source of a module, of the src modules it uses directly, e.g. preprocessing for
+    preprocessing.transform_one_hot, and of src.constants, so an edit to a helper changes the hash too.
+    """
+    modules = {module.__name__: module, 'src.constants': sys.modules['src.constants']}
+    for value in list(vars(module).values()):
+        dep = value if inspect.ismodule(value) else getattr(value, '__module__', None)
+        dep = sys.modules.get(dep) if isinstance(dep, str) else dep
+        if inspect.ismodule(dep) and dep.__name__.startswith('src.'):
+            modules[dep.__name__] = dep
+    sha = hashlib.sha1()
+    for name in sorted(modules):
+        sha.update(name.encode() + inspect.getsource(modules[name]).encode())
+    return sha.hexdigest()
+
+
+def code_fingerprint(func):
+    """ module_fingerprint of the module defining func.
+    """
+    return module_fingerprint(inspect.getmodule(func))
+
+
+def value_fingerprint(value):
+    """ Json-able fingerprint of a stage argument: content hashes of frames and arrays, the value itself
+    for plain parameters, and a hash of the pickle for anything else, e.g. a fitted encoder.
+    """
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        try:
+            content = pd.util.hash_pandas_object(value, index=True).values.tobytes()
+        except TypeError:  # unhashable cells, e.g. lists
+            content = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        schema = str(list(value.columns) if isinstance(value, pd.DataFrame) else value.name) + str(value.dtypes)
+        return {'frame': hashlib.sha1(content + schema.encode()).hexdigest()}
+    if isinstance(value, np.ndarray):
+        return {'array': hashlib.sha1(np.ascontiguousarray(value).tobytes() + str(value.dtype).encode()
+                                      + str(value.shape).encode()).hexdigest()}
+    if isinstance(value, (list, tuple)):
+        return [value_fingerprint(x) for x in value]
+    if isinstance(value, dict):
+        return {str(key): value_fingerprint(x) for key, x in value.items()}
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return {'pickle': hashlib.sha1(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)).hexdigest()}
+
+
+def save_artifact(value, path):
+    """ Save one output in its natural format: parquet for frames, .cbm for CatBoost models,
+    gzip compressed pickle for anything else.
+    Returns:
+        kind (dict): format of the saved file, needed to load it back
+    """
+    if type(value) is pd.DataFrame:
+        try:
+            value.to_parquet(f'{path}.parquet')
+            return {'format': 'parquet'}
+        except (ValueError, TypeError, ImportError) as e:
+            print(f'{path}: stored as pickle, not parquet ({e})')
+    if isinstance(value, catboost.CatBoost):
+        value.save_model(f'{path}.cbm', format='cbm')
+        return {'format': 'cbm', 'class': type(value).__name__}
+    with gzip.open(f'{path}.pkl.gz', 'wb', compresslevel=3) as f:
+        pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+    return {'format': 'pickle'}
+
+
+def load_artifact(kind, path):
+    if kind['format'] == 'parquet':
+        return pd.read_parquet(f'{path}.parquet')
+    if kind['format'] == 'cbm':
+        model = getattr(catboost, kind['class'])()
+        model.load_model(f'{path}.cbm', format='cbm')
+        return model
+    with gzip.open(f'{path}.pkl.gz', 'rb') as f:
+        return pickle.load(f)
+
+
+def entry_size(entry_dir):
+    return sum(os.path.getsize(f'{entry_dir}/{x}') for x in os.listdir(entry_dir))
+
+
+def stage(name=None, file_args=(), version='', cache_dir=None, max_bytes=ARTIFACT_CACHE_MAX_BYTES):
+    """ Memoize a pipeline stage on disk. The cache key hashes the stage name, the source code of the function's
+    module and the src modules it uses (see code_fingerprint), version, the fingerprint of every argument,
+    and size and modification time of the files named by file_args. A hit loads the stored outputs instead of running the stage. Tuple outputs are stored
+    part by part, so every frame of e.g. (df_c, df_nc) goes to parquet.
+    Args:
+        name (str): stage name, defaults to the function name
+        file_args (tuple): names of the arguments that are input file paths
+        version (str): bump to invalidate the stage when something beyond the hashed code changed
+        cache_dir (str): cache root, defaults to ARTIFACT_CACHE_DIR
+        max_bytes (int): cache size kept by gc after every stored entry
+    """
+    def decorator(func):
+        stage_name = name or func.__name__
+        signature = inspect.signature(func)
+
+        def cache_key(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            inputs = {arg: file_fingerprint(value) if arg in file_args and value is not None
+                      else value_fingerprint(value) for arg, value in bound.arguments.items()}
+            key = {'stage': stage_name, 'code': code_fingerprint(func), 'version': version, 'inputs': inputs}
+            return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            root = cache_dir or ARTIFACT_CACHE_DIR
+            key = cache_key(*args, **kwargs)
+            entry_dir = f'{root}/{stage_name}/{key}'
+            if os.path.exists(f'{entry_dir}/meta.json'):
+                with open(f'{entry_dir}/meta.json') as f:
+                    meta = json.load(f)
+                os.utime(f'{entry_dir}/meta.json')  # mark as recently used
+                parts = [load_artifact(kind, f'{entry_dir}/part-{idx}') for idx, kind in enumerate(meta['parts'])]
+                print(f'{stage_name}: cache hit {key[:12]}')
+                return tuple(parts) if meta['tuple'] else parts[0]
+
+            result = func(*args, **kwargs)
+            tmp_dir = f'{entry_dir}.tmp-{os.getpid()}'
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            os.makedirs(tmp_dir)
+            is_tuple = isinstance(result, tuple)
+            parts = [save_artifact(part, f'{tmp_dir}/part-{idx}')
+                     for idx, part in enumerate(result if is_tuple else [result])]
+            with open(f'{tmp_dir}/meta.json', 'w') as f:
+                json.dump({'stage': stage_name, 'key': key, 'tuple': is_tuple, 'parts': parts,
+                           'created': datetime.datetime.now().isoformat()}, f, indent=2)
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            os.replace(tmp_dir, entry_dir)
+            gc(max_bytes, root)
+            return result
+
+        wrapper.cache_key = cache_key
+        return wrapper
+    return decorator
+
+
+def list_entries(cache_dir=ARTIFACT_CACHE_DIR):
+    """ Every stored entry, least recently used first.
+    Returns:
+        entries (DataFrame): stage, key, formats, bytes, created and last_used of every entry
+    """
+    entries = []
+    stages = os.listdir(cache_dir) if os.path.exists(cache_dir) else []
+    for stage_name in stages:
+        for key in os.listdir(f'{cache_dir}/{stage_name}'):
+            meta_path = f'{cache_dir}/{stage_name}/{key}/meta.json'
+            if not os.path.exists(meta_path):
+                continue  # an entry being written
+            with open(meta_path) as f:
+                meta = json.load(f)
+            entries.append({'stage': stage_name, 'key': key, 'formats': ','.join(x['format'] for x in meta['parts']),
+                            'bytes': entry_size(f'{cache_dir}/{stage_name}/{key}'), 'created': meta['created'],
+                            'last_used': datetime.datetime.fromtimestamp(os.path.getmtime(meta_path)).isoformat()})
+    entries = pd.DataFrame(entries, columns=['stage', 'key', 'formats', 'bytes', 'created', 'last_used'])
+    return entries.sort_values('last_used').reset_index(drop=True)
+
+
+def gc(max_bytes=ARTIFACT_CACHE_MAX_BYTES, cache_dir=ARTIFACT_CACHE_DIR, stage_name=None):
+    """ Evict least recently used entries until the cache holds at most max_bytes.
+    Args:
+        max_bytes (int): size to keep, 0 empties the cache
+        cache_dir (str): cache root
+        stage_name (str): only evict entries of this stage
+    Returns:
+        evicted (DataFrame): removed entries
+    """
+    entries = list_entries(cache_dir)
+    total = entries['bytes'].sum()
+    candidates = entries if stage_name is None else entries[entries.stage == stage_name]
+    evict = []
+    for idx, entry in candidates.iterrows():
+        if total <= max_bytes:
+            break
+        shutil.rmtree(f"{cache_dir}/{entry['stage']}/{entry['key']}", ignore_errors=True)
+        total -= entry['bytes']
+        evict.append(idx)
+    return entries.loc[evict]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Inspect and trim the pipeline artifact cache.')
+    parser.add_argument('command', choices=['ls', 'gc'])
+    parser.add_argument('--cache-dir', default=ARTIFACT_CACHE_DIR)
+    parser.add_argument('--max-bytes', type=int, default=None,
+                        help='size gc keeps, defaults to ARTIFACT_CACHE_MAX_BYTES, or 0 with --stage')
+    parser.add_argument('--stage', default=None, help='limit gc to one stage')
+    args = parser.parse_args()
+    if args.max_bytes is None:
+        args.max_bytes = 0 if args.stage else ARTIFACT_CACHE_MAX_BYTES
+    if args.command == 'ls':
+        entries = list_entries(args.cache_dir)
+        entries['key'] = entries['key'].str[:12]
+        print(entries.to_string(index=False) if len(entries) else f'{args.cache_dir} is empty')
+        print(f"{len(entries)} entries, {entries['bytes'].sum() / 2 ** 20:.1f} MB")
+    else:
+        evicted = gc(args.max_bytes, args.cache_dir, args.stage)
+        print(f"evicted {len(evicted)} entries, {evicted['bytes'].sum() / 2 ** 20:.1f} MB")
@@ -0,0 +1,608 @@
+import datetime
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from zoneinfo import ZoneInfo
+
+import pandas as pd
+from shapely import wkt
+
+from src.constants import *
+from src import geometry, model_registry, preprocessing, temporal_features, ups_data_loader
+from src.modeling.model_beta import beta_modeling, non_crash_data_gen, non_crash_sampler
+from src.weather import response_store, weather_collector, weather_data, weather_planner, weather_store
+from src.weather.weather_data import weather_url
+
+
+def run_fresh(code, repeat):
+    """ Run python code in fresh interpreters and return the wall time of each run in ms.
+    """
+    times = []
+    for _ in range(repeat):
+        s = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], check=True, capture_output=True)
+        times.append((time.perf_counter() - s) * 1000)
+    return times
+
+
+def median_seconds(func, repeat):
+    """ Median wall time of repeat calls of func in s, and its last result.
+    """
+    times = []
+    for _ in range(repeat):
+        s = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - s)
+    return statistics.median(times), result
+
+
+def benchmark_import(module='src.constants', repeat=5):
+    """ Cold-start import cost of a module, what every worker process or CLI tool pays.
+    Args:
+        module (str): module to import
+        repeat (int): number of fresh interpreters
+    Returns:
+        results (dict): median ms of a bare interpreter, of importing the module and of the
+            first use of the lazily loaded distribution artifacts
+    """
+    results = {
+        'interpreter': statistics.median(run_fresh('pass', repeat)),
+        'import': statistics.median(run_fresh(f'import {module}', repeat)),
+        'import + artifacts': statistics.median(run_fresh(
+            'from src import constants; constants.get_distro_crash(); constants.get_distro_sever()', repeat)),
+    }
+    for name, val in results.items():
+        print(f'{name}: {val:.1f} ms')
+    return results
+
+
+def benchmark_model_load(model_name='Model_Alpha', repeat=5):
+    """ Load time of a model from its pickle vs the registry's native .cbm file.
+    Args:
+        model_name (str): model saved by both ups_data_loader.pickel_model and model_registry.register_model
+        repeat (int): number of loads
+    Returns:
+        results (dict): median ms per format
+    """
+    pickle_times, cbm_times = [], []
+    for _ in range(repeat):
+        s = time.perf_counter()
+        ups_data_loader.load_model(model_name)
+        pickle_times.append((time.perf_counter() - s) * 1000)
+
+        model_registry.LOADED_MODELS.clear()  # measure a cold load, not the process cache
+        s = time.perf_counter()
+        model_registry.load_model(model_name)
+        cbm_times.append((time.perf_counter() - s) * 1000)
+    results = {'pickle': statistics.median(pickle_times), 'cbm': statistics.median(cbm_times)}
+    for name, val in results.items():
+        print(f'{model_name} {name}: {val:.1f} ms')
+    return results
+
+
+def benchmark_temporal(n=1473811, seed=42, repeat=5):
+    """ Per-row temporal feature derivation vs the vectorized temporal_features module on a crash-sized frame:
+    indicator blocks, time parsing, and crash datetimes through get_crash_datetime vs parse_crash_datetimes.
+    The per-row paths run once, they take seconds to minutes, the vectorized ones repeat times.
+    Args:
+        n (int): rows, defaults to the size of the crash file
+        seed (int): random seed of the synthetic hours, weekdays, times and dates
+        repeat (int): runs of each vectorized path, the median is reported
+    Returns:
+        results (dict): seconds per path and speedups
+    """
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({'hour': rng.integers(0, 24, n), 'day': rng.integers(0, 7, n)})
+    times = pd.Series([f'{h}:{m:02d} {p}' for h, m, p in zip(rng.integers(1, 13, n), rng.integers(0, 60, n),
+                                                             rng.choice(['AM', 'PM'], n))])
+
+    s = time.perf_counter()
+    old = pd.DataFrame({'Time': df['hour'].map(lambda x: preprocessing.rush_hour(int(x))),
+                        'Day': df['day'].map(lambda x: NUM2DAY[int(x)][len('Day_'):])})
+    for col in ['Day', 'Time']:
+        old = preprocessing.one_hot(col, col, old)
+    old_indicators = time.perf_counter() - s
+    new_indicators, new = median_seconds(lambda: temporal_features.temporal_indicators(df['hour'], df['day']),
+                                         repeat)
+    assert (old[new.columns].values == new.values).all()
+
+    s = time.perf_counter()
+    times.map(preprocessing.reformat_time)
+    old_times = time.perf_counter() - s
+    new_times, _ = median_seconds(lambda: temporal_features.parse_times(times), repeat)
+
+    dates = pd.Timestamp('2010-01-01') + pd.to_timedelta(rng.integers(0, 365 * 10, n), unit='D')
+    crashes = pd.DataFrame({'Crash_ID': np.arange(n), 'Crash_Date': dates.strftime('%m/%d/%Y'), 'Crash_Time': times})
+    crashes.datetime = datetime.datetime  # get_crash_datetime reaches strptime through the frame
+    s = time.perf_counter()
+    old = [preprocessing.get_crash_datetime(crashes, idx) for idx in crashes.index]
+    old_datetimes = time.perf_counter() - s
+    new_datetimes, new = median_seconds(lambda: temporal_features.parse_crash_datetimes(crashes), repeat)
+    assert (np.array([t for t, _ in old], dtype='datetime64[ns]') == new.values).all()
+
+    results = {'indicators_old_s': old_indicators, 'indicators_new_s': new_indicators,
+               'indicators_speedup': old_indicators / new_indicators,
+               'times_old_s': old_times, 'times_new_s': new_times, 'times_speedup': old_times / new_times,
+               'datetimes_old_s': old_datetimes, 'datetimes_new_s': new_datetimes,
+               'datetimes_speedup': old_datetimes / new_datetimes,
+               'speedup': (old_indicators + old_times + old_datetimes) / (new_indicators + new_times + new_datetimes)}
+    print(f"indicators: {old_indicators:.2f}s -> {new_indicators:.3f}s ({results['indicators_speedup']:.0f}x), "
+          f"times: {old_times:.2f}s -> {new_times:.3f}s ({results['times_speedup']:.0f}x), "
+          f"datetimes: {old_datetimes:.2f}s -> {new_datetimes:.3f}s ({results['datetimes_speedup']:.0f}x), "
+          f"all: {results['speedup']:.0f}x")
+    return results
+
+
+def benchmark_geometry(n=500000, cache_dir='/tmp/geometry_benchmark'):
+    """ Per-row WKT parsing and get_coords vs geometry.load_geometry, cold and from its WKB cache.
+    Args:
+        n (int): synthetic road segments
+        cache_dir (str): geometry cache used by the benchmark, emptied first
+    Returns:
+        results (dict): seconds per path
+    """
+    wkt_strings = pd.Series([f'LINESTRING ({-97 - i * 1e-6} 30, -97.1 {30.1 + i * 1e-6}, -97.2 30.2)' for i in range(n)])
+    shutil.rmtree(cache_dir, ignore_errors=True)
+
+    s = time.perf_counter()
+    geoms = wkt_strings.apply(wkt.loads)
+    geoms.map(lambda x: preprocessing.get_coords(x, 0))
+    geoms.map(lambda x: preprocessing.get_coords(x, 1))
+    results = {'per_row_s': time.perf_counter() - s}
+    s = time.perf_counter()
+    geometry.load_geometry(wkt_strings, cache_dir)
+    results['vectorized_s'] = time.perf_counter() - s
+    s = time.perf_counter()
+    geometry.load_geometry(wkt_strings, cache_dir)
+    results['cached_s'] = time.perf_counter() - s
+    print(f"geometry: per row {results['per_row_s']:.2f}s, vectorized {results['vectorized_s']:.2f}s, "
+          f"cached {results['cached_s']:.2f}s")
+    return results
+
+
+def benchmark_crash_load(file_name=CRASH_DATA_FILE_NAME, repeat=3):
+    """ Full csv read of the crash file vs ups_data_loader.load_crash_and_weather through the parquet cache.
+    Args:
+        file_name (str): crash file in DATA_PATH
+        repeat (int): number of loads
+    Returns:
+        results (dict): median seconds per path
+    """
+    ups_data_loader.load_crash_and_weather(file_name)  # builds the cache partition if it is missing or stale
+    csv_times, cache_times = [], []
+    for _ in range(repeat):
+        s = time.perf_counter()
+        pd.read_csv(f'{DATA_PATH}/{file_name}')
+        csv_times.append(time.perf_counter() - s)
+        s = time.perf_counter()
+        ups_data_loader.load_crash_and_weather(file_name)
+        cache_times.append(time.perf_counter() - s)
+    results = {'csv_s': statistics.median(csv_times), 'cache_s': statistics.median(cache_times)}
+    print(f"{file_name}: csv {results['csv_s']:.2f}s, parquet cache {results['cache_s']:.2f}s")
+    return results
+
+
+def benchmark_severity_labels(n=1473811, seed=42):
+    """ beta_modeling.mutual_exclusive vs label_severity on a crash-sized injury frame, checking they agree.
+    Args:
+        n (int): rows, defaults to the size of the crash file
+        seed (int): random seed of the synthetic injury counts
+    Returns:
+        results (dict): seconds per path
+    """
+    rng = np.random.default_rng(seed)
+    df_injry = pd.DataFrame(rng.choice([0, 0, 0, 1, 2], size=(n, len(INJRY_COLS))), columns=INJRY_COLS)
+    df_injry = df_injry.rename(columns={'Sus_Serious_Injry_Cnt': 'Incap_Injry_Cnt'})
+
+    s = time.perf_counter()
+    expected = beta_modeling.mutual_exclusive(df_injry.copy())
+    results = {'mutual_exclusive_s': time.perf_counter() - s}
+    s = time.perf_counter()
+    labeled = beta_modeling.label_severity(df_injry)
+    results['label_severity_s'] = time.perf_counter() - s
+    assert (expected.values == labeled[expected.columns].values).all()
+    print(f"severity labels: {results['mutual_exclusive_s']:.2f}s -> {results['label_severity_s']:.3f}s")
+    return results
+
+
+def benchmark_non_crash_sampler(n=20000000, n_segments=700000, seed=42):
+    """ pandas sample based non_crash_data_gen draws vs the alias table sampler on synthetic traffic data.
+    Args:
+        n (int): non-crash samples
+        n_segments (int): road segments
+        seed (int): random seed of the synthetic inputs and the sampler
+    Returns:
+        results (dict): seconds per path
+    """
+    rng = np.random.default_rng(seed)
+    road_info = pd.DataFrame({'STR_UNQ_ID': np.arange(n_segments), 'AADT_DESGN': rng.integers(10, 50000, n_segments),
+                              'RU_F_SYSTE': rng.choice(list(FCLASS2STREET_MAP), n_segments)})
+    road_info['fClassSimp'] = road_info['RU_F_SYSTE'].map(FCLASS2STREET_MAP)
+    month_distri = pd.Series(rng.random(12) + 1)
+    traffic_df = pd.DataFrame(rng.random((24, 7)), columns=[day[len('Day_'):] for day in DAYS])
+    traffic_df = traffic_df / traffic_df.values.sum()
+    weekday2num = dict(zip(traffic_df.columns, range(len(traffic_df.columns))))
+
+    s = time.perf_counter()
+    non_crash_data_gen.sample_with_respect2aadt(road_info.copy(), n)
+    non_crash_data_gen.fetch_hour_day_year(traffic_df, weekday2num, n)
+    results = {'pandas_s': time.perf_counter() - s}
+    s = time.perf_counter()
+    tables = non_crash_sampler.build_sampler_tables(road_info, month_distri, traffic_df, weekday2num)
+    results['tables_s'] = time.perf_counter() - s
+    s = time.perf_counter()
+    non_crash_sampler.sample_non_crash(tables, n, seed)
+    results['sampler_s'] = time.perf_counter() - s
+    print(f"{n} non-crash samples: pandas (no months) {results['pandas_s']:.2f}s, "
+          f"alias tables {results['tables_s']:.2f}s + sampling {results['sampler_s']:.2f}s")
+    return results
+
+
+class WeatherStubHandler(BaseHTTPRequestHandler):
+    """ Local stand-in for the weather API: a day of observations after a fixed latency,
+    HTTP 429 for a fraction of requests.
+    """
+    latency_s, fail_rate = 0.05, 0.0
+
+    def do_GET(self):
+        time.sleep(self.latency_s)
+        if random.random() < self.fail_rate:
+            self.send_response(429)
+            self.end_headers()
+            return
+        body = json.dumps({'observations': [{'valid_time_gmt': 1583020800 + 3600 * h, 'precip_hrly': 0.0,
+                                             'vis': 10.0, 'wspd': 5} for h in range(24)]}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_weather_stub(latency_ms=50, fail_rate=0.0, port=0):
+    """ Serve WeatherStubHandler on localhost in a background thread.
+    Returns:
+        server (ThreadingHTTPServer): call shutdown() when done
+        base_url (str): pass as base_url to the weather collectors
+    """
+    handler = type('Handler', (WeatherStubHandler,), {'latency_s': latency_ms / 1000, 'fail_rate': fail_rate})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    server.request_queue_size = 128
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}/v1/geocode'
+
+
+def benchmark_weather_collector(n=2000, n_sequential=100, latency_ms=50, fail_rate=0.05,
+                                journal_path='/tmp/weather_benchmark/journal.jsonl'):
+    """ One request at a time, as save_weather_obj_files does, vs weather_collector against a local stub API.
+    The collector is run twice to show the second run resumes from the journal without any requests.
+    Args:
+        n (int): requests of the collector
+        n_sequential (int): requests of the sequential loop
+        latency_ms (float): stub response time
+        fail_rate (float): share of stub responses that are HTTP 429
+        journal_path (str): journal of the benchmark, removed first
+    Returns:
+        results (dict): requests per second per path
+    """
+    server, base_url = start_weather_stub(latency_ms, fail_rate)
+    requests = [(idx, 30 + idx % 100 / 100, -97 - idx % 50 / 100, '03/01/2020') for idx in range(n)]
+    s = time.perf_counter()
+    for _, lat, long, date in requests[:n_sequential]:
+        try:
+            with urllib.request.urlopen(weather_url(lat, long, date, base_url)) as response:
+                json.loads(response.read())
+        except urllib.error.HTTPError:
+            pass  # the sequential loop has no retries
+    results = {'sequential_per_s': n_sequential / (time.perf_counter() - s)}
+
+    if os.path.exists(journal_path):
+        os.remove(journal_path)
+    stats = weather_collector.collect_weather(requests, journal_path, rate=10000, backoff=0.05, base_url=base_url)
+    results['collector_per_s'] = stats['requests_per_s']
+    resumed = weather_collector.collect_weather(requests, journal_path, rate=10000, base_url=base_url)
+    results['resumed_skipped'] = resumed['skipped']
+    server.shutdown()
+    print(f"weather requests: sequential {results['sequential_per_s']:.1f}/s, "
+          f"collector {results['collector_per_s']:.1f}/s, resumed run skipped {results['resumed_skipped']} of {n}")
+    return results
+
+
+def benchmark_weather_plan(n=5000, n_cities=20, n_days=30, n_stations=150, latency_ms=50, seed=42,
+                           journal_dir='/tmp/weather_plan_benchmark'):
+    """ One weather request per incident vs weather_planner's one request per (station, date) and per
+    (grid cell, date) against a local stub API, on incidents clustered around a few cities like real crashes.
+    Args:
+        n (int): incidents
+        n_cities (int): incident clusters
+        n_days (int): distinct dates
+        n_stations (int): synthetic weather stations spread over the state, standing in for WEATHER_LOCATIONS_PATH
+        latency_ms (float): stub response time
+        seed (int): random seed of the incidents and stations
+        journal_dir (str): journals of the benchmark, removed first
+    Returns:
+        results (dict): wall seconds per path and the reduction ratio of each plan
+    """
+    rng = np.random.default_rng(seed)
+    cities = rng.uniform([26, -106], [36, -94], size=(n_cities, 2))
+    points = cities[rng.integers(n_cities, size=n)] + rng.normal(0, 0.05, size=(n, 2))
+    stations = pd.DataFrame(rng.uniform([26, -106], [36, -94], size=(n_stations, 2)), columns=['Latitude', 'Longitude'])
+    dates = (pd.Timestamp('2019-01-01') + pd.to_timedelta(rng.integers(n_days, size=n), unit='D')).strftime('%m/%d/%Y')
+    shutil.rmtree(journal_dir, ignore_errors=True)
+    server, base_url = start_weather_stub(latency_ms)
+
+    per_incident = weather_collector.collect_weather(list(zip(range(n), points[:, 0], points[:, 1], dates)),
+                                                     f'{journal_dir}/per_incident.jsonl', rate=10000, base_url=base_url)
+    _, station = weather_planner.collect_planned(np.arange(n), points[:, 0], points[:, 1], dates,
+                                                 f'{journal_dir}/station.jsonl', stations, rate=10000,
+                                                 base_url=base_url)
+    _, grid = weather_planner.collect_planned(np.arange(n), points[:, 0], points[:, 1], dates,
+                                              f'{journal_dir}/grid.jsonl', cell_deg=WEATHER_CACHE_CELL_DEG,
+                                              rate=10000, base_url=base_url)
+    server.shutdown()
+    results = {'per_incident_s': per_incident['wall_s'], 'station_s': station['wall_s'], 'grid_s': grid['wall_s'],
+               'station_reduction_ratio': station['reduction_ratio'], 'grid_reduction_ratio': grid['reduction_ratio']}
+    print(f"weather for {n} incidents: per incident {results['per_incident_s']:.2f}s, "
+          f"by station {results['station_s']:.2f}s ({results['station_reduction_ratio']:.1f}x fewer requests), "
+          f"by grid cell {results['grid_s']:.2f}s ({results['grid_reduction_ratio']:.1f}x fewer requests)")
+    return results
+
+
+def synthetic_weather_dict(n, n_obs=30, seed=42):
+    """ Raw weather responses of n incidents with n_obs observations each over their day, in the API format,
+    plus the local incident times. Every tenth incident has no observations.
+    """
+    rng = np.random.default_rng(seed)
+    days = pd.Timestamp('2019-01-01') + pd.to_timedelta(rng.integers(365, size=n), unit='D')
+    times = days + pd.to_timedelta(rng.integers(24 * 60, size=n), unit='min')
+    day_epochs = days.tz_localize(LOCAL_TIMEZONE).asi8 // 10 ** 9
+    weather_dict = {}
+    for key, day_epoch in zip(range(n), day_epochs):
+        if key % 10 == 0:
+            weather_dict[key] = {'metadata': {}}
+            continue
+        epochs = day_epoch + np.sort(rng.integers(24 * 3600, size=n_obs))
+        weather_dict[key] = {'observations': [{'valid_time_gmt': int(epoch), 'precip_hrly': float(rng.random()),
+                                               'vis': 10.0, 'wspd': int(rng.integers(30))} for epoch in epochs]}
+    return weather_dict, pd.Series(times, index=range(n))
+
+
+def nearest_observation_loop(weather_dict, key, incident_time):
+    """ Per observation reference of match_nearest_observations, comparing absolute time differences.
+    """
+    observations = (weather_dict.get(key) or {}).get('observations')
+    if not observations:
+        return None
+    times = [datetime.datetime.fromtimestamp(obs['valid_time_gmt'], ZoneInfo(LOCAL_TIMEZONE)).replace(tzinfo=None)
+             for obs in observations]
+    return min(range(len(observations)), key=lambda idx: abs((incident_time - times[idx]).total_seconds()))
+
+
+def benchmark_weather_matching(n=10000, n_obs=30, n_check=1000):
+    """ Time the as-of merge matching of one converted weather chunk and check it against the per observation
+    loop on the first n_check incidents.
+    Args:
+        n (int): incidents, COLLECTION_SAVE_THRESH per file
+        n_obs (int): observations per incident
+        n_check (int): incidents compared with the loop
+    Returns:
+        results (dict): seconds of the merge and of the loop extrapolated to n, and mismatches
+    """
+    weather_dict, times = synthetic_weather_dict(n, n_obs)
+    s = time.time()
+    matched = weather_data.match_nearest_observations(times.index.values, times.values, weather_dict)
+    merge_s = time.time() - s
+
+    s = time.time()
+    expected = [nearest_observation_loop(weather_dict, key, time_) for key, time_ in times[:n_check].items()]
+    loop_s = (time.time() - s) * n / n_check
+    mismatches = 0
+    for key, pos, (_, row) in zip(times.index[:n_check], expected, matched[:n_check].iterrows()):
+        if pos is None:
+            mismatches += row[['valid_time_gmt']].notna().any()
+        else:
+            mismatches += row['valid_time_gmt'] != weather_dict[key]['observations'][pos]['valid_time_gmt']
+    results = {'merge_s': merge_s, 'loop_s': loop_s, 'mismatches': int(mismatches)}
+    print(f"weather matching of {n} incidents: as-of merge {merge_s:.3f}s, loop ~{loop_s:.2f}s, "
+          f"{results['mismatches']} mismatches in {n_check}")
+    return results
+
+
+def benchmark_weather_store(n_stations=300, n_days=365, obs_per_day=24, n_queries=100000, seed=42,
+                            path='/tmp/weather_store_benchmark'):
+    """ Build, save and memory-map a weather store of synthetic hourly observations, then time single and
+    batched nearest station lookups and check a sample of them against a brute force search.
+    Args:
+        n_stations (int): weather stations
+        n_days (int): days of observations per station
+        obs_per_day (int): observations per station and day
+        n_queries (int): points of the batched lookup
+        seed (int): random seed
+        path (str): store directory, replaced
+    Returns:
+        results (dict): build seconds, microseconds per single and per batched lookup, and mismatches
+    """
+    rng = np.random.default_rng(seed)
+    stations = pd.DataFrame(rng.uniform([26, -106], [36, -94], size=(n_stations, 2)), columns=['Latitude', 'Longitude'])
+    t0 = int(pd.Timestamp('2019-01-01', tz='UTC').timestamp())
+    n_obs = n_stations * n_days * obs_per_day
+    station = np.repeat(np.arange(n_stations), n_days * obs_per_day)
+    observations = pd.DataFrame({'Latitude': stations['Latitude'].values[station] + rng.normal(0, 0.01, n_obs),
+                                 'Longitude': stations['Longitude'].values[station] + rng.normal(0, 0.01, n_obs),
+                                 'epoch': t0 + rng.integers(n_days * 86400, size=n_obs)})
+    for col in WEATHER_COLS:
+        observations[col] = rng.random(n_obs).astype(np.float32)
+
+    s = time.time()
+    shutil.rmtree(path, ignore_errors=True)
+    weather_store.save_weather_store(weather_store.build_weather_store(observations, stations), path)
+    store = weather_store.load_weather_store(path)
+    build_s = time.time() - s
+
+    lats, longs = rng.uniform(26, 36, n_queries), rng.uniform(-106, -94, n_queries)
+    times = pd.to_datetime(t0 + rng.integers(n_days * 86400, size=n_queries), unit='s').tz_localize('UTC')
+    s = time.time()
+    weather = weather_store.query_weather(store, lats, longs, times)
+    batch_us = (time.time() - s) / n_queries * 1e6
+    s = time.time()
+    for idx in range(1000):
+        weather_store.weather_at(store, lats[idx], longs[idx], times[idx])
+    single_us = (time.time() - s) / 1000 * 1e6
+
+    mismatches = 0
+    for idx in range(200):
+        nearest = np.argmin((store['station_lat'] - lats[idx]) ** 2 + (store['station_long'] - longs[idx]) ** 2)
+        rows = np.arange(store['offsets'][nearest], store['offsets'][nearest + 1])
+        gaps = np.abs((store['keys'][rows] & 0xffffffff) - times[idx].timestamp())
+        mismatches += not np.allclose(store['values'][rows[np.argmin(gaps)]], weather.values[idx])
+    results = {'build_s': build_s, 'single_us': single_us, 'batch_us': batch_us, 'mismatches': int(mismatches)}
+    print(f"weather store of {n_obs} observations: built in {build_s:.2f}s, {single_us:.0f}us per single lookup, "
+          f"{batch_us:.2f}us per batched lookup, {results['mismatches']} mismatches in 200")
+    return results
+
+
+def benchmark_response_store(n=20000, n_obs=30, n_reads=1000, path='/tmp/response_store_benchmark'):
+    """ Stream synthetic raw responses into a ResponseStore, then time random single reads against
+    unpickling the COLLECTION_SAVE_THRESH checkpoint that holds the response.
+    Args:
+        n (int): responses
+        n_obs (int): observations per response
+        n_reads (int): random single reads
+        path (str): store directory, replaced
+    Returns:
+        results (dict): write seconds, store and pickle bytes, ms per read from the store and from a checkpoint
+    """
+    weather_dict, _ = synthetic_weather_dict(n, n_obs)
+    shutil.rmtree(path, ignore_errors=True)
+    s = time.time()
+    with response_store.ResponseStore(path) as store:
+        for key, data in weather_dict.items():
+            store.put(key, data)
+    write_s = time.time() - s
+    store_bytes = sum(os.path.getsize(f'{path}/{x}') for x in os.listdir(path))
+
+    checkpoint = pickle.dumps({key: weather_dict[key] for key in range(COLLECTION_SAVE_THRESH)},
+                              pickle.HIGHEST_PROTOCOL)
+    keys = np.random.default_rng(0).integers(n, size=n_reads)
+    store = response_store.ResponseStore(path)
+    s = time.time()
+    for key in keys:
+        assert store.get(key) == weather_dict[key]
+    store_ms = (time.time() - s) / n_reads * 1000
+    store.close()
+    s = time.time()
+    for _ in range(10):
+        pickle.loads(checkpoint)
+    pickle_ms = (time.time() - s) / 10 * 1000
+    results = {'write_s': write_s, 'store_bytes': store_bytes,
+               'checkpoint_bytes': len(checkpoint) * n / COLLECTION_SAVE_THRESH, 'store_read_ms': store_ms, 'checkpoint_read_ms': pickle_ms}
+    print(f"response store: {n} responses written in {write_s:.2f}s ({store_bytes / 2 ** 20:.1f} MB vs "
+          f"{results['checkpoint_bytes'] / 2 ** 20:.1f} MB pickled), single read {store_ms:.3f}ms vs "
+          f"{pickle_ms:.1f}ms to unpickle its checkpoint")
+    return results
+
+
+def benchmark_random_dates(n=200000, seed=42):
+    """ Random incident dates from weather_data.random_dates vs one randomdate call per row. Every vectorized
+    date is checked for its year, month and weekday, and its week of the month for uniformity.
+    Args:
+        n (int): rows
+        seed (int): random seed
+    Returns:
+        results (dict): seconds of both paths, invalid dates and the largest deviation of a week-of-month share
+    """
+    rng = np.random.default_rng(seed)
+    years, months, weekdays = rng.choice(NON_CRASH_YEARS, n), rng.integers(1, 13, n), rng.integers(0, 7, n)
+    s = time.time()
+    dates = pd.DatetimeIndex(weather_data.random_dates(years, months, weekdays, seed))
+    vectorized_s = time.time() - s
+    s = time.time()
+    for year, month, weekday in zip(years[:n // 10].tolist(), months[:n // 10].tolist(), weekdays[:n // 10].tolist()):
+        weather_data.randomdate(year, month, weekday)
+    loop_s = (time.time() - s) * 10
+
+    invalid = int(((dates.year != years) | (dates.month != months) | (dates.weekday != weekdays)).sum())
+    week = (dates.day.values - 1) // 7
+    shares = np.bincount(week[week < 4], minlength=4) / (week < 4).sum()  # every month has 4 of each weekday
+    results = {'vectorized_s': vectorized_s, 'loop_s': loop_s, 'invalid': invalid,
+               'max_share_diff': float(np.abs(shares - 0.25).max())}
+    print(f"random dates of {n} rows: vectorized {vectorized_s:.3f}s, loop ~{loop_s:.2f}s, {invalid} invalid, "
+          f"week of month shares within {results['max_share_diff']:.4f} of uniform")
+    return results
+
+
+def write_synthetic_crash_files(data_dir, n, n_segments=1000, seed=42):
+    """ Crash, collision to segment map and road files shaped like the real inputs of beta_modeling.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(data_dir, exist_ok=True)
+    df_crash = pd.DataFrame({col: rng.integers(0, 3, n) for col in CRASH_WEATHER_COLS})
+    df_crash['Crash_ID'] = rng.permutation(n)
+    for col in WEATHER_COLS:
+        df_crash[col] = rng.random(n)
+    df_crash.to_csv(f'{data_dir}/crash.csv', index=False)
+    pd.DataFrame({'Crash_ID': df_crash.Crash_ID, 'STR_UNQ_ID': rng.integers(0, n_segments, n)}).to_csv(
+        f'{data_dir}/crash2segment.csv', index=False)
+
+    road_info = pd.DataFrame({'STR_UNQ_ID': np.arange(n_segments),
+                              'HSYS': rng.choice(['IH', 'US', 'FM', 'CR', 'TL', 'RM', 'SL'], n_segments),
+                              'RU_F_SYSTE': rng.choice([1, 2, 4], n_segments), 'RU': rng.choice([1, 2, 4], n_segments),
+                              'MED_TYPE': rng.choice([0.0, 3.0, 5.0], n_segments)})
+    for col in ['LN_MILES', 'AADT_TRUCK', 'PCT_PK_CUT', 'INCRS_FCTR', 'D_FAC']:
+        road_info[col] = rng.random(n_segments)
+    road_info.to_parquet(f'{data_dir}/road_info.parquet')
+
+
+def peak_rss_mb(code, cwd):
+    """ Peak resident memory of python code run in a fresh interpreter with the repo importable.
+    """
+    code = f'{code}\nimport resource; print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)'
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.getcwd(), os.environ.get('PYTHONPATH', '')]))
+    out = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True, cwd=cwd, env=env)
+    return int(out.stdout.split()[-1]) / 1024  # ru_maxrss is in KB on linux
+
+
+def benchmark_ingest_memory(sizes=(100000, 400000), chunk_size=50000, work_dir='/tmp/ingest_benchmark'):
+    """ Peak RSS of segment_data_preprocessing on the whole crash table vs streaming ingest_crash_data.
+    The streaming peak should stay flat as the input grows.
+    Args:
+        sizes (tuple): numbers of synthetic collisions
+        chunk_size (int): rows per chunk of the streaming path
+        work_dir (str): scratch directory, its data dir stands in for DATA_PATH
+    Returns:
+        results (dict): peak MB per size and path
+    """
+    load = ('import pandas as pd\nfrom src import ups_data_loader\n'
+            'from src.modeling.model_beta import beta_modeling\n'
+            'road_info = pd.read_parquet("data/road_info.parquet")\n')
+    in_memory = (load + 'df_crash = pd.read_csv("data/crash.csv")\n'
+                 'ups_data_loader.load_map_crash2segment(df_crash, "crash2segment.csv")\n'
+                 'beta_modeling.segment_data_preprocessing(df_crash, road_info)[0].to_parquet("data/in_memory.parquet")')
+    streaming = load + (f'beta_modeling.ingest_crash_data("crash.csv", "crash2segment.csv", road_info, '
+                        f'"data/streamed", {chunk_size})')
+    results = {}
+    for n in sizes:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        write_synthetic_crash_files(f'{work_dir}/data', n)
+        results[n] = {'in_memory_mb': peak_rss_mb(in_memory, work_dir),
+                      'streaming_mb': peak_rss_mb(streaming, work_dir)}
+        print(f"{n} rows: in memory {results[n]['in_memory_mb']:.0f} MB, "
+              f"streaming {results[n]['streaming_mb']:.0f} MB peak RSS")
+    return results
+
+
+if __name__ == '__main__':
+    benchmark_import()
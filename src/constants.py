@@ -1,8 +1,10 @@
+import functools
 import numpy as np
 import pickle
 
 DATA_PATH ='data'
 PICKEL_PATH = f'{DATA_PATH}/models'
+MODEL_REGISTRY_PATH = f'{PICKEL_PATH}/registry'
 ROAD_DATA_PATH = f'{DATA_PATH}/pdStreets.csv'
 ROAD2WEATHER2DATE_PATH = f'{DATA_PATH}/NonCrashRoadsDayMonth.csv'
 PATH2CRASH_DIR = f'{DATA_PATH}/txdot_crash_data'
@@ -14,6 +16,18 @@ CLEANED_NC_FILE_PATH = f'{DATA_PATH}/processed/joinedNC_dataClean.csv'
 CLEANED_C_FILE_PATH = f'{DATA_PATH}/processed/joinedCrash_dataClean.csv'
 WEATHER_LOCATIONS_PATH = f'{DATA_PATH}/weather_station_locations.csv'
 CRASH_DATA_FILE_NAME = 'crash_and_weather_data_n1473811.csv'
+CRASH2SEGMENT_FILE_NAME = 'cFromMatch2Roads-Crash2Roads.csv'  # Crash_ID to STR_UNQ_ID map
+CRASH_YEARS = [2020, 2019, 2018]  # yearly TxDOT files in PATH2CRASH_DIR, named '<year> crash.csv'
+CRASH_CACHE_DIR = 'cache/crash'  # parquet copies of the crash csv files, one partition per source file
+CRASH_CACHE_ROW_GROUP_SIZE = 100000  # rows per row group, the unit filters can skip
+CRASH_WEATHER_COLS = ['Crash_ID', 'precip_hrly', 'vis', 'wc', 'wspd', 'Crash_Speed_Limit',
+                      'Road_Cls_ID', 'Crash_Sev_ID', 'Sus_Serious_Injry_Cnt', 'Nonincap_Injry_Cnt',
+                      'Poss_Injry_Cnt', 'Non_Injry_Cnt', 'Unkn_Injry_Cnt', 'Tot_Injry_Cnt',
+                      'Death_Cnt', 'Time_PM_peak', 'Time_Mid_day', 'Time_AM_peak',
+                      'Time_Night/Early_Morning', 'Day_Friday', 'Day_Sunday', 'Day_Thursday',
+                      'Day_Monday', 'Day_Wednesday', 'Day_Saturday', 'Day_Tuesday']
+INGEST_CHUNK_SIZE = 100000  # crash rows held in memory at once by streaming ingestion
+INGEST_OUTPUT_DIR = f'{DATA_PATH}/processed/crash_segments'
 
 # plotting
 FIGSIZE = (15, 3)
@@ -30,18 +44,61 @@ COST_ARR = np.array([98400, 28500, 23400, 4600, 12500, 1704000])
 DAYS = ['Day_Monday','Day_Tuesday','Day_Wednesday','Day_Thursday','Day_Friday','Day_Sunday','Day_Saturday']
 NUM = [x for x in range(len(DAYS))]
 NUM2DAY = dict(zip( NUM, DAYS ))
-SEVERITY_DIS = pickle.load(open("data/models/severityDis.pkl", "rb"))
-DISTRO_CRASH = pickle.load(open("data/models/distroCrash.pkl", "rb"))
-DISTRO_SEVER = SEVERITY_DIS.values/sum(SEVERITY_DIS)
+TIME_COLS = ['Time_PM_peak', 'Time_Mid_day', 'Time_AM_peak', 'Time_Night/Early_Morning']
+WEATHER_COLS = ['precip_hrly', 'vis', 'wspd']
+SEVERITY_DIS_PATH = f'{PICKEL_PATH}/severityDis.pkl'
+DISTRO_CRASH_PATH = f'{PICKEL_PATH}/distroCrash.pkl'
 
 # demo
 FREDERICKSBURG_ID = 15150
 DEMO_LOCATION = 'Fredericksburg, TX, USA'
 MAP_DATA_PATH = 'data/map_data/TxDOT_Roadway_Inventory_2019/TxDOT_Roadway_Inventory_2019.shp'
+DEMO_MAP_OBJ_NAME = 'demo_map_fredericksburg'
+SEGMENT_STORE_PATH = f'{DATA_PATH}/segment_store'
+RISK_TABLE_PATH = f'{DATA_PATH}/risk_tables'
+PIPELINE_DIR = f'{DATA_PATH}/pipeline'  # intermediate outputs and run stamps of src/pipeline.py
+GEOMETRY_CACHE_DIR = 'cache/geometry'  # parsed road geometry as WKB parquet, keyed by a hash of the WKT
+ARTIFACT_CACHE_DIR = 'cache/artifacts'  # memoized pipeline stage outputs, keyed by a hash of their inputs
+ARTIFACT_CACHE_MAX_BYTES = 20 * 2 ** 30  # least recently used stage outputs are evicted above this size
+# weather borders the alpha and beta models are quantized with and the risk tables hold one state per interval
+# between, so lookup mode is exact. Each state costs 224 bytes per segment (2 float32 tables x 28 weekday and
+# time buckets): 4 x 2 x 2 states, 3584 bytes per segment, about 2.5 GB for the ~700k statewide segments
+RISK_TABLE_WEATHER_BORDERS = {'precip_hrly': [0, 0.1, 0.3], 'vis': [3], 'wspd': [15]}
+RISK_TABLE_WEATHER_RANGE = {'precip_hrly': (0, 1), 'vis': (0, 10), 'wspd': (0, 40)}  # check_risk_tables weather
+RISK_TABLE_TOLERANCE = 0.05  # relative trip cost error of lookup mode check_risk_tables holds the tables to
+RISK_TABLE_CHUNK_ROWS = 500000  # segment x condition rows scored per model call while building tables
+TIME_BUCKET_HOURS = [17, 12, 8, 2]  # an hour inside each TIME_COLS bucket
+
+# routing
+ROUTING_RISK_WEIGHT = 180  # seconds of travel time one dollar of risk cost is worth (lambda)
+ROUTING_PARETO_WEIGHTS = [0, 30, 90, 180, 600, 1800, 3600]
+ROUTING_MAX_SPEED_KPH = 140  # floor of the A* heuristic speed, above the 85 mph (137 kph) Texas limit
+
+# risk service
+SERVICE_HOST = '127.0.0.1'
+SERVICE_PORT = 8765
+SERVICE_MAX_BATCH_SIZE = 256  # trips per model call
+SERVICE_MAX_WAIT_MS = 5  # longest a trip waits for its batch to fill
 
 # weather data
 API_KEY = ''
 COLLECTION_SAVE_THRESH = 10000  # How many weather data points to collect before saving
+WEATHER_CACHE_DIR = 'cache/weather'
+WEATHER_CACHE_TTL = 3600  # seconds a cached weather lookup stays valid
+WEATHER_CACHE_MAX_ENTRIES = 50000
+WEATHER_CACHE_CELL_DEG = 0.1  # ~11km grid cells when no station list is used
+WEATHER_API_URL = 'https://api.weather.com/v1/geocode'
+WEATHER_CONCURRENCY = 32  # open requests of the weather collector
+WEATHER_RATE_LIMIT = 20  # requests per second, the collector's token bucket refill rate
+WEATHER_MAX_RETRIES = 5
+WEATHER_BACKOFF_S = 0.5  # first retry delay, doubled on every further retry
+WEATHER_TIMEOUT_S = 30
+WEATHER_JOURNAL_DIR = f'{PATH2WEATHER_OBJ_DIR}/journal'  # one json line per completed weather request
+LOCAL_TIMEZONE = 'America/Chicago'  # crash times are local Texas time, observation epochs are UTC
+WEATHER_STORE_PATH = f'{DATA_PATH}/weather_store'  # observations per weather station for offline lookups
+WEATHER_STORE_MAX_GAP_S = 3 * 3600  # offline lookups further than this from every observation of their station are NaN
+WEATHER_RESPONSE_DIR = f'{PATH2WEATHER_OBJ_DIR}/responses'  # append-only shards of raw weather responses
+WEATHER_SHARD_BYTES = 256 * 2 ** 20  # size of a response shard before the next one is started
 
 USELESS_ROAD_COLS = ['Shape__Len', 'geometry', 'Unnamed: 0', 'UAN_HPMS', 'UAN', 'MPA', 'STE_NAM', 'TO_DISP', 'TO_NUM',
                      'RIA_RTE_ID', 'FRM_DFO', 'TO_DFO', 'HPMSID', 'RTE_GRID', 'GID', 'ACCEL_DECE', 'LEN_SEC',
@@ -57,8 +114,13 @@ USELESS_ROAD_COLS = ['Shape__Len', 'geometry', 'Unnamed: 0', 'UAN_HPMS', 'UAN',
                      'SURF_TRE_2', 'BASE_TP', 'DI', 'CO', 'CITY', 'SPD_MAX', 'SPD_MIN', 'F_SYSTEM', 'SRF_TYPE',
                      'S_TYPE_I', 'S_TYPE_O', 'MSA_CLS', 'ADT_CUR']
 
+ROAD_ONE_HOT_COLS = ['HSYS', 'RU_F_SYSTE', 'RU', 'MED_TYPE']
+
 INJRY_COLS = ['Non_Injry_Cnt', 'Poss_Injry_Cnt', 'Unkn_Injry_Cnt', 'Nonincap_Injry_Cnt', 'Sus_Serious_Injry_Cnt',
               'Death_Cnt']
+# injury columns (Sus_Serious_Injry_Cnt renamed) in order of importance, a crash is labeled by the first one it has
+INJRY_PRIORITY_COLS = ['Death_Cnt', 'Incap_Injry_Cnt', 'Nonincap_Injry_Cnt', 'Unkn_Injry_Cnt', 'Poss_Injry_Cnt',
+                       'Non_Injry_Cnt']
 
 # beta model
 MODEL_BETA_PARAMS = {'learning_rate': 0.01, 'eval_metric': 'AUC', 'max_depth': 10, 'early_stopping_rounds': 100,
@@ -75,6 +137,9 @@ FCLASS2STREET_MAP = {'R1': 'R1', 'R2': 'R1', 'R3': 'R4', 'R4': 'R4', 'R5': 'RO',
                      'U1': 'U1', 'U2': 'U1', 'U3': 'U4', 'U4': 'U4', 'U5': 'UO', 'U6': 'UO', 'U7': 'UO'}
 
 ROAD_CLASS_COLS = ['U1', 'R1', 'U4', 'R4', 'UO', 'RO']
+NON_CRASH_YEARS = [2020, 2018, 2019]  # years non-crash samples are drawn from, uniformly
+NON_CRASH_SHARD_DIR = f'{DATA_PATH}/processed/non_crash'
+NON_CRASH_SHARD_ROWS = 2000000  # samples per shard file, the most a generation worker holds at once
 
 # model alpha
 BST_COLS_ALPHA_MODEL = ['LN_MILES', 'wspd', 'Time_PM_peak', 'Time_AM_peak', 'vis', 'AADT_TRUCK', 'precip_hrly', 'RU_1',
@@ -85,3 +150,37 @@ MODEL_ALPHA_PARAS = {'learning_rate': 0.01, 'eval_metric': 'AUC', 'max_depth': 9
     'verbose': 200, 'random_seed': 42}
 
 
+# artifacts: loaded on first use instead of at import, then cached for the life of the process.
+# Load them in a parent process before forking workers to share one copy.
+@functools.lru_cache(maxsize=None)
+def load_artifact(file_name):
+    """ Load a pickled artifact once per process.
+    """
+    with open(file_name, 'rb') as f:
+        return pickle.load(f)
+
+
+def get_severity_dis():
+    return load_artifact(SEVERITY_DIS_PATH)
+
+
+def get_distro_crash():
+    return load_artifact(DISTRO_CRASH_PATH)
+
+
+@functools.lru_cache(maxsize=None)
+def get_distro_sever():
+    severity_dis = get_severity_dis()
+    return severity_dis.values / sum(severity_dis)
+
+
+LAZY_ARTIFACTS = {'SEVERITY_DIS': get_severity_dis, 'DISTRO_CRASH': get_distro_crash,
+                  'DISTRO_SEVER': get_distro_sever}
+
+
+def __getattr__(name):
+    """ Keep constants.SEVERITY_DIS, DISTRO_CRASH and DISTRO_SEVER working as lazily loaded attributes.
+    """
+    if name in LAZY_ARTIFACTS:
+        return LAZY_ARTIFACTS[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,71 @@
+import hashlib
+import os
+
+import pandas as pd
+import shapely
+
+from src.constants import *
+
+
+def parse_wkt(wkt_strings):
+    """ Parse a column of WKT strings in one shapely call. Missing or invalid strings give None.
+    Args:
+        wkt_strings (Series): WKT geometry strings
+    Returns:
+        geoms (array): shapely geometries
+    """
+    wkt_strings = pd.Series(wkt_strings)
+    wkt_strings = wkt_strings.where(wkt_strings.notna(), None).values
+    return shapely.from_wkt(wkt_strings, on_invalid='ignore')
+
+
+def first_coords(geoms):
+    """ x and y of the first vertex of every geometry, vectorized preprocessing.get_coords.
+    Multi part and missing geometries give NaN, as get_coords gives None for them.
+    """
+    points = np.where(shapely.get_type_id(geoms) == 0, geoms, shapely.get_point(geoms, 0))
+    return shapely.get_x(points), shapely.get_y(points)
+
+
+def centroid_coords(geoms):
+    """ x and y of the centroid of every geometry.
+    """
+    centroids = shapely.centroid(geoms)
+    return shapely.get_x(centroids), shapely.get_y(centroids)
+
+
+def wkt_fingerprint(wkt_strings):
+    """ Content hash of a WKT column, names its geometry cache file.
+    """
+    return hashlib.sha1(pd.util.hash_pandas_object(pd.Series(wkt_strings), index=False).values.tobytes()).hexdigest()
+
+
+def load_geometry(wkt_strings, cache_dir=GEOMETRY_CACHE_DIR):
+    """ Parse a WKT column once and keep the geometries as WKB in a parquet file next to their coordinates.
+    Later calls with the same strings read the cache instead of parsing again.
+    Args:
+        wkt_strings (Series): WKT geometry strings
+        cache_dir (str): cache directory, None disables the cache
+    Returns:
+        geometry (DataFrame): geometry (shapely), x, y (first vertex), centroid_x, centroid_y
+            in the order of wkt_strings
+    """
+    index = wkt_strings.index if isinstance(wkt_strings, pd.Series) else None
+    path = f'{cache_dir}/{wkt_fingerprint(wkt_strings)}.parquet' if cache_dir else None
+    if path and os.path.exists(path):
+        geometry = pd.read_parquet(path)
+        geometry['geometry'] = shapely.from_wkb(geometry['geometry'].values)
+    else:
+        geoms = parse_wkt(wkt_strings)
+        x, y = first_coords(geoms)
+        centroid_x, centroid_y = centroid_coords(geoms)
+        geometry = pd.DataFrame({'geometry': shapely.to_wkb(geoms), 'x': x, 'y': y,
+                                 'centroid_x': centroid_x, 'centroid_y': centroid_y})
+        if path:
+            os.makedirs(cache_dir, exist_ok=True)
+            geometry.to_parquet(f'{path}.tmp', index=False)
+            os.replace(f'{path}.tmp', path)
+        geometry['geometry'] = geoms
+    if index is not None:
+        geometry.index = index
+    return geometry
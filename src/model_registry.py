@@ -0,0 +1,120 @@
+import datetime
+import hashlib
+import json
+import os
+
+import catboost
+import pandas as pd
+from catboost import CatBoostClassifier
+
+from src.constants import *
+
+LOADED_MODELS = {}  # (model_name, version) -> (model, manifest), kept warm for the life of the process
+
+
+def frame_hash(df):
+    """ Content hash of a DataFrame, recorded so a model can be traced back to its training data.
+    """
+    return hashlib.sha1(pd.util.hash_pandas_object(df, index=True).values.tobytes()).hexdigest()
+
+
+def list_versions(model_name):
+    """ Registered versions of a model in ascending order.
+    """
+    model_dir = f'{MODEL_REGISTRY_PATH}/{model_name}'
+    if not os.path.exists(model_dir):
+        return []
+    return sorted(int(x[1:]) for x in os.listdir(model_dir) if x.startswith('v') and x[1:].isdigit())
+
+
+def latest_version(model_name):
+    versions = list_versions(model_name)
+    if not versions:
+        raise FileNotFoundError(f'No registered versions of {model_name} in {MODEL_REGISTRY_PATH}')
+    return versions[-1]
+
+
+def register_model(model_name, model, cols, train_data=None, metrics=None, encoder=None):
+    """ Save a CatBoost model in its native .cbm format next to a manifest as a new version.
+    Args:
+        model_name (str): e.g. Model_Alpha
+        model (CatBoost Model): trained model
+        cols (list): feature columns in model order
+        train_data (DataFrame): training data, only its hash is stored
+        metrics (dict): evaluation metrics, e.g. model.get_best_score()
+        encoder (dict): fit_one_hot encoder the training data was encoded with, reused at inference
+    Returns:
+        version (int): the new version
+    """
+    versions = list_versions(model_name)
+    version = versions[-1] + 1 if versions else 1
+    version_dir = f'{MODEL_REGISTRY_PATH}/{model_name}/v{version}'
+    os.makedirs(version_dir)
+
+    model.save_model(f'{version_dir}/model.cbm', format='cbm')
+    manifest = {
+        'model_name': model_name,
+        'version': version,
+        'feature_columns': list(cols),
+        'train_data_hash': frame_hash(train_data) if train_data is not None else None,
+        'metrics': metrics,
+        'one_hot_encoder': encoder,
+        'catboost_version': catboost.__version__,
+        'created': datetime.datetime.now().isoformat(),
+    }
+    with open(f'{version_dir}/manifest.json', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    print(f'Model: {model_name} v{version} Save to: {version_dir}')
+    return version
+
+
+def load_model(model_name, version=None, expected_cols=None):
+    """ Load a registered model, verifying its schema. Loaded versions are cached per process, so calling
+    this again with version=None picks up a newly registered version and serves cached ones for free.
+    Args:
+        model_name (str): e.g. Model_Alpha
+        version (int): defaults to the latest version
+        expected_cols (list): columns the caller will predict with
+    Returns:
+        model (CatBoost Model): loaded model
+        cols (list): feature columns in model order
+    """
+    if version is None:
+        version = latest_version(model_name)
+    if (model_name, version) not in LOADED_MODELS:
+        version_dir = f'{MODEL_REGISTRY_PATH}/{model_name}/v{version}'
+        with open(f'{version_dir}/manifest.json') as f:
+            manifest = json.load(f)
+        model = CatBoostClassifier()
+        model.load_model(f'{version_dir}/model.cbm', format='cbm')
+        if list(model.feature_names_) != manifest['feature_columns']:
+            raise ValueError(f'{model_name} v{version}: model features do not match its manifest')
+        LOADED_MODELS[(model_name, version)] = (model, manifest)
+
+    model, manifest = LOADED_MODELS[(model_name, version)]
+    if expected_cols is not None and list(expected_cols) != manifest['feature_columns']:
+        raise ValueError(f'{model_name} v{version}: expected columns {list(expected_cols)}, '
+                         f'model was trained on {manifest["feature_columns"]}')
+    return model, manifest['feature_columns']
+
+
+def load_encoder(model_names=('Model_Alpha', 'Model_Beta'), versions=None):
+    """ One-hot encoder of registered models, the categories of every model merged, so road data is encoded
+    at inference with the categories the models were trained on instead of refitting.
+    Args:
+        model_names (tuple): models whose encoders are merged
+        versions (dict): model name -> version, latest by default
+    Returns:
+        encoder (dict): column -> sorted category names, see preprocessing.fit_one_hot
+    """
+    encoder = {}
+    for model_name in model_names:
+        version = (versions or {}).get(model_name) or latest_version(model_name)
+        load_model(model_name, version)
+        model_encoder = LOADED_MODELS[(model_name, version)][1].get('one_hot_encoder')
+        if model_encoder is None:
+            raise ValueError(f'{model_name} v{version} was registered without its one-hot encoder, '
+                             f'retrain it or pass an encoder')
+        for col, categories in model_encoder.items():
+            encoder[col] = sorted(set(encoder.get(col, [])) | set(categories))
+    return encoder
@@ -1,3 +1,5 @@
+import tempfile
+
 from catboost import CatBoostClassifier
 from catboost import Pool
 from sklearn.model_selection import train_test_split
@@ -12,16 +14,31 @@ def split_data(df, label, split_size):
     return x_train, x_valid, y_train, y_valid
 
 
-def train_catboost(params, x_train, x_valid, y_train, y_valid):
-    """ Conducts CatBoost modeling.
+def write_borders_file(columns, borders, path):
+    """ CatBoost input_borders file: feature index and border per line, for the features of borders in columns.
+    """
+    with open(path, 'w') as f:
+        for col, col_borders in borders.items():
+            if col in columns:
+                f.writelines(f'{columns.get_loc(col)}\t{border}\n' for border in col_borders)
+    return path
+
+
+def train_catboost(params, x_train, x_valid, y_train, y_valid, plot=True, borders=None):
+    """ Conducts CatBoost modeling. plot shows the interactive training widget, notebooks only.
+    borders (dict) fixes the quantization borders of some features by name, e.g. RISK_TABLE_WEATHER_BORDERS,
+    the other features get CatBoost's own.
     """
     train_data = Pool(data=x_train,
                       label=y_train)
     valid_data = Pool(data=x_valid,
                       label=y_valid)
-    model = CatBoostClassifier(**params)
-    model.fit(train_data,
-              eval_set=valid_data,
-              use_best_model=True,
-              plot=True)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if borders:
+            params = dict(params, input_borders=write_borders_file(x_train.columns, borders, f'{tmp_dir}/borders.tsv'))
+        model = CatBoostClassifier(**params)
+        model.fit(train_data,
+                  eval_set=valid_data,
+                  use_best_model=True,
+                  plot=plot)
     return model
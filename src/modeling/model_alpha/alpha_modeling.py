@@ -1,14 +1,15 @@
 import pandas as pd
 from eli5.sklearn import PermutationImportance
 
-from src import ups_data_loader, preprocessing, ups_plotting
+from src import artifact_cache, ups_data_loader, preprocessing, ups_plotting, model_registry, temporal_features
 from src.constants import *
 from src.modeling import boosted_modeling
 
 
+@artifact_cache.stage(file_args=('file_c', 'file_nc'))
 def load_preprocess(file_c, file_nc):
     """
-    Loads and preprocess the two datasets.
+    Loads and preprocess the two datasets. Memoized by artifact_cache until either file changes.
 
     Args:
         file_c (str): file name for crash data
@@ -21,15 +22,9 @@ def load_preprocess(file_c, file_nc):
     # load data
     df_c = pd.read_csv(file_c)
     df_nc = pd.read_csv(file_nc)
-    # convert days2nums
-    days = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Sunday', 'Saturday']
-    num = [x for x in range(len(days))]
-    day2num = dict(zip(num, days))
-    # time encode
-    df_nc.loc[:, 'Time'] = df_nc['hour'].map(lambda x: preprocessing.rush_hour(int(x)))
-    df_nc.loc[:, 'Day'] = df_nc['day'].map(lambda x: day2num[int(x)])
-    df_nc = preprocessing.one_hot('Day', 'Day', df_nc)
-    df_nc = preprocessing.one_hot('Time', 'Time', df_nc)
+    # time encode, day numbers follow NUM2DAY
+    df_nc = pd.concat([df_nc, temporal_features.temporal_indicators(df_nc['hour'], df_nc['day'], df_nc.index)],
+                      axis=1)
     return df_c, df_nc
 
 
@@ -68,18 +63,20 @@ def drop_check_for_missing(df_c, df_nc):
     return df_c, df_nc
 
 
-def clean_preprocess_fullset(df_full, one_hot_cols, keep_cols):
-    """ Preprocessing data.
+def clean_preprocess_fullset(df_full, one_hot_cols, keep_cols, encoder=None):
+    """ Preprocessing data. The one-hot encoder is fit on df_full unless a fitted one is given, and returned
+    so it can be registered with the model.
     """
-    for col in one_hot_cols:
-        df_full = preprocessing.one_hot(col, col, df_full)
+    if encoder is None:
+        encoder = preprocessing.fit_one_hot(df_full, one_hot_cols)
+    df_full = preprocessing.transform_one_hot(encoder, df_full)
 
     df_full = df_full[keep_cols]
     df_full = df_full.dropna()
-    return df_full
+    return df_full, encoder
 
 
-def main(df_C, df_NC, label='target', split_frac=0.2, model_name='Model_Alpha'):
+def main(df_C, df_NC, label='target', split_frac=0.2, model_name='Model_Alpha', encoder=None, plot=True, plot_dir=None):
     """ Conducts alpha model training (model that predicts crash occurrence).
     Args:
         df_C (DataFrame): crash data
@@ -87,6 +84,9 @@ def main(df_C, df_NC, label='target', split_frac=0.2, model_name='Model_Alpha'):
         label (str): name of label column
         split_frac (str): test train split fraction
         model_name (str): model name used for saving model
+        encoder (dict): fitted one-hot encoder, e.g. fit on the full road inventory
+        plot (bool): draw the heat map, SHAP and training plots
+        plot_dir (str): write the plots to png files here instead of showing them
     Returns:
         perm (PermutationImportance): permutation importance of features
         cols (list): list of columns used
@@ -99,15 +99,22 @@ def main(df_C, df_NC, label='target', split_frac=0.2, model_name='Model_Alpha'):
     df_full = pd.concat([df_C, df_NC])
     # preprocess the full set
     one_hot_cols = ['RU_F_SYSTE', 'RU', 'MED_TYPE']
-    df_full = clean_preprocess_fullset(df_full, one_hot_cols, BST_COLS_ALPHA_MODEL + [label])
+    df_full, encoder = clean_preprocess_fullset(df_full, one_hot_cols, BST_COLS_ALPHA_MODEL + [label], encoder)
     # plot heat map of features
-    ups_plotting.plot_heat_map(df_full.drop([label], axis=1), figsize=8, fontsize=12)
+    if plot:
+        ups_plotting.plot_heat_map(df_full.drop([label], axis=1), figsize=8, fontsize=12,
+                                   save_path=f'{plot_dir}/{model_name}_heat_map.png' if plot_dir else None)
     # train model
     x_train, x_valid, y_train, y_valid = boosted_modeling.split_data(df_full, label, split_frac)
-    model_alpha = boosted_modeling.train_catboost(MODEL_ALPHA_PARAS, x_train, x_valid, y_train, y_valid)
+    model_alpha = boosted_modeling.train_catboost(MODEL_ALPHA_PARAS, x_train, x_valid, y_train, y_valid,
+                                                  plot=plot and plot_dir is None, borders=RISK_TABLE_WEATHER_BORDERS)
     ups_data_loader.pickel_model(model_name, model_alpha, x_train.columns)
+    model_registry.register_model(model_name, model_alpha, x_train.columns, x_train, model_alpha.get_best_score(),
+                                  encoder)
     # get permutation importance
     perm = PermutationImportance(model_alpha).fit(x_valid, y_valid)
     # plot SHAP
-    _, _ = ups_plotting.plot_shap(x_train, model_alpha)
+    if plot:
+        _, _ = ups_plotting.plot_shap(x_train, model_alpha,
+                                      save_path=f'{plot_dir}/{model_name}_shap.png' if plot_dir else None)
     return perm, x_train.columns.tolist(), x_valid, y_valid
@@ -1,10 +1,14 @@
+import collections
+import os
+import shutil
+
 import pandas as pd
 from eli5.sklearn import PermutationImportance
 
 from src.constants import *
 from src import preprocessing
 from src.modeling import boosted_modeling
-from src import ups_data_loader
+from src import artifact_cache, ups_data_loader, model_registry
 from src import ups_plotting
 
 
@@ -37,8 +41,7 @@ def mutual_exclusive(df_injry):
     for col in df_injry.columns:
         df_injry[col] = df_injry[col].map(lambda x: 0 if x == 0 else 1)
     # order of importance
-    ordered_cols = ['Death_Cnt', 'Incap_Injry_Cnt', 'Nonincap_Injry_Cnt',
-                    'Unkn_Injry_Cnt', 'Poss_Injry_Cnt','Non_Injry_Cnt']
+    ordered_cols = INJRY_PRIORITY_COLS
     dict_ = df_injry.to_dict(orient='dict')
     for target_col in ordered_cols:  # cycle
         dict_ = mutual_exclusive_helper(target_col, dict_, ordered_cols)
@@ -52,6 +55,41 @@ def mutual_exclusive(df_injry):
     return df_clean_injry
 
 
+def label_severity(df_injry):
+    """ Vectorized mutual_exclusive. Every crash is labeled by its most important injury column,
+    numbered by position in df_injry, 0 if it has none.
+    Args:
+        df_injry (DataFrame): injury counts, INJRY_PRIORITY_COLS in any order
+    Returns:
+        df_clean_injry (DataFrame): uint8 position of the label in its own column, 0 elsewhere, and target
+    """
+    flags = df_injry.values != 0  # NaN counts as an injury, as in mutual_exclusive
+    target = np.zeros(len(df_injry), dtype=np.uint8)
+    for col in INJRY_PRIORITY_COLS[::-1]:  # more important columns overwrite less important ones
+        pos = df_injry.columns.get_loc(col)
+        target[flags[:, pos]] = pos + 1
+
+    positions = np.arange(1, df_injry.shape[1] + 1, dtype=np.uint8)
+    df_clean_injry = pd.DataFrame(np.where(target[:, None] == positions, positions, 0).astype(np.uint8),
+                                  columns=df_injry.columns, index=df_injry.index)
+    df_clean_injry['target'] = target
+    return df_clean_injry
+
+
+def check_severity_labels(df_injry):
+    """ Equivalence check of label_severity against mutual_exclusive.
+    Args:
+        df_injry (DataFrame): injury counts
+    Returns:
+        n_mismatches (int): rows whose labels differ
+    """
+    expected = mutual_exclusive(df_injry.copy())
+    labeled = label_severity(df_injry)
+    n_mismatches = int((expected.values != labeled[expected.columns].values).any(axis=1).sum())
+    print(f'severity labels: {n_mismatches} of {len(df_injry)} rows differ from mutual_exclusive')
+    return n_mismatches
+
+
 def split_injury_and_label_crash_data(df_crash):
     """ Clean data and split predictor variables from label data.
     """
@@ -61,7 +99,7 @@ def split_injury_and_label_crash_data(df_crash):
     df_injry = df_clean_crash[INJRY_COLS]  # sub-select
     df_clean_crash = df_clean_crash.drop(INJRY_COLS, axis=1)
     df_injry = df_injry.rename(columns={'Sus_Serious_Injry_Cnt': 'Incap_Injry_Cnt'})
-    df_injry = mutual_exclusive(df_injry)
+    df_injry = label_severity(df_injry)
 
     df_clean_crash['target'] = df_injry['target']
     return df_clean_crash, df_injry
@@ -80,29 +118,93 @@ def balance_targets(df):
     return df_balanced
 
 
-def segment_data_preprocessing(df_crash, road_info):
-    """ Preprocess road/segment data.
+def segment_data_preprocessing(df_crash, road_info, encoder=None):
+    """ Preprocess road/segment data. The one-hot encoder is fit on road_info unless a fitted one is given,
+    and returned so it can be registered with the model, see main.
     """
     df_clean_crash, df_injry = split_injury_and_label_crash_data(df_crash)
     # match on street labels
     df_joined = df_clean_crash.merge(road_info, how='left', on='STR_UNQ_ID')
     # one hot cat cols
-    for col in ['HSYS', 'RU_F_SYSTE', 'RU', 'MED_TYPE']:
-        df_joined = preprocessing.one_hot(col, col, df_joined)
+    if encoder is None:
+        encoder = preprocessing.fit_one_hot(road_info, ROAD_ONE_HOT_COLS)
+    df_joined = preprocessing.transform_one_hot(encoder, df_joined)
 
     # remove class zero it is an error
     df_cleaned = df_joined[df_joined.target != 0]
     df_cleaned = df_cleaned.dropna()
+    return df_cleaned, encoder
+
+
+@artifact_cache.stage()
+def segment_data_table(df_crash, road_info, encoder=None):
+    """ segment_data_preprocessing of the whole crash table, memoized by artifact_cache on the content of
+    its inputs. Chunked ingest calls segment_data_preprocessing directly, so chunks are never cached.
+    """
+    return segment_data_preprocessing(df_crash, road_info, encoder)
+
+
+def ingest_crash_data(file_name, map_file_name, road_info, out_dir=INGEST_OUTPUT_DIR, chunk_size=INGEST_CHUNK_SIZE,
+                      encoder=None):
+    """ Streaming segment_data_preprocessing. The crash file is read chunk_size rows at a time, each chunk is
+    mapped to its road segments, labeled and joined, then written out partitioned by target, so peak memory
+    depends on chunk_size and not on the number of collisions.
+    Args:
+        file_name (str): crash file in DATA_PATH, see ups_data_loader.load_crash_and_weather
+        map_file_name (str): collision to road segment map in DATA_PATH
+        road_info (DataFrame): road/segment data
+        out_dir (str): output directory, holds target=<target>/part-<chunk>.parquet files
+        chunk_size (int): rows per chunk
+        encoder (dict): fit_one_hot encoder of ROAD_ONE_HOT_COLS, fit on road_info if not given
+    Returns:
+        counts (dict): rows written per target
+        encoder (dict): encoder of the written data, to register with the model
+    """
+    if encoder is None:
+        encoder = preprocessing.fit_one_hot(road_info, ROAD_ONE_HOT_COLS)
+    crash2segment = ups_data_loader.load_crash2segment_arrays(map_file_name)
+    shutil.rmtree(out_dir, ignore_errors=True)
+
+    dtypes, counts = None, collections.Counter()
+    for idx, df_crash in enumerate(ups_data_loader.iter_csv_chunks(file_name, chunk_size)):
+        df_crash['STR_UNQ_ID'] = ups_data_loader.map_crash2segment(df_crash.Crash_ID.values, crash2segment)
+        df_cleaned, _ = segment_data_preprocessing(df_crash, road_info, encoder)
+        # a chunk without missing values would otherwise infer int where others have float
+        dtypes = df_cleaned.dtypes if dtypes is None else dtypes
+        df_cleaned = df_cleaned.astype(dtypes)
+        for target, df_target in df_cleaned.groupby('target'):
+            os.makedirs(f'{out_dir}/target={target}', exist_ok=True)
+            df_target.drop(columns='target').to_parquet(f'{out_dir}/target={target}/part-{idx:05d}.parquet', index=False)
+            counts[target] += len(df_target)
+    return dict(counts), encoder
+
+
+def load_ingested_crash_data(out_dir=INGEST_OUTPUT_DIR, columns=None, targets=None):
+    """ Read the output of ingest_crash_data back as one frame.
+    Args:
+        out_dir (str): ingest_crash_data output directory
+        columns (list): columns to read, all by default
+        targets (list): targets to read, all by default
+    Returns:
+        df_cleaned (DataFrame): same columns as segment_data_preprocessing
+    """
+    filters = [('target', 'in', list(targets))] if targets is not None else None
+    columns = columns if columns is None or 'target' in columns else list(columns) + ['target']
+    df_cleaned = pd.read_parquet(out_dir, columns=columns, filters=filters)
+    df_cleaned['target'] = df_cleaned['target'].astype(int)
     return df_cleaned
 
 
-def main(df_cleaned, label='target', split_frac=0.2, model_name='Model_Beta'):
+def main(df_cleaned, label='target', split_frac=0.2, model_name='Model_Beta', encoder=None, plot=True, plot_dir=None):
     """ Conducts beta model training (model that predicts crash severity).
     Args:
         df_cleaned (DataFrame): preprocess data for beta modeling
         label (str): name of label column
         split_frac (str): test train split fraction
         model_name (str): model name used for saving model
+        encoder (dict): one-hot encoder df_cleaned was encoded with, from segment_data_preprocessing
+        plot (bool): draw the heat map, SHAP and training plots
+        plot_dir (str): write the plots to png files here instead of showing them
     Returns:
         perm (PermutationImportance): permutation importance of features
         cols (list): list of columns used
@@ -110,7 +212,9 @@ def main(df_cleaned, label='target', split_frac=0.2, model_name='Model_Beta'):
         y_valid (DataFrame): validation labels
     """
     df_cleaned = df_cleaned[[label] + BST_COLS_BETA_MODEL]
-    ups_plotting.plot_heat_map(df_cleaned.drop([label], axis=1), figsize=8, fontsize=12)
+    if plot:
+        ups_plotting.plot_heat_map(df_cleaned.drop([label], axis=1), figsize=8, fontsize=12,
+                                   save_path=f'{plot_dir}/{model_name}_heat_map.png' if plot_dir else None)
 
     x_train, x_valid, y_train, y_valid = boosted_modeling.split_data(df_cleaned, label, split_frac)
     # add target to x_train for class balancing
@@ -119,11 +223,16 @@ def main(df_cleaned, label='target', split_frac=0.2, model_name='Model_Beta'):
     y_train = x_train_balance[label]
     x_train = x_train_balance.drop([label], axis=1)
 
-    model_beta = boosted_modeling.train_catboost(MODEL_BETA_PARAMS, x_train, x_valid, y_train, y_valid)
+    model_beta = boosted_modeling.train_catboost(MODEL_BETA_PARAMS, x_train, x_valid, y_train, y_valid,
+                                                 plot=plot and plot_dir is None, borders=RISK_TABLE_WEATHER_BORDERS)
 
     ups_data_loader.pickel_model(model_name, model_beta, x_train.columns)
+    model_registry.register_model(model_name, model_beta, x_train.columns, x_train, model_beta.get_best_score(),
+                                  encoder)
     # get permutation importance
     perm = PermutationImportance(model_beta).fit(x_valid, y_valid)
     # plot SHAP
-    _, _ = ups_plotting.plot_shap(x_train, model_beta)
+    if plot:
+        _, _ = ups_plotting.plot_shap(x_train, model_beta,
+                                      save_path=f'{plot_dir}/{model_name}_shap.png' if plot_dir else None)
     return perm, x_train.columns.tolist(), x_valid, y_valid
\ No newline at end of file
@@ -1,13 +1,13 @@
-import math
-import random
+import argparse
 
 import matplotlib.pyplot as plt
 import pandas as pd
 
 from src.constants import *
+from src.modeling.model_beta import non_crash_sampler
 
 
-def load_statistical_traffic_disto(file_name):
+def load_statistical_traffic_disto(file_name, plot=True):
     """ Load data about historic traffic seasonality daily and monthly
     """
     df = pd.read_csv(f'{DATA_PATH}/published_datasets/{file_name}')
@@ -21,9 +21,10 @@ def load_statistical_traffic_disto(file_name):
         df.loc[:, col] = df[col].map(lambda x: x / sum_)
 
     df["Ave"] = df.sum(axis=1) / 12
-    month_distri.plot.bar(figsize=FIGSIZE, color=(0.8, 0, 0))
-    plt.title('Traffic Monthly Distribution')
-    plt.show()
+    if plot:
+        month_distri.plot.bar(figsize=FIGSIZE, color=(0.8, 0, 0))
+        plt.title('Traffic Monthly Distribution')
+        plt.show()
     return df, month_distri
 
 
@@ -74,34 +75,6 @@ def sample_with_respect2aadt(road_info_sub, number_of_crashes):
     return resample_non_crash, distribution_aadt
 
 
-def add_month_column(resample_non_crash, month_distri, number_of_crashes):
-    """ Sample month data weighted by traffic data
-    Args:
-        resample_non_crash (DataFrame): resampled non-crash data
-        month_distri (array): weight of traffic per month
-        number_of_crashes (int): number of collisions
-    Returns:
-        resample_non_crash (DataFrame): resampled data with month data
-    """
-    monthly_percent = month_distri / sum(month_distri)
-    monthlyvalue = monthly_percent * number_of_crashes
-    monthlyvalue.plot.bar(figsize=FIGSIZE, color=(0.8, 0, 0))
-    plt.title('Resampled Monthly Distribution')
-    plt.show()
-
-    months = []
-    for month, num_val in enumerate(monthlyvalue):
-        months = months + [(month + 1) for x in range(math.ceil(num_val))]
-
-    random.shuffle(months)
-    months = months[:number_of_crashes]
-
-    resample_non_crash.loc[:,'month'] = months
-    resample_non_crash = resample_non_crash.reset_index()
-    resample_non_crash = resample_non_crash.drop(['index'], axis=1)
-    return resample_non_crash
-
-
 def load_hourly_statistical_traffic_disto(file_name):
     """ Load hour/weekday data
     """
@@ -146,7 +119,7 @@ def array2percent(arr):
     return [x / sum(arr) * 100 for x in arr]
 
 
-def main(df_crash, road_info, month_distri, df_traffic_by_hour, weekday2num):
+def main(df_crash, road_info, month_distri, df_traffic_by_hour, weekday2num, seed=None, plot=True):
     """ Generate non-crash data
     Args:
         df_crash (DataFrame): crash data
@@ -154,6 +127,8 @@ def main(df_crash, road_info, month_distri, df_traffic_by_hour, weekday2num):
         month_distri (dict): monthly seasonality
         df_traffic_by_hour (DataFrame): hourly seasonality
         weekday2num (dict): weekly seasonality
+        seed (int): seed of the sampler, the same seed gives the same data
+        plot (bool): plot the segment distributions
     Returns:
         df_concat (DataFrame): correctly sampled non-crash data
     """
@@ -161,17 +136,41 @@ def main(df_crash, road_info, month_distri, df_traffic_by_hour, weekday2num):
     road_info_sub.loc[:, 'fClassSimp'] = road_info_sub['RU_F_SYSTE'].map(lambda x: FCLASS2STREET_MAP[x])
 
     count_distribution = array2percent(road_info_sub['fClassSimp'].value_counts()[ROAD_CLASS_COLS])
-    # create a df that randomly selects the correct distrobtion of road segments
+    # sample segments, months, hours/weekdays and years in one pass
     number_of_crashes = len(df_crash)
-    resample_non_crash, aadt_distribution = sample_with_respect2aadt(road_info_sub,
-                                                                                        number_of_crashes)
-    resample_non_crash = add_month_column(resample_non_crash, month_distri, number_of_crashes)
-    count_resampled = array2percent(resample_non_crash.fClassSimp.value_counts()[ROAD_CLASS_COLS])
-    plot_distribution(count_distribution, aadt_distribution, count_resampled,
-                                         'Segment distributions')
-    # get hourly data
-    df_hour_day_year = fetch_hour_day_year(df_traffic_by_hour, weekday2num, number_of_crashes)
-    # join time with selected segments
-    df_concat = pd.concat([resample_non_crash, df_hour_day_year], axis=1)
+    tables = non_crash_sampler.build_sampler_tables(road_info_sub, month_distri, df_traffic_by_hour, weekday2num)
+    df_concat = non_crash_sampler.sample_non_crash(tables, number_of_crashes, seed)
+    count_resampled = array2percent(df_concat.fClassSimp.value_counts()[ROAD_CLASS_COLS])
+    if plot:
+        plot_distribution(count_distribution, count_resampled, count_resampled, 'Segment distributions')
     df_concat.to_csv(ROAD2WEATHER2DATE_PATH, index=False)  # save
     return df_concat
+
+
+def main_headless(n, seed=None, out_dir=NON_CRASH_SHARD_DIR, shard_rows=NON_CRASH_SHARD_ROWS, workers=None):
+    """ Generate non-crash data without plots, sharded across processes, see non_crash_sampler.generate_sharded.
+    Args:
+        n (int): number of non-crash samples, e.g. the number of collisions
+        seed (int): root seed, the same seed gives the same shards
+        out_dir (str): output directory of the shard files
+        shard_rows (int): samples per shard
+        workers (int): worker processes, defaults to the number of cpus
+    Returns:
+        summary (dict): sampled vs expected distributions
+    """
+    road_info = pd.read_csv(ROAD_DATA_PATH, usecols=['STR_UNQ_ID', 'AADT_DESGN', 'RU_F_SYSTE'])
+    _, month_distri = load_statistical_traffic_disto(PUBISHED_TRAFFIC_DATA_MONTHLY_FILE_NAME, plot=False)
+    df_traffic_by_hour, weekday2num = load_hourly_statistical_traffic_disto(PUBISHED_TRAFFIC_DATA_HOURLY_FILE_NAME)
+    tables = non_crash_sampler.build_sampler_tables(road_info, month_distri, df_traffic_by_hour, weekday2num)
+    return non_crash_sampler.generate_sharded(tables, n, out_dir, shard_rows, seed, workers)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Headless, sharded non-crash data generation.')
+    parser.add_argument('n', type=int, help='number of non-crash samples')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--out-dir', default=NON_CRASH_SHARD_DIR)
+    parser.add_argument('--shard-rows', type=int, default=NON_CRASH_SHARD_ROWS)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+    main_headless(args.n, args.seed, args.out_dir, args.shard_rows, args.workers)
@@ -0,0 +1,209 @@
+import json
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from src.constants import *
+
+
+def alias_table(weights):
+    """ Walker/Vose alias table of non-negative weights, built once so every draw costs O(1).
+    Args:
+        weights (array): unnormalized weights
+    Returns:
+        table (tuple): acceptance probability and alias index of every bucket
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    scaled = (weights * (len(weights) / weights.sum())).tolist()
+    prob, alias = [1.0] * len(scaled), list(range(len(scaled)))
+    small = [idx for idx, val in enumerate(scaled) if val < 1]
+    large = [idx for idx, val in enumerate(scaled) if val >= 1]
+    while small and large:
+        less, more = small.pop(), large.pop()
+        prob[less], alias[less] = scaled[less], more
+        scaled[more] = scaled[more] + scaled[less] - 1
+        (small if scaled[more] < 1 else large).append(more)
+    return np.array(prob), np.array(alias, dtype=np.int64)  # buckets left over keep probability 1
+
+
+def draw(rng, table, n):
+    """ n indices drawn from the distribution behind an alias table.
+    """
+    prob, alias = table
+    buckets = rng.integers(len(prob), size=n)
+    return np.where(rng.random(n) < prob[buckets], buckets, alias[buckets])
+
+
+def build_sampler_tables(road_info, month_distri, traffic_df, weekday2num, years=NON_CRASH_YEARS):
+    """ Precompute everything the sampler draws from, once per input data.
+    Args:
+        road_info (DataFrame): road segment data with STR_UNQ_ID, AADT_DESGN and RU_F_SYSTE
+        month_distri (Series): traffic per month, see non_crash_data_gen.load_statistical_traffic_disto
+        traffic_df (DataFrame): traffic share per hour (rows) and weekday (columns),
+            see non_crash_data_gen.load_hourly_statistical_traffic_disto
+        weekday2num (dict): weekday column to day number
+        years (list): years drawn uniformly
+    Returns:
+        tables (dict): segment, month, hour/day and year tables
+    """
+    fclass = road_info['RU_F_SYSTE'].map(FCLASS2STREET_MAP)
+    hour_day = np.asarray(traffic_df.values, dtype=np.float64)  # hours x weekdays
+    return {
+        'segment_ids': road_info['STR_UNQ_ID'].values,
+        'segment_aadt': road_info['AADT_DESGN'].values,
+        'segment_f_system': pd.Categorical(road_info['RU_F_SYSTE']),
+        'segment_fclass': pd.Categorical(fclass, categories=ROAD_CLASS_COLS).codes,
+        'segment_table': alias_table(road_info['AADT_DESGN'].astype(int).values),
+        'month_table': alias_table(month_distri.values),
+        'hour_day_table': alias_table(hour_day.ravel()),
+        'n_days': hour_day.shape[1],
+        'day_nums': np.array([weekday2num[col] for col in traffic_df.columns], dtype=np.uint8),
+        'years': np.asarray(years, dtype=np.uint16),
+    }
+
+
+def sample_non_crash(tables, n, seed=None):
+    """ Draw non-crash samples: a segment weighted by AADT, a month weighted by monthly traffic,
+    an hour and weekday weighted jointly by hourly traffic, and a uniform year.
+    The same tables, n and seed always give the same samples.
+    Args:
+        tables (dict): see build_sampler_tables
+        n (int): number of samples
+        seed (int, SeedSequence): seed of the numpy Generator
+    Returns:
+        samples (DataFrame): STR_UNQ_ID, AADT_DESGN, RU_F_SYSTE, fClassSimp, month, day, hour, year
+    """
+    rng = np.random.default_rng(seed)
+    rows = draw(rng, tables['segment_table'], n)
+    hour_day = draw(rng, tables['hour_day_table'], n)
+    hours, days = np.divmod(hour_day, tables['n_days'])
+    return pd.DataFrame({
+        'STR_UNQ_ID': tables['segment_ids'][rows],
+        'AADT_DESGN': tables['segment_aadt'][rows],
+        'RU_F_SYSTE': pd.Categorical.from_codes(tables['segment_f_system'].codes[rows],
+                                                tables['segment_f_system'].categories),
+        'fClassSimp': pd.Categorical.from_codes(tables['segment_fclass'][rows], categories=ROAD_CLASS_COLS),
+        'month': (draw(rng, tables['month_table'], n) + 1).astype(np.uint8),
+        'day': tables['day_nums'][days],
+        'hour': hours.astype(np.uint8),
+        'year': tables['years'][rng.integers(len(tables['years']), size=n)],
+    })
+
+
+SHARD_TABLES = {}  # sampler tables of a worker process, set once by its initializer
+
+
+def init_shard_worker(tables):
+    SHARD_TABLES.update(tables)
+
+
+def sample_shard(shard, n, seed, out_dir):
+    """ Draw one shard in a worker process and write it to out_dir/part-<shard>.parquet.
+    Returns:
+        counts (dict): rows and the class, month and hour/day counts the summary is built from
+    """
+    tables = SHARD_TABLES
+    samples = sample_non_crash(tables, n, seed)
+    samples.to_parquet(f'{out_dir}/part-{shard:05d}.parquet', index=False)
+    day_pos = np.zeros(tables['day_nums'].max() + 1, dtype=np.int64)
+    day_pos[tables['day_nums']] = np.arange(tables['n_days'])  # day number back to its traffic_df column
+    hour_day = samples['hour'].values.astype(np.int64) * tables['n_days'] + day_pos[samples['day'].values]
+    return {
+        'rows': n,
+        'fclass': np.bincount(samples['fClassSimp'].cat.codes[samples['fClassSimp'].cat.codes >= 0],
+                              minlength=len(ROAD_CLASS_COLS)),
+        'month': np.bincount(samples['month'].values - 1, minlength=len(tables['month_table'][0])),
+        'hour_day': np.bincount(hour_day, minlength=len(tables['hour_day_table'][0])),
+    }
+
+
+def distribution_summary(tables, counts):
+    """ Percent of total per road class of the segments, of their AADT and of the samples, the numbers
+    non_crash_data_gen.plot_distribution draws, plus sampled vs expected month and hour/day shares.
+    Args:
+        tables (dict): see build_sampler_tables
+        counts (dict): summed sample_shard counts
+    Returns:
+        summary (dict): road_class, month and hour_day DataFrames
+    """
+    valid = tables['segment_fclass'] >= 0
+    fclass = tables['segment_fclass'][valid]
+    segment_count = np.bincount(fclass, minlength=len(ROAD_CLASS_COLS))
+    aadt = np.bincount(fclass, weights=tables['segment_aadt'][valid].astype(np.float64), minlength=len(ROAD_CLASS_COLS))
+    summary = {'road_class': pd.DataFrame({
+        'Segment Count': segment_count / segment_count.sum() * 100,
+        'AADT distribution': aadt / aadt.sum() * 100,
+        'Resampled Count': counts['fclass'] / counts['fclass'].sum() * 100,
+    }, index=ROAD_CLASS_COLS)}
+    for name in ['month', 'hour_day']:
+        prob, alias = tables[f'{name}_table']
+        expected = prob + np.bincount(alias, weights=1 - prob, minlength=len(prob))  # alias table back to weights
+        summary[name] = pd.DataFrame({'expected': expected / expected.sum() * 100,
+                                      'sampled': counts[name] / counts[name].sum() * 100})
+    summary['month'].index = np.arange(1, len(summary['month']) + 1)
+    summary['hour_day'].index = pd.MultiIndex.from_product(
+        [np.arange(len(summary['hour_day']) // tables['n_days']), tables['day_nums']], names=['hour', 'day'])
+    return summary
+
+
+def generate_sharded(tables, n, out_dir=NON_CRASH_SHARD_DIR, shard_rows=NON_CRASH_SHARD_ROWS, seed=None, workers=None):
+    """ Headless non-crash generation. n samples are split into shards with independent child seeds of seed,
+    drawn across a process pool and streamed to out_dir/part-<shard>.parquet, so no process holds more than
+    one shard. The same n, shard_rows and seed always give the same files.
+    Args:
+        tables (dict): see build_sampler_tables
+        n (int): total number of samples
+        out_dir (str): output directory, replaced
+        shard_rows (int): samples per shard
+        seed (int): root seed
+        workers (int): worker processes, defaults to the number of cpus
+    Returns:
+        summary (dict): see distribution_summary, also saved to out_dir/_summary.json
+    """
+    n_shards = max(1, -(-n // shard_rows))
+    sizes = [n // n_shards + (shard < n % n_shards) for shard in range(n_shards)]
+    seeds = np.random.SeedSequence(seed).spawn(n_shards)
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.makedirs(out_dir)
+
+    with ProcessPoolExecutor(workers, initializer=init_shard_worker, initargs=(tables,)) as pool:
+        results = list(pool.map(sample_shard, range(n_shards), sizes, seeds, [out_dir] * n_shards))
+    counts = {key: sum(result[key] for result in results) for key in results[0]}
+
+    summary = distribution_summary(tables, counts)
+    with open(f'{out_dir}/_summary.json', 'w') as f:
+        json.dump({'rows': int(counts['rows']), 'shards': n_shards, 'seed': seed,
+                   'road_class': summary['road_class'].round(3).to_dict(orient='index'),
+                   'month_max_abs_diff': float((summary['month'].sampled - summary['month'].expected).abs().max()),
+                   'hour_day_max_abs_diff': float((summary['hour_day'].sampled - summary['hour_day'].expected).abs().max())},
+                  f, indent=2)
+    print(f'{n} non-crash samples in {n_shards} shards written to {out_dir}')
+    print(summary['road_class'].round(2).to_string())
+    return summary
+
+
+def shard_files(out_dir=NON_CRASH_SHARD_DIR):
+    """ Shard files of generate_sharded in shard order.
+    """
+    if not os.path.exists(out_dir):
+        raise FileNotFoundError(f'No non-crash shards in {out_dir}, run non_crash_data_gen.main_headless first')
+    return [f'{out_dir}/{x}' for x in sorted(os.listdir(out_dir)) if x.startswith('part-')]
+
+
+def iter_shards(out_dir=NON_CRASH_SHARD_DIR, columns=None):
+    """ Read the output of generate_sharded back one shard at a time. Samples are numbered in shard order
+    as NonCrashIDX, so the same files always give the same keys.
+    Args:
+        out_dir (str): generate_sharded output directory
+        columns (list): columns to read, all by default
+    Yields:
+        samples (DataFrame): NonCrashIDX and the columns of sample_non_crash
+    """
+    offset = 0
+    for file_name in shard_files(out_dir):
+        samples = pd.read_parquet(file_name, columns=columns)
+        samples.insert(0, 'NonCrashIDX', np.arange(offset, offset + len(samples), dtype=np.int64))
+        offset += len(samples)
+        yield samples
@@ -7,8 +7,9 @@ import pandas as pd
 from scipy.spatial import cKDTree
 import matplotlib.pyplot as plt
 from src.constants import *
-from src.modeling.model_complete import model_full
+from src.modeling.model_complete import model_full, risk_routing
 from src import ups_plotting
+from src.common_tools import load_obj, save_obj
 
 def fetch_map_demo_data():
     """ Loads a nx network map of Fredericksburg TX for model demonstration.
@@ -80,22 +81,35 @@ def map_street_id2edges(segments, gdf_edges):
     return map_df
 
 
-def get_route_in_unq(route, map_df):
-    """
+def build_edge_index(map_df):
+    """ Hash index from nx edges to segment id's, built once per map.
     Args:
-        route (list): list of nx edges in the selected trip
         map_df (DataFrame): map nx to segment id's
+    Returns:
+        edge_index (Series): STR_UNQ_ID indexed by (u, v), parallel edges keep the first match
+    """
+    edge_index = map_df.drop_duplicates(['u', 'v']).set_index(['u', 'v'])['STR_UNQ_ID']
+    return edge_index
+
+
+def get_route_in_unq(route, edge_index):
+    """ Translate a route into segment id's with one vectorized lookup.
+    Args:
+        route (list): list of nx nodes in the selected trip
+        edge_index (Series): index built by build_edge_index
     Returns:
         str_urq_ids (list): segment id's in the trip
+        unmatched (list): (u, v) edges of the trip without a segment
     """
-    str_urq_ids = []
-    for idx in range(len(route) - 1):
-        str_urq_ids.append(map_df[map_df.u == route[idx]][map_df.v==route[idx + 1]].STR_UNQ_ID.values[0])
-    return str_urq_ids
+    edges = pd.MultiIndex.from_arrays([route[:-1], route[1:]], names=['u', 'v'])
+    matched = edge_index.reindex(edges)
+    unmatched = edges[matched.isna().values].tolist()
+    str_urq_ids = matched.dropna().astype(int).tolist()
+    return str_urq_ids, unmatched
 
 
-def random_map(g, map_df, nd, model_alpha, model_beta, lat_long2uni, segment_map):
-    """ Map all open map nx network id's to our shape file.
+def random_map(g, map_df, nd, model_alpha, model_beta, lat_long2uni, segment_map, risk_weight=ROUTING_RISK_WEIGHT):
+    """ Select a risk-aware route between two random nodes.
     Args:
         g (NxNetwork): full network
         map_df (DataFrame): map of nx to segment id's with extended info for modeling
@@ -104,21 +118,39 @@ def random_map(g, map_df, nd, model_alpha, model_beta, lat_long2uni, segment_map
         model_beta (CatBoost Model): given a collision occurs, this model calculates probability of each crash severity.
         lat_long2uni (dict): coordinates to id of segment
         segment_map (dict): map segments to data
+        risk_weight (float): seconds of travel time one dollar of risk is worth
+    Returns:
+        g (NxNetwork): network with risk scored edges, reuse it to skip re-scoring
     """
-    route = nx.shortest_path(g, nd[random.randint(0, len(nd))], nd[random.randint(0, len(nd))])
-    str_urq_ids = get_route_in_unq(route, map_df)
-    # compute
+    if not g.graph.get('risk_scored'):
+        g = risk_routing.add_edge_risk_costs(g, map_df, model_alpha, model_beta, lat_long2uni, segment_map)
+    route = risk_routing.fetch_min_risk_route(g, random.choice(nd), random.choice(nd), risk_weight)
+    # the route is picked on per edge costs, the trip is priced as a whole as before
+    edge_index = g.graph.get('edge_index')
+    str_urq_ids, _ = get_route_in_unq(route, edge_index if edge_index is not None else build_edge_index(map_df))
     cost = model_full.fetch_trip_cost(model_alpha, model_beta, lat_long2uni, segment_map, str_urq_ids)
     print(f'This route incurs a risk cost of: ${round(cost, 2)}')
     # plot
     fig, ax = ox.plot_graph_route(g, route, route_linewidth=6, node_size=0, bgcolor='k', show=False, close=False)
     fig.text(0.15, 0.81, f'Incurred Risk Cost: ${round(cost, 2)}', fontsize=12, color='white', fontweight='bold')
     plt.show()
+    return g
 
 def fetch_demo_maps(target_city_streets):
     """ Load network map information for demonstration.
+    The edge to segment index is stored on the graph (g.graph['edge_index']) and saved with the map.
     """
     g, gdf_nodes, gdf_edges = load_plot_graph()
     map_df = map_street_id2edges(target_city_streets, gdf_edges)
+    edge_index = build_edge_index(map_df)
+    save_obj({'map_df': map_df, 'edge_index': edge_index}, DEMO_MAP_OBJ_NAME)
+    g.graph['edge_index'] = edge_index
     nd = list(g.nodes)
     return g, map_df, nd
+
+
+def load_demo_maps():
+    """ Load the saved map of nx edges to segment id's and its edge index.
+    """
+    saved = load_obj(DEMO_MAP_OBJ_NAME)
+    return saved['map_df'], saved['edge_index']
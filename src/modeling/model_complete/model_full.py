@@ -1,8 +1,12 @@
 import pandas as pd
 from src.constants import *
 import datetime
-from src import preprocessing
+from src import preprocessing, segment_store, temporal_features
 from src.weather.weather_data import get_weather_data
+from src.weather.weather_cache import WeatherCache
+from src.weather.weather_store import query_weather
+
+WEATHER_CACHE = WeatherCache()  # shared by every trip scored in this process
 
 
 def get_date_data(day_val):
@@ -18,6 +22,33 @@ def get_date_data(day_val):
     return day_data
 
 
+def fetch_weather_now(lat, long, date_now):
+    """Latest weather observation of the day at a location, straight from the API.
+    Returns:
+        weather_data_now (dict): WEATHER_COLS values
+    """
+    weather_data = get_weather_data(lat, long, date_now.strftime('%m/%d/%Y'))['observations'][-1]
+    weather_data_now = {}
+    for col in WEATHER_COLS:
+        weather_data_now[col] = weather_data[col]
+    return weather_data_now
+
+
+def get_weather_now(lat, long, date_now, weather_cache=None):
+    """Latest weather observation at a location, shared by every segment in the same cell and hour.
+    Args:
+        lat (float): latitude
+        long (float): longitude
+        date_now (datetime): time of the trip
+        weather_cache (WeatherCache): defaults to the process wide WEATHER_CACHE
+    Returns:
+        weather_data_now (dict): WEATHER_COLS values
+    """
+    if weather_cache is None:
+        weather_cache = WEATHER_CACHE
+    return weather_cache.get(lat, long, date_now, fetch_weather_now)
+
+
 def get_data_from_segment(road_id, lat_long2uni, segment_map):
     """Given a date and a coordinates collect weather data from that day.
         Can be used live to collect weather data of trip path.
@@ -34,20 +65,30 @@ def get_data_from_segment(road_id, lat_long2uni, segment_map):
     date_now = datetime.datetime.now()
     day_val, h = date_now.weekday(), int(date_now.strftime('%H'))
     # get temporal data
-    day_data = get_date_data(day_val)
-    time_data = preprocessing.rush_hour_peripheral(h)
+    temporal_data = temporal_features.temporal_indicators([h], [day_val]).iloc[0].to_dict()
     # get weather
-    weather_data = get_weather_data(lat, long, date_now.strftime('%m/%d/%Y'))['observations'][-1]
-    weather_data_now = {}
-    for col in ['precip_hrly', 'vis', 'wspd']:
-        weather_data_now[col] = weather_data[col]
+    weather_data_now = get_weather_now(lat, long, date_now)
 
     all_data = {}
-    for d in [data, day_data, time_data, weather_data_now]:
+    for d in [data, temporal_data, weather_data_now]:
         all_data.update(d)
     return all_data
 
 
+def trip_risk_cost(proba_alpha, proba_beta):
+    """Combine model outputs of every segment of a trip into the trip risk cost.
+    Args:
+        proba_alpha (array): model alpha probabilities, one row per segment
+        proba_beta (array): model beta severity probabilities, one row per segment
+    Returns:
+        cost (float): risk cost
+    """
+    prob_nc_c = np.sum(proba_alpha, axis=0)[1] * get_distro_crash() / 50  # procrash*likelyHood
+    prob_severity = np.sum(proba_beta, axis=0) * get_distro_sever()
+    cost = prob_nc_c * sum(prob_severity * COST_ARR)
+    return cost
+
+
 def fetch_trip_cost(model_alpha, model_beta, lat_long2uni, segment_map, segments):
     """Implement both model alpha and beta to calculate risk cost per segment.
     Args:
@@ -64,8 +105,130 @@ def fetch_trip_cost(model_alpha, model_beta, lat_long2uni, segment_map, segments
         data[idx] = get_data_from_segment(road_id, lat_long2uni, segment_map)
     data = pd.DataFrame(data).T
 
-    prob_nc_c = np.sum(model_alpha.predict_proba(data[BST_COLS_ALPHA_MODEL]), axis=0)[
-                    1] * DISTRO_CRASH / 50  # procrash*likelyHood
-    prob_severity = np.sum(model_beta.predict_proba(data[BST_COLS_BETA_MODEL]), axis=0) * DISTRO_SEVER
-    cost = prob_nc_c * sum(prob_severity * COST_ARR)
-    return cost
+    return trip_risk_cost(model_alpha.predict_proba(data[BST_COLS_ALPHA_MODEL]),
+                          model_beta.predict_proba(data[BST_COLS_BETA_MODEL]))
+
+
+def fetch_trip_features(store, segments, date_now=None, weather_cache=None, weather=None, weather_store=None):
+    """Build the model input frame of a trip from the segment store.
+    Args:
+        store (dict): segment store, see segment_store.build_segment_store
+        segments (list): list of segments in the given trip
+        date_now (datetime): time of the trip, defaults to now
+        weather_cache (WeatherCache): defaults to the process wide WEATHER_CACHE
+        weather (dict): known WEATHER_COLS values for the whole trip, skips the weather lookup
+        weather_store (dict): offline weather store, looked up instead of the API, see weather_store.load_weather_store
+    Returns:
+        data (DataFrame): static, temporal and weather features, one row per segment
+    """
+    if date_now is None:
+        date_now = datetime.datetime.now()
+    rows = segment_store.lookup_rows(store, segments)
+    data = segment_store.gather_features(store, rows)
+    # temporal data is shared by the whole trip
+    temporal_data = temporal_features.temporal_indicators(np.full(len(rows), date_now.hour),
+                                                          np.full(len(rows), date_now.weekday()))
+    data[temporal_data.columns] = temporal_data.values
+    # get weather
+    if weather is not None:
+        for col in WEATHER_COLS:
+            data[col] = np.float32(weather[col])
+        return data
+    if weather_store is not None:
+        weather = query_weather(weather_store, store['lat'][rows], store['long'][rows],
+                                np.full(len(rows), np.datetime64(date_now)))
+        data[WEATHER_COLS] = weather[WEATHER_COLS].values
+        return data
+    weather = [get_weather_now(lat, long, date_now, weather_cache)
+               for lat, long in zip(store['lat'][rows], store['long'][rows])]
+    data[WEATHER_COLS] = pd.DataFrame(weather, columns=WEATHER_COLS).astype(np.float32).values
+    return data
+
+
+def fetch_trip_cost_from_store(model_alpha, model_beta, store, segments, date_now=None, weather_cache=None,
+                               weather_store=None):
+    """Same risk cost as fetch_trip_cost, with features gathered from the segment store.
+    Args:
+        model_alpha (CatBoost Model): calculates probability of collision
+        model_beta (CatBoost Model): given a collision occurs, this model calculates probability of each crash severity.
+        store (dict): segment store
+        segments (list): list of segments in the given trip
+        date_now (datetime): time of the trip, defaults to now
+        weather_cache (WeatherCache): defaults to the process wide WEATHER_CACHE
+        weather_store (dict): offline weather store, see fetch_trip_features
+    Returns:
+        cost (float): risk cost
+    """
+    data = fetch_trip_features(store, segments, date_now, weather_cache, weather_store=weather_store)
+    return trip_risk_cost(model_alpha.predict_proba(data[BST_COLS_ALPHA_MODEL]),
+                          model_beta.predict_proba(data[BST_COLS_BETA_MODEL]))
+
+
+def fetch_trip_costs(model_alpha, model_beta, store, trips, date_now=None, weather_cache=None, weather_store=None):
+    """Score many trips at once. Segments shared by trips are scored once and each model runs once.
+    Args:
+        model_alpha (CatBoost Model): calculates probability of collision
+        model_beta (CatBoost Model): given a collision occurs, this model calculates probability of each crash severity.
+        store (dict): segment store
+        trips (list): list of trips, each a list of segments
+        date_now (datetime): time of the trips, defaults to now
+        weather_cache (WeatherCache): defaults to the process wide WEATHER_CACHE
+        weather_store (dict): offline weather store, see fetch_trip_features
+    Returns:
+        costs (array): risk cost per trip, equal to fetch_trip_cost_from_store of each trip
+        breakdown (DataFrame): one row per trip segment with trip, STR_UNQ_ID, prob_crash and risk_cost
+    """
+    lengths = np.array([len(trip) for trip in trips], dtype=np.int64)
+    trip_idx = np.repeat(np.arange(len(trips)), lengths)
+    segments = np.concatenate([np.asarray(trip, dtype=np.int64) for trip in trips] + [np.array([], np.int64)])
+    unique_segments, inverse = np.unique(segments, return_inverse=True)
+
+    if len(unique_segments):
+        data = fetch_trip_features(store, unique_segments, date_now, weather_cache, weather_store=weather_store)
+        proba_alpha = model_alpha.predict_proba(data[BST_COLS_ALPHA_MODEL])[inverse]
+        proba_beta = model_beta.predict_proba(data[BST_COLS_BETA_MODEL])[inverse]
+    else:
+        proba_alpha, proba_beta = np.zeros((0, 2)), np.zeros((0, len(COST_ARR)))
+    # scatter segment results back to the trips
+    severity_cost = (proba_beta * get_distro_sever()) @ COST_ARR
+    prob_nc_c = np.bincount(trip_idx, weights=proba_alpha[:, 1], minlength=len(trips)) * get_distro_crash() / 50
+    costs = prob_nc_c * np.bincount(trip_idx, weights=severity_cost, minlength=len(trips))
+
+    breakdown = pd.DataFrame({'trip': trip_idx, 'STR_UNQ_ID': segments, 'prob_crash': proba_alpha[:, 1],
+                              'risk_cost': segment_risk_costs(proba_alpha, proba_beta)})
+    return costs, breakdown
+
+
+def segment_risk_costs(proba_alpha, proba_beta):
+    """Expected risk cost of each segment on its own, so costs can be summed along any route.
+    Args:
+        proba_alpha (array): model alpha probabilities, one row per segment
+        proba_beta (array): model beta severity probabilities, one row per segment
+    Returns:
+        costs (array): risk cost per segment
+    """
+    prob_c = proba_alpha[:, 1] * get_distro_crash() / 50  # procrash*likelyHood
+    severity_cost = (proba_beta * get_distro_sever()) @ COST_ARR
+    return prob_c * severity_cost
+
+
+def fetch_segment_costs(model_alpha, model_beta, lat_long2uni, segment_map, segments):
+    """Score many segments at once with a single pass of each model.
+    Args:
+        model_alpha (CatBoost Model): calculates probability of collision
+        model_beta (CatBoost Model): given a collision occurs, this model calculates probability of each crash severity.
+        lat_long2uni (dict): coordinates to id of segment
+        segment_map (dict): map segments to data
+        segments (list): segment ids to score, duplicates are scored once
+    Returns:
+        costs (Series): risk cost indexed by segment id
+    """
+    segments = pd.unique(pd.Series(segments))
+    data = {}
+    for idx, road_id in enumerate(segments):
+        data[idx] = get_data_from_segment(road_id, lat_long2uni, segment_map)
+    data = pd.DataFrame(data).T
+
+    costs = segment_risk_costs(model_alpha.predict_proba(data[BST_COLS_ALPHA_MODEL]),
+                               model_beta.predict_proba(data[BST_COLS_BETA_MODEL]))
+    return pd.Series(costs, index=segments)
@@ -0,0 +1,117 @@
+import networkx as nx
+import osmnx as ox
+
+from src.constants import *
+from src.modeling.model_complete import model_full
+
+
+def add_edge_risk_costs(g, map_df, model_alpha, model_beta, lat_long2uni, segment_map):
+    """ Score every edge of the network in one batch and store the result as edge weights.
+    Args:
+        g (NxNetwork): full network
+        map_df (DataFrame): map of nx edges (u, v, key) to segment id's
+        model_alpha (CatBoost Model): calculates probability of collision
+        model_beta (CatBoost Model): given a collision occurs, this model calculates probability of each crash severity.
+        lat_long2uni (dict): coordinates to id of segment
+        segment_map (dict): map segments to data
+    Returns:
+        g (NxNetwork): network with `travel_time` (s) and `risk_cost` ($) on every edge
+    """
+    g = ox.add_edge_speeds(g)
+    g = ox.add_edge_travel_times(g)
+
+    costs = model_full.fetch_segment_costs(model_alpha, model_beta, lat_long2uni, segment_map,
+                                           map_df.STR_UNQ_ID.values)
+    edge_costs = map_df.STR_UNQ_ID.map(costs).fillna(0).values
+    edges = zip(map_df.u.values, map_df.v.values, map_df.key.values)
+    nx.set_edge_attributes(g, dict(zip(edges, edge_costs)), 'risk_cost')
+    g.graph['risk_scored'] = True
+    return g
+
+
+def route_weight(risk_weight=ROUTING_RISK_WEIGHT):
+    """ Combined edge cost: travel time + risk_weight * risk cost.
+    Args:
+        risk_weight (float): seconds of travel time one dollar of risk is worth
+    Returns:
+        weight (func): weight function for nx path searches
+    """
+    def weight(u, v, d):
+        # d holds every parallel edge of a MultiDiGraph, keep the cheapest
+        return min(attr.get('travel_time', 0) + risk_weight * attr.get('risk_cost', 0) for attr in d.values())
+    return weight
+
+
+def travel_time_heuristic(g):
+    """ Admissible A* heuristic: straight line distance at the maximum network speed, the fastest edge of g
+    and at least ROUTING_MAX_SPEED_KPH, so the heuristic never overestimates the travel time left.
+    """
+    edge_speeds = [d['speed_kph'] for _, _, d in g.edges(data=True) if d.get('speed_kph') is not None]
+    max_speed = max(edge_speeds + [ROUTING_MAX_SPEED_KPH]) / 3.6  # m/s
+
+    def heuristic(u, v):
+        u_node, v_node = g.nodes[u], g.nodes[v]
+        return ox.distance.great_circle_vec(u_node['y'], u_node['x'], v_node['y'], v_node['x']) / max_speed
+    return heuristic
+
+
+def route_totals(g, route, risk_weight=ROUTING_RISK_WEIGHT):
+    """ Sum travel time and risk cost along a route using the edges the search picked.
+    Returns:
+        travel_time (float): seconds
+        risk_cost (float): dollars
+    """
+    weight = route_weight(risk_weight)
+    travel_time, risk_cost = 0, 0
+    for u, v in zip(route[:-1], route[1:]):
+        attr = min(g[u][v].values(), key=lambda x: weight(u, v, {0: x}))
+        travel_time += attr.get('travel_time', 0)
+        risk_cost += attr.get('risk_cost', 0)
+    return travel_time, risk_cost
+
+
+def fetch_min_risk_route(g, orig, dest, risk_weight=ROUTING_RISK_WEIGHT, method='astar'):
+    """ Find the route that minimises travel time + risk_weight * risk cost.
+    Args:
+        g (NxNetwork): network scored by add_edge_risk_costs
+        orig (int): origin node
+        dest (int): destination node
+        risk_weight (float): seconds of travel time one dollar of risk is worth
+        method (str): 'astar' or 'dijkstra'
+    Returns:
+        route (list): nodes of the selected route
+    """
+    weight = route_weight(risk_weight)
+    if method == 'astar':
+        return nx.astar_path(g, orig, dest, heuristic=travel_time_heuristic(g), weight=weight)
+    return nx.dijkstra_path(g, orig, dest, weight=weight)
+
+
+def fetch_pareto_routes(g, orig, dest, risk_weights=None, method='astar'):
+    """ Trade-off routes between travel time and risk cost.
+    Sweeps the risk weight and keeps every route that is not dominated on both objectives.
+    Args:
+        g (NxNetwork): network scored by add_edge_risk_costs
+        orig (int): origin node
+        dest (int): destination node
+        risk_weights (list): risk weights to sweep
+        method (str): 'astar' or 'dijkstra'
+    Returns:
+        pareto (list): dicts of route, travel_time and risk_cost sorted by travel time
+    """
+    if risk_weights is None:
+        risk_weights = ROUTING_PARETO_WEIGHTS
+    candidates = {}
+    for risk_weight in risk_weights:
+        route = fetch_min_risk_route(g, orig, dest, risk_weight, method)
+        if tuple(route) in candidates:
+            continue
+        travel_time, risk_cost = route_totals(g, route, risk_weight)
+        candidates[tuple(route)] = {'route': route, 'risk_weight': risk_weight,
+                                    'travel_time': travel_time, 'risk_cost': risk_cost}
+
+    pareto = []
+    for cand in sorted(candidates.values(), key=lambda x: (x['travel_time'], x['risk_cost'])):
+        if not pareto or cand['risk_cost'] < pareto[-1]['risk_cost']:
+            pareto.append(cand)
+    return pareto
@@ -0,0 +1,201 @@
+import datetime
+import itertools
+import json
+import os
+
+import pandas as pd
+from numpy.lib.format import open_memmap
+
+from src.constants import *
+from src import segment_store, temporal_features
+from src.modeling.model_complete import model_full
+
+REFERENCE_MONDAY = datetime.datetime(2021, 1, 4)
+
+
+def weather_cell(values, borders):
+    """ Interval of each weather value between the borders the models were quantized with, in float32 as the
+    models compare them: k counts the borders below the value, a value on a border belongs below it.
+    Missing values fall in the lowest interval, as under CatBoost's default nan_mode Min.
+    """
+    values = np.asarray(values, dtype=np.float32)
+    cells = np.searchsorted(np.asarray(borders, dtype=np.float32), values, side='left')
+    return np.where(np.isnan(values), 0, cells)
+
+
+def cell_values(borders):
+    """ A weather value inside each interval of borders, the value the interval is scored at.
+    """
+    return list(borders) + [borders[-1] + 1] if len(borders) else [0]
+
+
+def condition_grid(weather_borders):
+    """ Every weekday x time bucket x weather interval, in table order.
+    Args:
+        weather_borders (dict): quantization borders of each WEATHER_COLS column
+    Returns:
+        conditions (DataFrame): temporal one-hots and weather values, one row per state
+    """
+    states = np.array(list(itertools.product(range(len(DAYS)), range(len(TIME_COLS)),
+                                             *[cell_values(weather_borders[col]) for col in WEATHER_COLS])))
+    conditions = temporal_features.temporal_indicators(np.array(TIME_BUCKET_HOURS)[states[:, 1].astype(int)],
+                                                       states[:, 0])
+    conditions[WEATHER_COLS] = states[:, 2:].astype(np.float32)
+    return conditions
+
+
+def build_risk_tables(model_alpha, model_beta, store, path=RISK_TABLE_PATH, weather_borders=None,
+                      chunk_rows=RISK_TABLE_CHUNK_ROWS):
+    """ Offline stage: score every segment under every weekday, time bucket and weather interval.
+    Tables hold the crash probability and the expected severity cost of each segment, the two per-segment
+    terms of the trip risk cost, with shape (segment, weekday, time bucket, precip_hrly, vis, wspd), where every
+    weather axis has one state per interval between the weather borders. Models trained on the same borders,
+    see boosted_modeling.train_catboost, only see which interval a weather value is in, so the tables are exact.
+    Args:
+        model_alpha (CatBoost Model): calculates probability of collision
+        model_beta (CatBoost Model): given a collision occurs, this model calculates probability of each crash severity.
+        store (dict): segment store
+        path (str): output directory
+        weather_borders (dict): quantization borders of each WEATHER_COLS column
+        chunk_rows (int): segment x condition rows scored per model call, sets the segments per chunk
+    Returns:
+        tables (dict): see load_risk_tables
+    """
+    if weather_borders is None:
+        weather_borders = RISK_TABLE_WEATHER_BORDERS
+    if not os.path.exists(path):
+        os.makedirs(path)
+    conditions = condition_grid(weather_borders)
+    n_segments, n_conditions = len(store['ids']), len(conditions)
+    shape = (n_segments, len(DAYS), len(TIME_COLS)) + tuple(len(weather_borders[col]) + 1 for col in WEATHER_COLS)
+    chunk_size = max(1, chunk_rows // n_conditions)
+    print(f'risk tables: {n_conditions} conditions, {2 * 4 * n_conditions} bytes per segment, '
+          f'{2 * 4 * n_conditions * n_segments / 2 ** 30:.2f} GiB, {chunk_size} segments per chunk')
+
+    for name in ['ids', 'lat', 'long']:
+        np.save(f'{path}/{name}.npy', store[name])
+    with open(f'{path}/weather_borders.json', 'w') as f:
+        json.dump({col: weather_borders[col] for col in WEATHER_COLS}, f)
+    prob_crash = open_memmap(f'{path}/prob_crash.npy', mode='w+', dtype=np.float32, shape=shape)
+    severity_cost = open_memmap(f'{path}/severity_cost.npy', mode='w+', dtype=np.float32, shape=shape)
+
+    for start in range(0, n_segments, chunk_size):
+        rows = np.arange(start, min(start + chunk_size, n_segments))
+        static = segment_store.gather_features(store, rows)
+        # cross join the chunk with every condition
+        data = pd.concat([static.iloc[np.repeat(np.arange(len(rows)), n_conditions)].reset_index(drop=True),
+                          conditions.iloc[np.tile(np.arange(n_conditions), len(rows))].reset_index(drop=True)],
+                         axis=1)
+        proba_alpha = model_alpha.predict_proba(data[BST_COLS_ALPHA_MODEL])
+        proba_beta = model_beta.predict_proba(data[BST_COLS_BETA_MODEL])
+        prob_crash[rows] = proba_alpha[:, 1].reshape((len(rows),) + shape[1:])
+        severity_cost[rows] = ((proba_beta * get_distro_sever()) @ COST_ARR).reshape((len(rows),) + shape[1:])
+        print(f'risk tables: {rows[-1] + 1}/{n_segments} segments')
+    prob_crash.flush()
+    severity_cost.flush()
+    del prob_crash, severity_cost
+    return load_risk_tables(path)
+
+
+def load_risk_tables(path=RISK_TABLE_PATH, mmap_mode='r'):
+    """ Load risk tables, memory-mapped by default.
+    Returns:
+        tables (dict): ids, lat, long, prob_crash, severity_cost and weather_borders
+    """
+    with open(f'{path}/weather_borders.json') as f:
+        tables = {'weather_borders': json.load(f)}
+    for name in ['ids', 'lat', 'long', 'prob_crash', 'severity_cost']:
+        tables[name] = np.load(f'{path}/{name}.npy', mmap_mode=mmap_mode)
+    return tables
+
+
+def lookup_segment_risk(tables, segments, date_now, weather):
+    """ Crash probability and severity cost of segments by table gather, no model inference.
+    Args:
+        tables (dict): risk tables
+        segments (list): segment ids
+        date_now (datetime): time of the trip
+        weather (dict/DataFrame): WEATHER_COLS values for the whole trip or one row per segment
+    Returns:
+        prob_crash (array): per segment
+        severity_cost (array): per segment
+    """
+    rows = segment_store.lookup_rows(tables, segments)
+    day, bucket = date_now.weekday(), temporal_features.time_bucket_codes([date_now.hour])[0]
+    index = (rows, day, bucket) + tuple(
+        weather_cell(np.broadcast_to(np.asarray(weather[col], dtype=np.float64), len(rows)),
+                     tables['weather_borders'][col]) for col in WEATHER_COLS)
+    return tables['prob_crash'][index], tables['severity_cost'][index]
+
+
+def fetch_trip_cost_lookup(tables, segments, date_now=None, weather=None, weather_cache=None):
+    """ Lookup mode of fetch_trip_cost: same risk cost without any model inference.
+    Args:
+        tables (dict): risk tables
+        segments (list): list of segments in the given trip
+        date_now (datetime): time of the trip, defaults to now
+        weather (dict/DataFrame): WEATHER_COLS values, fetched live through the weather cache if not given
+        weather_cache (WeatherCache): defaults to the process wide model_full.WEATHER_CACHE
+    Returns:
+        cost (float): risk cost
+    """
+    if date_now is None:
+        date_now = datetime.datetime.now()
+    if weather is None:
+        rows = segment_store.lookup_rows(tables, segments)
+        weather = pd.DataFrame([model_full.get_weather_now(lat, long, date_now, weather_cache)
+                                for lat, long in zip(tables['lat'][rows], tables['long'][rows])],
+                               columns=WEATHER_COLS)
+    prob_crash, severity_cost = lookup_segment_risk(tables, segments, date_now, weather)
+    return np.sum(prob_crash) * get_distro_crash() / 50 * np.sum(severity_cost)
+
+
+def sample_weather(rng, observed=None, missing_frac=0.1):
+    """ Weather of a random trip: a random row of observed weather, or without it uniform over
+    RISK_TABLE_WEATHER_RANGE and now and then missing.
+    """
+    if observed is not None:
+        return observed.iloc[rng.integers(len(observed))][WEATHER_COLS].to_dict()
+    weather = {}
+    for col in WEATHER_COLS:
+        value = rng.uniform(*RISK_TABLE_WEATHER_RANGE[col])
+        weather[col] = np.nan if rng.random() < missing_frac else value
+    return weather
+
+
+def check_risk_tables(model_alpha, model_beta, store, tables, observed=None, n_checks=200, trip_len=20,
+                      tolerance=RISK_TABLE_TOLERANCE, seed=42):
+    """ Error of lookup mode against live inference, for random trips under continuous or observed weather.
+    Only float32 rounding remains if the models were trained on the weather borders of the tables.
+    Args:
+        model_alpha (CatBoost Model): calculates probability of collision
+        model_beta (CatBoost Model): given a collision occurs, this model calculates probability of each crash severity.
+        store (dict): segment store the tables were built from
+        tables (dict): risk tables
+        observed (DataFrame): WEATHER_COLS of observed weather trips draw theirs from, e.g. the non-crash
+            samples, see sample_weather
+        n_checks (int): number of random trips checked
+        trip_len (int): segments per random trip
+        tolerance (float): relative trip cost error the weather grid is meant to keep
+        seed (int): random seed
+    Returns:
+        max_rel_error (float): largest relative trip cost difference
+    """
+    rng = np.random.default_rng(seed)
+    errors = []
+    for _ in range(n_checks):
+        segments = rng.choice(tables['ids'], size=min(trip_len, len(tables['ids'])), replace=False)
+        day, bucket = rng.integers(len(DAYS)), rng.integers(len(TIME_COLS))
+        date_now = REFERENCE_MONDAY + datetime.timedelta(days=int(day), hours=TIME_BUCKET_HOURS[bucket])
+        weather = sample_weather(rng, observed)
+
+        data = model_full.fetch_trip_features(store, segments, date_now, weather=weather)
+        live = model_full.trip_risk_cost(model_alpha.predict_proba(data[BST_COLS_ALPHA_MODEL]),
+                                         model_beta.predict_proba(data[BST_COLS_BETA_MODEL]))
+        lookup = fetch_trip_cost_lookup(tables, segments, date_now, weather)
+        errors.append(abs(lookup - live) / max(abs(live), 1e-12))
+    max_rel_error = max(errors)
+    print(f'risk tables relative error vs live inference: mean {np.mean(errors):.2e}, '
+          f'p95 {np.percentile(errors, 95):.2e}, max {max_rel_error:.2e}, tolerance {tolerance:.0e} '
+          f"{'met' if max_rel_error <= tolerance else 'exceeded, retrain the models on RISK_TABLE_WEATHER_BORDERS'}")
+    return max_rel_error
@@ -0,0 +1,257 @@
+import argparse
+import hashlib
+import inspect
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import matplotlib
+import pandas as pd
+
+from src.constants import *
+from src import model_registry, preprocessing, segment_store, ups_data_loader
+from src.artifact_cache import file_fingerprint, module_fingerprint
+from src.modeling.model_alpha import alpha_modeling
+from src.modeling.model_beta import beta_modeling, non_crash_data_gen
+from src.modeling.model_complete import risk_tables
+from src.weather import weather_collector, weather_data
+
+
+def run_non_crash(config):
+    df_crash = ups_data_loader.load_crash_and_weather(CRASH_DATA_FILE_NAME, keep_cols=['Crash_ID'])
+    non_crash_data_gen.main_headless(len(df_crash), config['seed'])
+
+
+def run_weather_collection(config):
+    road_info = weather_data.geo_convert(pd.read_csv(ROAD_DATA_PATH, usecols=['STR_UNQ_ID', 'geometry']))
+    stid2lat = preprocessing.dict_from_cols(road_info, 'STR_UNQ_ID', 'Latitude')
+    stid2long = preprocessing.dict_from_cols(road_info, 'STR_UNQ_ID', 'Longitude')
+    requests, assignment = weather_collector.non_crash_weather_requests(stid2lat, stid2long, config['seed'])
+    weather_collector.collect_weather(requests, f'{WEATHER_JOURNAL_DIR}/non_crash.jsonl')
+    assignment.to_frame().to_parquet(f'{WEATHER_JOURNAL_DIR}/non_crash_assignment.parquet')
+
+
+def run_segment_store(config):
+    road_info = preprocessing.nan_thresh_drop(pd.read_csv(ROAD_DATA_PATH, low_memory=False))
+    preprocessing.preprocess_full_model_store(road_info, SEGMENT_STORE_PATH)
+
+
+def run_alpha_data(config):
+    df_c, df_nc = alpha_modeling.load_preprocess(CLEANED_C_FILE_PATH, CLEANED_NC_FILE_PATH)
+    df_c, df_nc = alpha_modeling.drop_check_for_missing(df_c, df_nc)
+    df_c.to_parquet(f'{PIPELINE_DIR}/alpha_crash.parquet')
+    df_nc.to_parquet(f'{PIPELINE_DIR}/alpha_non_crash.parquet')
+
+
+def run_beta_data(config):
+    road_info = pd.read_csv(ROAD_DATA_PATH, low_memory=False)
+    road_info = preprocessing.nan_thresh_drop(preprocessing.cull_cols(road_info), thresh=10000)
+    _, encoder = beta_modeling.ingest_crash_data(CRASH_DATA_FILE_NAME, CRASH2SEGMENT_FILE_NAME, road_info)
+    with open(f'{PIPELINE_DIR}/beta_encoder.json', 'w') as f:
+        json.dump(encoder, f)
+
+
+def run_train_alpha(config):
+    df_c = pd.read_parquet(f'{PIPELINE_DIR}/alpha_crash.parquet')
+    df_nc = pd.read_parquet(f'{PIPELINE_DIR}/alpha_non_crash.parquet')
+    alpha_modeling.main(df_c, df_nc, plot=config['plot_dir'] is not None, plot_dir=config['plot_dir'])
+
+
+def run_train_beta(config):
+    df_cleaned = beta_modeling.load_ingested_crash_data(columns=BST_COLS_BETA_MODEL)
+    with open(f'{PIPELINE_DIR}/beta_encoder.json') as f:
+        encoder = json.load(f)
+    beta_modeling.main(df_cleaned, encoder=encoder, plot=config['plot_dir'] is not None, plot_dir=config['plot_dir'])
+
+
+def run_risk_tables(config):
+    model_alpha, _ = model_registry.load_model('Model_Alpha')
+    model_beta, _ = model_registry.load_model('Model_Beta')
+    store = segment_store.load_segment_store(SEGMENT_STORE_PATH)
+    tables = risk_tables.build_risk_tables(model_alpha, model_beta, store)
+    observed = pd.read_parquet(f'{PIPELINE_DIR}/alpha_non_crash.parquet', columns=WEATHER_COLS)
+    if risk_tables.check_risk_tables(model_alpha, model_beta, store, tables, observed) > RISK_TABLE_TOLERANCE:
+        raise ValueError('Risk tables are off by more than RISK_TABLE_TOLERANCE, '
+                         'were the models trained on RISK_TABLE_WEATHER_BORDERS?')
+
+
+# Stages in dependency order. inputs are the source files a stage reads, outputs what it leaves behind,
+# modules the code it calls, so an edit to them or to the src modules they use runs the stage again.
+# CLEANED_*_FILE_PATH come from joining the collected weather onto the non-crash incidents, which happens
+# outside this pipeline, so alpha_data depends on non_crash and, through optional_deps, on weather_collection
+# when that stage is selected: a new sample or new weather runs it, and everything downstream, again.
+# segment_store one-hot encodes the road inventory with the encoder registered with the models, so it follows
+# training. Seeded stages depend on the seed, optional stages only run when asked for by name.
+STAGES = {
+    'non_crash': {'run': run_non_crash, 'deps': [], 'modules': [non_crash_data_gen],
+                  'inputs': [f'{DATA_PATH}/{CRASH_DATA_FILE_NAME}', ROAD_DATA_PATH,
+                             f'{DATA_PATH}/published_datasets/{PUBISHED_TRAFFIC_DATA_MONTHLY_FILE_NAME}',
+                             f'{DATA_PATH}/published_datasets/{PUBISHED_TRAFFIC_DATA_HOURLY_FILE_NAME}'],
+                  'outputs': [NON_CRASH_SHARD_DIR], 'seeded': True},
+    'weather_collection': {'run': run_weather_collection, 'deps': ['non_crash'], 'modules': [weather_collector],
+                           'inputs': [ROAD_DATA_PATH, WEATHER_LOCATIONS_PATH],
+                           'outputs': [f'{WEATHER_JOURNAL_DIR}/non_crash.jsonl',
+                                       f'{WEATHER_JOURNAL_DIR}/non_crash_assignment.parquet'],
+                           'seeded': True, 'optional': True},
+    'alpha_data': {'run': run_alpha_data, 'deps': ['non_crash'], 'optional_deps': ['weather_collection'],
+                   'modules': [alpha_modeling],
+                   'inputs': [CLEANED_C_FILE_PATH, CLEANED_NC_FILE_PATH],
+                   'outputs': [f'{PIPELINE_DIR}/alpha_crash.parquet', f'{PIPELINE_DIR}/alpha_non_crash.parquet']},
+    'beta_data': {'run': run_beta_data, 'deps': [], 'modules': [beta_modeling],
+                  'inputs': [f'{DATA_PATH}/{CRASH_DATA_FILE_NAME}', f'{DATA_PATH}/{CRASH2SEGMENT_FILE_NAME}',
+                             ROAD_DATA_PATH],
+                  'outputs': [INGEST_OUTPUT_DIR, f'{PIPELINE_DIR}/beta_encoder.json']},
+    'train_alpha': {'run': run_train_alpha, 'deps': ['alpha_data'], 'modules': [alpha_modeling], 'inputs': [],
+                    'outputs': [f'{MODEL_REGISTRY_PATH}/Model_Alpha']},
+    'train_beta': {'run': run_train_beta, 'deps': ['beta_data'], 'modules': [beta_modeling], 'inputs': [],
+                   'outputs': [f'{MODEL_REGISTRY_PATH}/Model_Beta']},
+    'segment_store': {'run': run_segment_store, 'deps': ['train_alpha', 'train_beta'], 'modules': [preprocessing],
+                      'inputs': [ROAD_DATA_PATH], 'outputs': [SEGMENT_STORE_PATH]},
+    'risk_tables': {'run': run_risk_tables, 'deps': ['alpha_data', 'train_alpha', 'train_beta', 'segment_store'],
+                    'modules': [risk_tables], 'inputs': [], 'outputs': [RISK_TABLE_PATH]},
+}
+
+
+def check_stage_names(names, stages=STAGES):
+    unknown = set(names) - set(stages)
+    if unknown:
+        raise KeyError(f'Unknown stages: {sorted(unknown)}, pick from {list(stages)}')
+
+
+def select_stages(targets=None, stages=STAGES):
+    """ Targets and everything they depend on, in dependency order. Defaults to every non-optional stage.
+    optional_deps are not pulled in, see stage_deps.
+    """
+    if not targets:
+        targets = [name for name, spec in stages.items() if not spec.get('optional')]
+    check_stage_names(targets, stages)
+    selected = set()
+    todo = list(targets)
+    while todo:
+        name = todo.pop()
+        if name not in selected:
+            selected.add(name)
+            todo.extend(stages[name]['deps'])
+    return [name for name in stages if name in selected]
+
+
+def stage_deps(name, names, stages=STAGES):
+    """ Stages name waits for: its deps, plus its optional_deps when they are selected as well.
+    """
+    spec = stages[name]
+    return spec['deps'] + [dep for dep in spec.get('optional_deps', []) if dep in names]
+
+
+def stage_keys(names, config, stages=STAGES):
+    """ Input hash of every stage: its run function, the modules it calls (see artifact_cache.module_fingerprint),
+    the seed of seeded stages, size and mtime of its input files and the keys of the stages it depends on,
+    so a change anywhere upstream changes every key downstream of it.
+    """
+    keys = {}
+    for name in names:
+        spec = stages[name]
+        key = {'code': inspect.getsource(spec['run']),
+               'modules': [module_fingerprint(module) for module in spec.get('modules', [])],
+               'seed': config['seed'] if spec.get('seeded') else None,
+               'inputs': [file_fingerprint(path) if os.path.exists(path) else {'missing': path}
+                          for path in spec['inputs']],
+               'deps': [keys[dep] for dep in stage_deps(name, names, stages)]}
+        keys[name] = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+    return keys
+
+
+def stamp_path(name):
+    return f'{PIPELINE_DIR}/_stamps/{name}.json'
+
+
+def is_current(name, key, stages=STAGES):
+    """ A stage is current when its last successful run had the same key and its outputs still exist.
+    """
+    if not os.path.exists(stamp_path(name)) or not all(os.path.exists(path) for path in stages[name]['outputs']):
+        return False
+    with open(stamp_path(name)) as f:
+        return json.load(f)['key'] == key
+
+
+def run_stage(run, config):
+    """ Run one stage function in a worker process, headless.
+    """
+    matplotlib.use('Agg')
+    s = time.time()
+    run(config)
+    return time.time() - s
+
+
+def run_pipeline(targets=None, force=(), workers=2, seed=None, plot_dir=None, dry_run=False, stages=STAGES):
+    """ Run the selected stages as a DAG: stages whose key changed, whose outputs are missing, or that are
+    forced run again along with everything downstream of them. Independent stages, e.g. train_alpha and
+    train_beta, run in parallel worker processes. A failed stage stops only the stages that depend on it.
+    Args:
+        targets (list): stages to bring up to date, see select_stages
+        force (list): stages to run even if current, KeyError on unknown names
+        workers (int): worker processes
+        seed (int): seed of the stages that draw random samples
+        plot_dir (str): write training plots here, no plots if None
+        dry_run (bool): only report what would run
+    Returns:
+        status (dict): stage -> 'current', 'ran', 'failed', 'skipped' or 'stale' on a dry run
+    """
+    config = {'seed': seed, 'plot_dir': plot_dir}
+    check_stage_names(force, stages)
+    names = select_stages(targets, stages)
+    deps = {name: stage_deps(name, names, stages) for name in names}
+    keys = stage_keys(names, config, stages)
+    stale = set()
+    for name in names:
+        if name in force or not is_current(name, keys[name], stages) or stale & set(deps[name]):
+            stale.add(name)
+    status = {name: 'current' for name in names if name not in stale}
+    if dry_run:
+        return {name: status.get(name, 'stale') for name in names}
+
+    os.makedirs(f'{PIPELINE_DIR}/_stamps', exist_ok=True)
+    pending = [name for name in names if name in stale]
+    with ProcessPoolExecutor(workers) as pool:
+        running = {}
+        while pending or running:
+            for name in list(pending):
+                if any(status.get(dep) in ('failed', 'skipped') for dep in deps[name]):
+                    pending.remove(name)
+                    status[name] = 'skipped'
+                elif all(status.get(dep) in ('current', 'ran') for dep in deps[name]):
+                    pending.remove(name)
+                    print(f'{name}: started')
+                    running[pool.submit(run_stage, stages[name]['run'], config)] = name
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    seconds = future.result()
+                except Exception as e:
+                    status[name] = 'failed'
+                    print(f'{name}: failed, {e!r}')
+                    continue
+                status[name] = 'ran'
+                with open(stamp_path(name), 'w') as f:
+                    json.dump({'key': keys[name], 'seconds': seconds, 'seed': seed}, f)
+                print(f'{name}: done in {seconds:.1f}s')
+    return {name: status[name] for name in names}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Headless, incremental model pipeline: ' + ', '.join(STAGES))
+    parser.add_argument('stages', nargs='*', help='stages to bring up to date, all non-optional ones by default')
+    parser.add_argument('--force', nargs='*', default=[], help='stages to run even if current')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--plot-dir', default=None, help='write training plots here as png files')
+    parser.add_argument('--dry-run', action='store_true', help='only show which stages would run')
+    args = parser.parse_args()
+    status = run_pipeline(args.stages, args.force, args.workers, args.seed, args.plot_dir, args.dry_run)
+    for name, state in status.items():
+        print(f'{name:20s}{state}')
+    if 'failed' in status.values():
+        raise SystemExit(1)
@@ -1,7 +1,7 @@
 import pandas as pd
-from shapely import wkt
 
 from src.constants import *
+from src import geometry, model_registry, segment_store
 
 
 def nan_thresh_drop(df, thresh=10000):
@@ -36,21 +36,60 @@ def cull_cols(df):
     return df
 
 
-def one_hot(new_name, old_name, df, exceptions=None):
-    """ Custom one-hot encoding.
+def category_names(values, exceptions=None):
+    """ Category name of each value as used in one-hot column names, exceptions (NaN by default) become 'Other'.
     """
-    if exceptions:
-        pass
-    else:
+    if exceptions is None:
         exceptions = ['NaN', np.nan]
-    unique_lst = df[str(old_name)].unique()
-    for item in unique_lst:
-        if item in exceptions:
-            df[str(new_name) + '_Other'] = np.where(df[str(old_name)] == item, 1, 0)
-        else:
-            df[str(new_name) + '_' + str(item)] = np.where(df[str(old_name)] == item, 1, 0)
-    df = df.drop([str(old_name)], axis=1)
-    return df
+    names = values.astype(str)
+    names[values.isna() | values.isin([x for x in exceptions if x is not np.nan])] = 'Other'
+    return names
+
+
+def fit_one_hot(df, cols, exceptions=None):
+    """ Record the categories of each column, at training time or on the full road inventory.
+    Args:
+        df (DataFrame): data holding the categorical columns
+        cols (list): columns to encode
+        exceptions (list): values grouped into the 'Other' category, NaN by default
+    Returns:
+        encoder (dict): column -> sorted category names, reuse it with transform_one_hot at inference
+    """
+    encoder = {}
+    for col in cols:
+        encoder[col] = sorted(category_names(df[col], exceptions).unique().tolist())
+    return encoder
+
+
+def transform_one_hot(encoder, df, exceptions=None):
+    """ Replace each encoded column by a fixed-schema uint8 indicator block built in one vectorized pass.
+    Every category of the encoder gets a column, values unseen at fit time get all zeros.
+    Args:
+        encoder (dict): from fit_one_hot
+        df (DataFrame): data holding the categorical columns
+        exceptions (list): same exceptions the encoder was fit with
+    Returns:
+        df (DataFrame): data with {col}_{category} indicator columns
+    """
+    blocks = []
+    for col, categories in encoder.items():
+        codes = pd.Categorical(category_names(df[col], exceptions), categories=categories).codes
+        block = np.zeros((len(df), len(categories)), dtype=np.uint8)
+        seen = codes >= 0
+        block[np.nonzero(seen)[0], codes[seen]] = 1
+        blocks.append(pd.DataFrame(block, columns=[f'{col}_{x}' for x in categories], index=df.index))
+    df = df.drop(list(encoder), axis=1)
+    df = df.drop([col for block in blocks for col in block.columns if col in df.columns], axis=1)
+    return pd.concat([df] + blocks, axis=1)
+
+
+def one_hot(new_name, old_name, df, exceptions=None):
+    """ Custom one-hot encoding. Categories are taken from df itself, use fit_one_hot/transform_one_hot
+    to keep the schema of training data at inference.
+    """
+    df = df.rename(columns={str(old_name): str(new_name)})
+    encoder = fit_one_hot(df, [str(new_name)], exceptions)
+    return transform_one_hot(encoder, df, exceptions)
 
 
 def dict_from_cols(df, col1, col2):
@@ -108,15 +147,28 @@ def get_coords(x, val):
     return x
 
 
-def preprocess_full_model_road(road_info):
-    """ Preprocess road/segment data
+def preprocess_road_frame(road_info, encoder=None, geometry_cache_dir=GEOMETRY_CACHE_DIR):
+    """ One-hot encode road data and add segment coordinates.
+    Args:
+        road_info (DataFrame): raw road data
+        encoder (dict): fit_one_hot encoder, defaults to the one saved with the registered models
+        geometry_cache_dir (str): parsed geometry cache, see geometry.load_geometry
     """
-    for col in ['HSYS', 'RU_F_SYSTE', 'RU', 'MED_TYPE']:
-        road_info = one_hot(col, col, road_info)
+    if encoder is None:
+        encoder = model_registry.load_encoder()
+    road_info = transform_one_hot(encoder, road_info)
+
+    geoms = geometry.load_geometry(road_info['geometry'], geometry_cache_dir)
+    road_info['geometry'] = geoms['geometry']
+    road_info.loc[:, 'lat'] = geoms['x']
+    road_info.loc[:, 'long'] = geoms['y']
+    return road_info
+
 
-    road_info['geometry'] = road_info['geometry'].apply(wkt.loads)
-    road_info.loc[:, 'lat'] = road_info['geometry'].map(lambda x: get_coords(x, 0))
-    road_info.loc[:, 'long'] = road_info['geometry'].map(lambda x: get_coords(x, 1))
+def preprocess_full_model_road(road_info, encoder=None):
+    """ Preprocess road/segment data, one-hot encoded with the encoder of the registered models by default.
+    """
+    road_info = preprocess_road_frame(road_info, encoder)
 
     lat_long2uni = {}
     longs, lats = road_info.long.tolist(), road_info.lat.tolist()
@@ -126,3 +178,19 @@ def preprocess_full_model_road(road_info):
     road_info_sub = road_info.drop(['STR_UNQ_ID', 'lat', 'long', 'geometry'], axis=1)
     segment_map = road_info_sub.to_dict('index')
     return segment_map, lat_long2uni
+
+
+def preprocess_full_model_store(road_info, path=None, encoder=None):
+    """ Preprocess road/segment data into an array backed segment store.
+    Args:
+        road_info (DataFrame): raw road data
+        path (str): if given the store is also saved here
+        encoder (dict): fit_one_hot encoder, defaults to the one saved with the registered models
+    Returns:
+        store (dict): see segment_store.build_segment_store
+    """
+    road_info = preprocess_road_frame(road_info, encoder)
+    store = segment_store.build_segment_store(road_info)
+    if path:
+        segment_store.save_segment_store(store, path)
+    return store
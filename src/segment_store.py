@@ -0,0 +1,93 @@
+import json
+import os
+
+import pandas as pd
+
+from src.constants import *
+
+
+def store_columns():
+    """ Static model columns held by the store, split into numeric and indicator (one-hot) blocks.
+    Temporal and weather columns change per request and are added at scoring time.
+    """
+    varying = set(DAYS + TIME_COLS + WEATHER_COLS)
+    cols = [col for col in dict.fromkeys(BST_COLS_ALPHA_MODEL + BST_COLS_BETA_MODEL) if col not in varying]
+    indicator_cols = [col for col in cols if col.startswith(('HSYS_', 'RU_', 'MED_TYPE_'))]
+    numeric_cols = [col for col in cols if col not in indicator_cols]
+    return numeric_cols, indicator_cols
+
+
+def build_segment_store(road_info):
+    """ Pack preprocessed road data into contiguous arrays indexed by STR_UNQ_ID.
+    Args:
+        road_info (DataFrame): one-hot encoded road data with lat/long columns
+    Returns:
+        store (dict): sorted segment ids, coordinates, float32 numeric block and uint8 indicator block
+    """
+    numeric_cols, indicator_cols = store_columns()
+    road_info = road_info.sort_values('STR_UNQ_ID')
+    # categories that never appear in this inventory are still part of the model schema
+    missing_cols = [col for col in numeric_cols + indicator_cols if col not in road_info.columns]
+    road_info = road_info.reindex(columns=road_info.columns.tolist() + missing_cols)
+    # preprocessing names the first coordinate (x) 'lat', so the columns are swapped here
+    store = {
+        'ids': road_info['STR_UNQ_ID'].values.astype(np.int64),
+        'lat': road_info['long'].values.astype(np.float64),
+        'long': road_info['lat'].values.astype(np.float64),
+        'numeric_cols': numeric_cols,
+        'numeric': np.ascontiguousarray(road_info[numeric_cols].values, dtype=np.float32),
+        'indicator_cols': indicator_cols,
+        'indicator': np.ascontiguousarray(road_info[indicator_cols].fillna(0).values, dtype=np.uint8),
+    }
+    return store
+
+
+def save_segment_store(store, path=SEGMENT_STORE_PATH):
+    """ Save the store as one .npy file per array plus a json file of column names.
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+    for name in ['ids', 'lat', 'long', 'numeric', 'indicator']:
+        np.save(f'{path}/{name}.npy', store[name])
+    with open(f'{path}/columns.json', 'w') as f:
+        json.dump({'numeric_cols': store['numeric_cols'], 'indicator_cols': store['indicator_cols']}, f)
+
+
+def load_segment_store(path=SEGMENT_STORE_PATH, mmap_mode='r'):
+    """ Load a saved store, memory-mapped by default so only gathered rows are read from disk.
+    """
+    with open(f'{path}/columns.json') as f:
+        store = json.load(f)
+    for name in ['ids', 'lat', 'long', 'numeric', 'indicator']:
+        store[name] = np.load(f'{path}/{name}.npy', mmap_mode=mmap_mode)
+    return store
+
+
+def lookup_rows(store, segments):
+    """ Map segment ids to store rows.
+    Args:
+        store (dict): segment store
+        segments (list): segment ids
+    Returns:
+        rows (array): row of each segment in the store
+    """
+    segments = np.asarray(segments, dtype=np.int64)
+    rows = np.searchsorted(store['ids'], segments)
+    found = rows < len(store['ids'])
+    found[found] = store['ids'][rows[found]] == segments[found]
+    if not found.all():
+        raise KeyError(f'Segments not in store: {segments[~found].tolist()}')
+    return rows
+
+
+def gather_features(store, rows):
+    """ Gather the static features of many segments with one fancy-index per block.
+    Args:
+        store (dict): segment store
+        rows (array): store rows from lookup_rows
+    Returns:
+        data (DataFrame): float32 numeric and uint8 indicator columns, one row per entry in rows
+    """
+    numeric = pd.DataFrame(store['numeric'][rows], columns=store['numeric_cols'])
+    indicator = pd.DataFrame(store['indicator'][rows], columns=store['indicator_cols'])
+    return pd.concat([numeric, indicator], axis=1)
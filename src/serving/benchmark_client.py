@@ -0,0 +1,71 @@
+import argparse
+import json
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from src.constants import *
+
+
+def post_json(url, body):
+    request = urllib.request.Request(url, data=json.dumps(body).encode(),
+                                     headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def score_trip(url, trip):
+    """ Score one trip and return the client side latency in ms.
+    """
+    s = time.perf_counter()
+    post_json(f'{url}/score', {'segments': [int(x) for x in trip]})
+    return (time.perf_counter() - s) * 1000
+
+
+def replay_trips(trips, url=f'http://{SERVICE_HOST}:{SERVICE_PORT}', concurrency=16, repeat=1):
+    """ Replay trips against the risk service from concurrent clients.
+    Args:
+        trips (list): list of trips, each a list of segments
+        url (str): service base url
+        concurrency (int): simultaneous clients
+        repeat (int): times every trip is replayed
+    Returns:
+        results (dict): client latency p50/p99, throughput and the service's own metrics
+    """
+    trips = list(trips) * repeat
+    s = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        latencies = np.array(list(pool.map(lambda trip: score_trip(url, trip), trips)))
+    wall = time.perf_counter() - s
+    with urllib.request.urlopen(f'{url}/metrics') as response:
+        service_metrics = json.loads(response.read())
+
+    results = {
+        'trips': len(trips),
+        'concurrency': concurrency,
+        'latency_p50_ms': float(np.percentile(latencies, 50)),
+        'latency_p99_ms': float(np.percentile(latencies, 99)),
+        'trips_per_s': len(trips) / wall,
+        'service': service_metrics,
+    }
+    print(f"{len(trips)} trips x{concurrency}: p50 {results['latency_p50_ms']:.1f} ms, "
+          f"p99 {results['latency_p99_ms']:.1f} ms, {results['trips_per_s']:.0f} trips/s, "
+          f"mean batch {service_metrics['mean_batch_size']:.1f}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay trips against the local risk service.')
+    parser.add_argument('trips', help='json file holding a list of trips (lists of STR_UNQ_ID)')
+    parser.add_argument('--url', default=f'http://{SERVICE_HOST}:{SERVICE_PORT}')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--repeat', type=int, default=1)
+    args = parser.parse_args()
+
+    with open(args.trips) as f:
+        trips = json.load(f)
+    replay_trips(trips, args.url, args.concurrency, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+import argparse
+import collections
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from src.constants import *
+from src import model_registry, segment_store
+from src.common_tools import load_obj
+from src.modeling.model_complete import model_demo, model_full
+
+
+class ServiceMetrics:
+    """ Request latency, batch size and throughput counters shared by the handler threads.
+    """
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests, self.trips, self.batches, self.errors = 0, 0, 0, 0
+        self.latencies = collections.deque(maxlen=window)  # ms of the most recent requests
+        self.batch_sizes = collections.deque(maxlen=window)
+
+    def record_request(self, latency_ms, n_trips, error=False):
+        with self.lock:
+            self.requests += 1
+            self.trips += n_trips
+            self.errors += int(error)
+            self.latencies.append(latency_ms)
+
+    def record_batch(self, batch_size):
+        with self.lock:
+            self.batches += 1
+            self.batch_sizes.append(batch_size)
+
+    def summary(self):
+        with self.lock:
+            latencies = np.array(self.latencies) if self.latencies else np.zeros(1)
+            uptime = time.time() - self.started
+            return {
+                'uptime_s': uptime,
+                'requests': self.requests,
+                'trips': self.trips,
+                'errors': self.errors,
+                'batches': self.batches,
+                'mean_batch_size': float(np.mean(self.batch_sizes)) if self.batch_sizes else 0,
+                'trips_per_s': self.trips / uptime,
+                'latency_p50_ms': float(np.percentile(latencies, 50)),
+                'latency_p99_ms': float(np.percentile(latencies, 99)),
+            }
+
+
+class MicroBatcher:
+    """ Coalesce trips submitted by concurrent requests into one scoring call.
+    A batch is flushed when it holds max_batch_size trips or max_wait_ms after its first trip arrived.
+    Args:
+        score_batch (func): list of trips -> (costs, breakdown), see model_full.fetch_trip_costs
+        metrics (ServiceMetrics): receives the size of every batch
+        max_batch_size (int): trips per batch
+        max_wait_ms (float): longest a trip waits for others to join its batch
+    """
+    def __init__(self, score_batch, metrics, max_batch_size=SERVICE_MAX_BATCH_SIZE, max_wait_ms=SERVICE_MAX_WAIT_MS):
+        self.score_batch = score_batch
+        self.metrics = metrics
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, trip):
+        future = Future()
+        self.queue.put((trip, future))
+        return future
+
+    def next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            self.metrics.record_batch(len(batch))
+            try:
+                costs, breakdown = self.score_batch([trip for trip, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            segment_costs = breakdown.groupby('trip').risk_cost.apply(list)
+            for idx, (_, future) in enumerate(batch):
+                future.set_result({'cost': float(costs[idx]), 'segment_costs': segment_costs.get(idx, [])})
+
+
+class RiskServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128  # concurrent clients queue in the listen backlog instead of being reset
+
+
+def make_handler(batcher, metrics, store, edge_index=None):
+    """ HTTP handler bound to a batcher.
+    POST /score accepts {"segments": [...]}, {"trips": [[...], ...]} or {"route": [node, ...]} (needs an edge index).
+    GET /metrics returns ServiceMetrics.summary().
+    """
+    class RiskHandler(BaseHTTPRequestHandler):
+        def send_json(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                self.send_json(200, metrics.summary())
+            elif self.path == '/health':
+                self.send_json(200, {'status': 'ok'})
+            else:
+                self.send_json(404, {'error': f'unknown path {self.path}'})
+
+        def do_POST(self):
+            if self.path != '/score':
+                self.send_json(404, {'error': f'unknown path {self.path}'})
+                return
+            s = time.perf_counter()
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                response, trips = {}, request.get('trips')
+                if 'segments' in request:
+                    trips = [request['segments']]
+                elif 'route' in request:
+                    if edge_index is None:
+                        raise ValueError('routes need the service to be started with an edge index')
+                    segments, unmatched = model_demo.get_route_in_unq(request['route'], edge_index)
+                    response['unmatched'] = [list(x) for x in unmatched]
+                    trips = [segments]
+                if trips is None:
+                    raise ValueError('request needs one of segments, trips or route')
+                for trip in trips:
+                    segment_store.lookup_rows(store, trip)  # reject unknown segments before they join a batch
+                results = [future.result() for future in [batcher.submit(trip) for trip in trips]]
+            except (ValueError, KeyError) as e:
+                metrics.record_request((time.perf_counter() - s) * 1000, 0, error=True)
+                self.send_json(400, {'error': str(e)})
+                return
+            except Exception as e:
+                metrics.record_request((time.perf_counter() - s) * 1000, 0, error=True)
+                self.send_json(500, {'error': str(e)})
+                return
+            response['costs'] = [x['cost'] for x in results]
+            response['segment_costs'] = [x['segment_costs'] for x in results]
+            metrics.record_request((time.perf_counter() - s) * 1000, len(trips))
+            self.send_json(200, response)
+
+        def log_message(self, format, *args):
+            pass  # access logs would dominate the latency being measured
+
+    return RiskHandler
+
+
+def make_server(model_alpha, model_beta, store, edge_index=None, host=SERVICE_HOST, port=SERVICE_PORT,
+                max_batch_size=SERVICE_MAX_BATCH_SIZE, max_wait_ms=SERVICE_MAX_WAIT_MS):
+    """ Build the scoring service around warm models and segment features.
+    Args:
+        model_alpha (CatBoost Model): calculates probability of collision
+        model_beta (CatBoost Model): given a collision occurs, this model calculates probability of each crash severity.
+        store (dict): segment store
+        edge_index (Series): optional (u, v) -> STR_UNQ_ID index for route requests
+        host (str): bind address, localhost by default
+        port (int): bind port
+        max_batch_size (int): trips per model call
+        max_wait_ms (float): longest a trip waits for a batch to fill
+    Returns:
+        server (RiskServer): call serve_forever() to start
+    """
+    metrics = ServiceMetrics()
+
+    def score_batch(trips):
+        return model_full.fetch_trip_costs(model_alpha, model_beta, store, trips)
+
+    batcher = MicroBatcher(score_batch, metrics, max_batch_size, max_wait_ms)
+    server = RiskServer((host, port), make_handler(batcher, metrics, store, edge_index))
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local risk scoring service.')
+    parser.add_argument('--store', default=SEGMENT_STORE_PATH, help='segment store directory')
+    parser.add_argument('--edge-index', action='store_true', help='load the demo map edge index for route requests')
+    parser.add_argument('--host', default=SERVICE_HOST)
+    parser.add_argument('--port', type=int, default=SERVICE_PORT)
+    parser.add_argument('--max-batch-size', type=int, default=SERVICE_MAX_BATCH_SIZE)
+    parser.add_argument('--max-wait-ms', type=float, default=SERVICE_MAX_WAIT_MS)
+    args = parser.parse_args()
+
+    model_alpha, _ = model_registry.load_model('Model_Alpha', expected_cols=BST_COLS_ALPHA_MODEL)
+    model_beta, _ = model_registry.load_model('Model_Beta', expected_cols=BST_COLS_BETA_MODEL)
+    store = segment_store.load_segment_store(args.store)
+    edge_index = load_obj(DEMO_MAP_OBJ_NAME)['edge_index'] if args.edge_index else None
+    server = make_server(model_alpha, model_beta, store, edge_index, args.host, args.port,
+                         args.max_batch_size, args.max_wait_ms)
+    print(f'Risk service listening on http://{args.host}:{args.port}')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
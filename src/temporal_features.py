@@ -0,0 +1,78 @@
+import pandas as pd
+
+from src.constants import *
+
+# TIME_COLS index of each hour of the day
+HOUR2TIME_CODE = np.array([TIME_COLS.index('Time_AM_peak') if 7 <= h <= 10 else
+                           TIME_COLS.index('Time_PM_peak') if 15 <= h <= 19 else
+                           TIME_COLS.index('Time_Mid_day') if 10 < h < 15 else
+                           TIME_COLS.index('Time_Night/Early_Morning') for h in range(24)], dtype=np.uint8)
+
+
+def time_bucket_codes(hours):
+    """ Index into TIME_COLS of every hour, same bins as preprocessing.rush_hour.
+    Args:
+        hours (array): hour of day 0-23
+    Returns:
+        codes (array): uint8 bucket index
+    """
+    return HOUR2TIME_CODE[np.asarray(hours).astype(np.int64)]
+
+
+def indicator_block(codes, cols, index=None):
+    """ uint8 one-hot block with one column per entry of cols, gathered from an identity matrix.
+    """
+    block = np.eye(len(cols), dtype=np.uint8)[np.asarray(codes).astype(np.int64)]
+    return pd.DataFrame(block, columns=cols, index=index)
+
+
+def time_indicators(hours, index=None):
+    """ Time_* indicator block of every hour.
+    """
+    return indicator_block(time_bucket_codes(hours), TIME_COLS, index)
+
+
+def day_indicators(day_nums, index=None):
+    """ Day_* indicator block of every weekday number, numbered as in NUM2DAY.
+    """
+    return indicator_block(day_nums, DAYS, index)
+
+
+def temporal_indicators(hours, day_nums, index=None):
+    """ Day_* and Time_* indicator blocks in one frame.
+    Args:
+        hours (array): hour of day 0-23
+        day_nums (array): weekday numbers
+        index (Index): index of the returned frame
+    Returns:
+        indicators (DataFrame): uint8 DAYS + TIME_COLS columns
+    """
+    # one uint8 block with a 1 set per row in each part, rather than two blocks concatenated
+    block = np.zeros((len(hours), len(DAYS) + len(TIME_COLS)), dtype=np.uint8)
+    row_starts = np.arange(0, block.size, block.shape[1])
+    block.reshape(-1)[row_starts + np.asarray(day_nums).astype(np.int64)] = 1
+    block.reshape(-1)[row_starts + len(DAYS) + time_bucket_codes(hours)] = 1
+    return pd.DataFrame(block, columns=DAYS + TIME_COLS, index=index)
+
+
+def parse_times(times):
+    """ Hour (0-23) and minute of '%I:%M %p' strings, vectorized preprocessing.reformat_time.
+    Only the distinct strings (at most 1440) are parsed.
+    """
+    codes, uniques = pd.factorize(pd.Series(times).astype(str))
+    parsed = pd.to_datetime(pd.Series(uniques), format='%I:%M %p')
+    return parsed.dt.hour.values[codes], parsed.dt.minute.values[codes]
+
+
+def parse_crash_datetimes(df):
+    """ Datetime of every crash from its Crash_Date and Crash_Time columns, vectorized get_crash_datetime.
+    Args:
+        df (DataFrame): crash data
+    Returns:
+        crash_datetimes (Series): datetime64 values indexed by Crash_ID
+    """
+    codes, uniques = pd.factorize(df['Crash_Date'].astype(str))
+    dates = pd.to_datetime(pd.Series(uniques), format='%m/%d/%Y').values[codes]
+    hours, minutes = parse_times(df['Crash_Time'])
+    crash_datetimes = dates + (hours * 60 + minutes).astype('timedelta64[m]')
+    return pd.Series(crash_datetimes, index=df['Crash_ID'].values, name='crash_datetime')
@@ -1,34 +1,111 @@
+import json
+import os
+
 import pandas as pd
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 
 from src.constants import *
 
 
-def load_all_tx_crash_data():
+def source_fingerprint(csv_path):
+    """ Size and modification time of a source file, a changed fingerprint invalidates its cache partition.
+    """
+    stat = os.stat(csv_path)
+    return {'source': os.path.abspath(csv_path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def normalize_csv_dtypes(df):
+    """ Store mixed type object columns as strings so every column has a single parquet type.
+    """
+    for col in df.columns[df.dtypes == object]:
+        df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+    return df
+
+
+def csv_cache_partition(csv_path, partition_dir):
+    """ Convert a csv file into a compressed parquet partition, unless the partition is already up to date.
+    Args:
+        csv_path (str): source csv
+        partition_dir (str): directory holding data.parquet and the source.json fingerprint
+    Returns:
+        path (str): parquet file of the partition
+    """
+    path, manifest_path = f'{partition_dir}/data.parquet', f'{partition_dir}/source.json'
+    fingerprint = source_fingerprint(csv_path)
+    if os.path.exists(path) and os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            if json.load(f) == fingerprint:
+                return path
+
+    print(f'Caching {csv_path} to {path}')
+    df = normalize_csv_dtypes(pd.read_csv(csv_path, low_memory=False))
+    os.makedirs(partition_dir, exist_ok=True)
+    df.to_parquet(f'{path}.tmp', index=False, compression='zstd', row_group_size=CRASH_CACHE_ROW_GROUP_SIZE)
+    os.replace(f'{path}.tmp', path)
+    with open(manifest_path, 'w') as f:
+        json.dump(fingerprint, f)
+    return path
+
+
+def read_csv_cached(csv_path, partition_dir, columns=None, filters=None, not_null=None):
+    """ Read a csv through its parquet partition, reading only the requested columns and row groups.
+    Args:
+        csv_path (str): source csv
+        partition_dir (str): cache partition of the csv
+        columns (list): columns to read, all by default
+        filters (list): pyarrow filters such as [('Crash_Sev_ID', 'in', [1, 2])]
+        not_null (list): columns whose missing values are dropped
+    Returns:
+        df (DataFrame): loaded data
+    """
+    expression = pq.filters_to_expression(filters) if filters else None
+    for col in not_null or []:
+        expression = pc.field(col).is_valid() if expression is None else expression & pc.field(col).is_valid()
+    table = pq.read_table(csv_cache_partition(csv_path, partition_dir), columns=columns, filters=expression)
+    return table.to_pandas()
+
+
+def build_crash_cache(years=CRASH_YEARS):
+    """ One time conversion of the raw yearly crash files, later loads only rebuild changed years.
+    """
+    return [csv_cache_partition(f'{PATH2CRASH_DIR}/{year} crash.csv', f'{CRASH_CACHE_DIR}/year={year}')
+            for year in years]
+
+
+def load_all_tx_crash_data(years=CRASH_YEARS, columns=None, filters=None):
     """ Load raw collision data from TxDOT.
+    Args:
+        years (list): crash years to load
+        columns (list): columns to load, all by default
+        filters (list): extra pyarrow filters, collisions without a Latitude are always dropped
     """
-    tx_crash1 = pd.read_csv(f'{PATH2CRASH_DIR}/2020 crash.csv', low_memory=False)
-    tx_crash2 = pd.read_csv(f'{PATH2CRASH_DIR}/2019 crash.csv', low_memory=False)
-    tx_crash3 = pd.read_csv(f'{PATH2CRASH_DIR}/2018 crash.csv', low_memory=False)
-    tx_crash = pd.concat([tx_crash1, tx_crash2, tx_crash3])
-    tx_crash = tx_crash[tx_crash['Latitude'].notna()]
+    tx_crash = [read_csv_cached(f'{PATH2CRASH_DIR}/{year} crash.csv', f'{CRASH_CACHE_DIR}/year={year}',
+                                columns, filters, not_null=['Latitude']) for year in years]
+    tx_crash = pd.concat(tx_crash, ignore_index=True)
     return tx_crash
 
 
-def load_crash_and_weather(file_name):
+def load_crash_and_weather(file_name, keep_cols=CRASH_WEATHER_COLS, filters=None):
     """ Load collision data.
     """
-    df = pd.read_csv(f'{DATA_PATH}/{file_name}')
-    keep_cols = ['Crash_ID', 'precip_hrly', 'vis', 'wc', 'wspd', 'Crash_Speed_Limit',
-                 'Road_Cls_ID', 'Crash_Sev_ID', 'Sus_Serious_Injry_Cnt', 'Nonincap_Injry_Cnt',
-                 'Poss_Injry_Cnt', 'Non_Injry_Cnt', 'Unkn_Injry_Cnt', 'Tot_Injry_Cnt',
-                 'Death_Cnt', 'Time_PM_peak', 'Time_Mid_day', 'Time_AM_peak',
-                 'Time_Night/Early_Morning', 'Day_Friday', 'Day_Sunday', 'Day_Thursday',
-                 'Day_Monday', 'Day_Wednesday', 'Day_Saturday', 'Day_Tuesday']
-
-    df = df[keep_cols]
+    df = read_csv_cached(f'{DATA_PATH}/{file_name}', f'{CRASH_CACHE_DIR}/{os.path.splitext(file_name)[0]}',
+                         keep_cols, filters)
     return df
 
 
+def iter_csv_chunks(file_name, chunk_size=INGEST_CHUNK_SIZE, columns=CRASH_WEATHER_COLS):
+    """ Read a csv in DATA_PATH in fixed size chunks, so memory does not grow with the file.
+    Args:
+        file_name (str): csv file in DATA_PATH
+        chunk_size (int): rows per chunk
+        columns (list): columns to read, all if None
+    Returns:
+        chunks (iterator): DataFrames of at most chunk_size rows
+    """
+    return pd.read_csv(f'{DATA_PATH}/{file_name}', usecols=columns, chunksize=chunk_size)
+
+
 def load_map_crash2segment(df_crash, file_name):
     """ Load map of collisions to road segments.
     """
@@ -38,23 +115,52 @@ def load_map_crash2segment(df_crash, file_name):
     return c_map_crash2street
 
 
+def load_crash2segment_arrays(file_name):
+    """ Map of collisions to road segments as two aligned arrays sorted by Crash_ID, 16 bytes per collision.
+    """
+    c_map_crash2street = pd.read_csv(f'{DATA_PATH}/{file_name}', usecols=['Crash_ID', 'STR_UNQ_ID'])
+    order = np.argsort(c_map_crash2street.Crash_ID.values, kind='stable')
+    return c_map_crash2street.Crash_ID.values[order], c_map_crash2street.STR_UNQ_ID.values[order]
+
+
+def map_crash2segment(crash_ids, crash2segment):
+    """ Road segment of every collision, vectorized load_map_crash2segment.
+    Args:
+        crash_ids (array): Crash_ID values
+        crash2segment (tuple): see load_crash2segment_arrays
+    Returns:
+        segments (array): STR_UNQ_ID of every collision
+    """
+    sorted_ids, segments = crash2segment
+    crash_ids = np.asarray(crash_ids)
+    rows = np.minimum(np.searchsorted(sorted_ids, crash_ids), len(sorted_ids) - 1)
+    missing = sorted_ids[rows] != crash_ids
+    if missing.any():
+        raise KeyError(f'{missing.sum()} collisions have no road segment, e.g. Crash_ID {crash_ids[missing][0]}')
+    return segments[rows]
+
+
 def pickel_model(model_name, model, cols):
     """ Save CatBoost model and used columns.
     """
     print(f'Model: {model_name} Save to: {PICKEL_PATH}/{model_name}.pkl')
     file_name = f"{PICKEL_PATH}/{model_name}.pkl"
-    pickle.dump(model, open(file_name, "wb"))
+    with open(file_name, "wb") as f:
+        pickle.dump(model, f)
 
     file_name = f"{PICKEL_PATH}/{model_name}_Columns.pkl"
-    pickle.dump(cols, open(file_name, "wb"))
+    with open(file_name, "wb") as f:
+        pickle.dump(cols, f)
 
 
 def load_model(model_name):
     """ Load CatBoost model and used columns.
     """
     file_name = f"{PICKEL_PATH}/{model_name}.pkl"
-    model = pickle.load(open(file_name, "rb"))
+    with open(file_name, "rb") as f:
+        model = pickle.load(f)
 
     file_name = f"{PICKEL_PATH}/{model_name}_Columns.pkl"
-    cols = pickle.load(open(file_name, "rb"))
+    with open(file_name, "rb") as f:
+        cols = pickle.load(f)
     return model, cols
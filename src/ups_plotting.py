@@ -1,3 +1,4 @@
+import os
 import warnings
 
 import contextily as cx
@@ -15,8 +16,19 @@ warnings.filterwarnings("ignore")
 from src.constants import *
 
 
-def plot_heat_map(df, figsize=48, fontsize=22):
-    """Plots heat map give a DataFrame.
+def show_or_save(save_path=None):
+    """Show the current figure, or write it to save_path and close it when running headless.
+    """
+    if save_path is None:
+        plt.show()
+        return
+    os.makedirs(os.path.dirname(save_path) or '.', exist_ok=True)
+    plt.savefig(save_path, bbox_inches='tight')
+    plt.close('all')
+
+
+def plot_heat_map(df, figsize=48, fontsize=22, save_path=None):
+    """Plots heat map give a DataFrame. Written to save_path instead of shown if given.
     """
     labels = df.columns.tolist()
     # --- Correlation Matrix Heatmap --- #
@@ -28,17 +40,17 @@ def plot_heat_map(df, figsize=48, fontsize=22):
 
     ax.set_xticklabels(labels, fontsize=fontsize)
     ax.set_yticklabels(labels, fontsize=fontsize)
-    plt.show()
+    show_or_save(save_path)
 
 
-def plot_shap(x_train, model, n=40000):
-    """Generate and plot SHAP: Shapley Additive Explanations.
+def plot_shap(x_train, model, n=40000, save_path=None):
+    """Generate and plot SHAP: Shapley Additive Explanations. Written to save_path instead of shown if given.
     """
     explainer = shap.TreeExplainer(model)
-    sample = x_train.sample(n=n)
+    sample = x_train.sample(n=min(n, len(x_train)))
     shap_values = explainer.shap_values(sample)
-    shap.summary_plot(shap_values, sample)
-    plt.show()
+    shap.summary_plot(shap_values, sample, show=False)
+    show_or_save(save_path)
     return shap_values, sample
 
 
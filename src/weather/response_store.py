@@ -0,0 +1,137 @@
+import json
+import os
+import struct
+import zlib
+
+from src.constants import *
+
+RECORD_HEADER = struct.Struct('<I')  # byte length of the compressed record that follows
+
+
+def index_key(key):
+    """ Incident key as a json value, numpy integers included.
+    """
+    return key.item() if hasattr(key, 'item') else key
+
+
+class ResponseStore:
+    """ Append-only store of raw weather responses. Every response is one zlib compressed json record,
+    prefixed by its length, appended to the current shard-<n>.bin file. A json lines sidecar index maps the
+    incident key to shard, offset and length, so one response is read with a single seek.
+    A record is indexed only once its bytes are flushed, so a run cut short leaves at most unindexed bytes
+    at the end of a shard, which are never read, and reopening the store resumes appending.
+    Args:
+        path (str): store directory
+        shard_bytes (int): size after which a new shard is started
+    """
+    def __init__(self, path=WEATHER_RESPONSE_DIR, shard_bytes=WEATHER_SHARD_BYTES):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.path = path
+        self.shard_bytes = shard_bytes
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # line cut short by a crash, its record is written again
+                    self.index[entry['key']] = entry
+        shards = [int(x[len('shard-'):-len('.bin')]) for x in os.listdir(path) if x.startswith('shard-')]
+        self.shard = max(shards, default=0)
+        self.writer, self.index_writer = None, None
+        self.readers = {}
+
+    @property
+    def index_path(self):
+        return f'{self.path}/index.jsonl'
+
+    def shard_path(self, shard):
+        return f'{self.path}/shard-{shard:05d}.bin'
+
+    def put(self, key, data, date=None):
+        """ Append the raw response of an incident, a key stored again points to its latest response.
+        """
+        if self.writer is None:
+            self.writer = open(self.shard_path(self.shard), 'ab')
+            self.index_writer = open(self.index_path, 'a')
+            if self.index_writer.tell() > 0:
+                with open(self.index_path, 'rb') as f:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n':
+                        self.index_writer.write('\n')  # close a line cut short by a crash
+        if self.writer.tell() >= self.shard_bytes:
+            self.writer.close()
+            self.shard += 1
+            self.writer = open(self.shard_path(self.shard), 'ab')
+        record = zlib.compress(json.dumps(data).encode())
+        offset = self.writer.tell()
+        self.writer.write(RECORD_HEADER.pack(len(record)) + record)
+        self.writer.flush()
+        key = index_key(key)
+        entry = {'key': key, 'date': date, 'shard': self.shard, 'offset': offset, 'length': len(record)}
+        self.index_writer.write(json.dumps(entry) + '\n')
+        self.index_writer.flush()
+        self.index[key] = entry
+
+    def get(self, key):
+        """ Raw response of an incident, KeyError if it was never stored.
+        """
+        entry = self.index[index_key(key)]
+        if entry['shard'] not in self.readers:
+            self.readers[entry['shard']] = open(self.shard_path(entry['shard']), 'rb')
+        reader = self.readers[entry['shard']]
+        reader.seek(entry['offset'] + RECORD_HEADER.size)
+        return json.loads(zlib.decompress(reader.read(entry['length'])))
+
+    def date(self, key):
+        return self.index[index_key(key)]['date']
+
+    def to_dicts(self, keys=None):
+        """ Responses in the format of the pickled collection checkpoints.
+        Args:
+            keys (list): keys to read, defaults to every stored key
+        Returns:
+            weather_data (dict): incident key -> raw API response
+            date_data (dict): incident key -> requested date
+        """
+        keys = self.index.keys() if keys is None else keys
+        return {key: self.get(key) for key in keys}, {key: self.date(key) for key in keys}
+
+    def close(self):
+        for f in [self.writer, self.index_writer, *self.readers.values()]:
+            if f is not None:
+                f.close()
+        self.writer, self.index_writer, self.readers = None, None, {}
+
+    def __contains__(self, key):
+        return index_key(key) in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def import_pickles(store, weather_files, date_files=None):
+    """ Copy pickled collection checkpoints into a response store, one checkpoint in memory at a time.
+    Args:
+        store (ResponseStore): destination
+        weather_files (list): weather_data-<n> checkpoint paths
+        date_files (list): matching date_data-<n> checkpoint paths of non-crash collections
+    """
+    for idx, file_name in enumerate(weather_files):
+        with open(file_name, 'rb') as f:
+            weather_data = pickle.load(f)
+        date_data = {}
+        if date_files is not None:
+            with open(date_files[idx], 'rb') as f:
+                date_data = pickle.load(f)
+        for key, data in weather_data.items():
+            store.put(key, data, date_data.get(key))
+        print(f'{file_name}: {len(weather_data)} responses imported')
@@ -0,0 +1,137 @@
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+
+from scipy.spatial import cKDTree
+
+from src.constants import *
+
+
+class MemoryBackend:
+    """ In-process LRU store of (saved_at, value) entries.
+    """
+    def __init__(self, max_entries=WEATHER_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def set(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class DiskBackend:
+    """ One json file per entry, shared across processes and restarts. LRU by file modification time.
+    The entry count is kept in memory, so a write only lists the directory once the count passes
+    max_entries, and eviction then trims to 90% of it so the next scans are spread out.
+    """
+    def __init__(self, path=WEATHER_CACHE_DIR, max_entries=WEATHER_CACHE_MAX_ENTRIES):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.path = path
+        self.max_entries = max_entries
+        self.count = len(self.entry_files())
+
+    def file_name(self, key):
+        return f"{self.path}/{hashlib.sha1(key.encode()).hexdigest()}.json"
+
+    def get(self, key):
+        file_name = self.file_name(key)
+        try:
+            with open(file_name) as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        os.utime(file_name)  # mark as recently used
+        return entry
+
+    def set(self, key, entry):
+        file_name = self.file_name(key)
+        is_new = not os.path.exists(file_name)
+        with open(f'{file_name}.tmp', 'w') as f:
+            json.dump(entry, f)
+        os.replace(f'{file_name}.tmp', file_name)
+        self.count += is_new
+        if self.count > self.max_entries:
+            self.evict()
+
+    def entry_files(self):
+        return [f'{self.path}/{x}' for x in os.listdir(self.path) if x.endswith('.json')]
+
+    def evict(self):
+        """ Remove the least recently used entries down to 90% of max_entries, and recount,
+        which also picks up entries written by other processes.
+        """
+        files = self.entry_files()
+        keep = self.max_entries * 9 // 10
+        if len(files) > self.max_entries:
+            files.sort(key=os.path.getmtime)
+            for file_name in files[:len(files) - keep]:
+                try:
+                    os.remove(file_name)
+                except FileNotFoundError:
+                    pass  # evicted by another process
+            files = files[len(files) - keep:]
+        self.count = len(files)
+
+    def __len__(self):
+        return self.count
+
+
+class WeatherCache:
+    """ Weather lookups bucketed by spatial cell and hour.
+    Segments in the same cell (nearest weather station, or a lat/long grid cell when no stations are given)
+    during the same hour share one lookup.
+    Args:
+        backend (MemoryBackend/DiskBackend): where entries are kept, defaults to in-process
+        ttl (int): seconds an entry stays valid
+        cell_deg (float): grid cell size in degrees, used without stations
+        stations (DataFrame): weather station Latitude/Longitude, cells become the nearest station
+    """
+    def __init__(self, backend=None, ttl=WEATHER_CACHE_TTL, cell_deg=WEATHER_CACHE_CELL_DEG, stations=None):
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.ttl = ttl
+        self.cell_deg = cell_deg
+        self.tree = None
+        if stations is not None:
+            self.tree = cKDTree(stations[['Latitude', 'Longitude']].values)
+        self.hits, self.misses = 0, 0
+
+    def cell(self, lat, long):
+        if self.tree is not None:
+            _, station = self.tree.query([lat, long])
+            return f'st{station}'
+        return f'{int(np.floor(lat / self.cell_deg))}:{int(np.floor(long / self.cell_deg))}'
+
+    def key(self, lat, long, date_now):
+        return f"{self.cell(lat, long)}|{date_now.strftime('%Y%m%d%H')}"
+
+    def get(self, lat, long, date_now, fetch):
+        """ Return the cached value of the cell/hour or call fetch(lat, long, date_now) and cache it.
+        """
+        key = self.key(lat, long, date_now)
+        entry = self.backend.get(key)
+        if entry is not None and time.time() - entry[0] < self.ttl:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        value = fetch(lat, long, date_now)
+        self.backend.set(key, [time.time(), value])
+        return value
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0,
+                'entries': len(self.backend)}
@@ -0,0 +1,192 @@
+import asyncio
+import json
+import os
+import random
+import time
+
+import aiohttp
+import pandas as pd
+
+from src.constants import *
+from src.modeling.model_beta import non_crash_sampler
+from src.weather import weather_planner
+from src.weather.weather_data import random_dates, weather_url
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class WeatherRequestError(Exception):
+    """ A weather request that failed for good, after its retries or with a status that is not retried.
+    """
+
+
+class TokenBucket:
+    """ Rate limiter shared by the collector's workers: rate requests per second on average,
+    bursts of up to capacity.
+    """
+    def __init__(self, rate=WEATHER_RATE_LIMIT, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def json_key(key):
+    """ Incident key as a json value, numpy integers included.
+    """
+    return key.item() if hasattr(key, 'item') else key
+
+
+def completed_keys(journal_path):
+    """ Keys of every request recorded in a journal. A line cut short by a crash is ignored, so it is fetched again.
+    """
+    keys = set()
+    if not os.path.exists(journal_path):
+        return keys
+    with open(journal_path) as f:
+        for line in f:
+            try:
+                keys.add(json.loads(line)['key'])
+            except (json.JSONDecodeError, KeyError):
+                continue
+    return keys
+
+
+def load_journal(journal_path):
+    """ Collected weather in the format of the pickled collection checkpoints.
+    Returns:
+        weather_data (dict): incident key -> raw API response
+        date_data (dict): incident key -> requested date
+    """
+    weather_data, date_data = {}, {}
+    with open(journal_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            weather_data[record['key']] = record['data']
+            date_data[record['key']] = record['date']
+    return weather_data, date_data
+
+
+async def fetch_with_retry(session, bucket, url, max_retries=WEATHER_MAX_RETRIES, backoff=WEATHER_BACKOFF_S):
+    """ GET one url through the rate limiter, retrying throttling, server errors, timeouts and bodies that
+    are not json, e.g. an HTML maintenance page served with status 200, with jittered exponential backoff.
+    """
+    for attempt in range(max_retries + 1):
+        await bucket.acquire()
+        try:
+            async with session.get(url) as response:
+                if response.status == 200:
+                    return await response.json(content_type=None)
+                if response.status not in RETRY_STATUSES:
+                    raise WeatherRequestError(f'HTTP {response.status}: {url}')
+                error = f'HTTP {response.status}'
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:  # ValueError: body is not json
+            error = repr(e)
+        if attempt < max_retries:
+            await asyncio.sleep(backoff * 2 ** attempt * (0.5 + random.random()))
+    raise WeatherRequestError(f'{error} after {max_retries + 1} attempts: {url}')
+
+
+async def collect_async(requests, journal_path, concurrency, rate, max_retries, backoff, base_url):
+    done = completed_keys(journal_path)
+    pending = [x for x in requests if json_key(x[0]) not in done]
+    stats = {'requests': len(requests), 'skipped': len(requests) - len(pending), 'completed': 0, 'failed': {}}
+    pending = iter(pending)
+    bucket = TokenBucket(rate)
+
+    os.makedirs(os.path.dirname(journal_path) or '.', exist_ok=True)
+    with open(journal_path, 'a') as journal:
+        if journal.tell() > 0:
+            with open(journal_path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    journal.write('\n')  # close a line cut short by a crash, so the next record starts clean
+        connector = aiohttp.TCPConnector(limit=concurrency)
+        timeout = aiohttp.ClientTimeout(total=WEATHER_TIMEOUT_S)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            async def worker():
+                for key, lat, long, date in pending:  # workers share one iterator, each request is taken once
+                    try:
+                        data = await fetch_with_retry(session, bucket, weather_url(lat, long, date, base_url),
+                                                      max_retries, backoff)
+                    except WeatherRequestError as e:
+                        stats['failed'][json_key(key)] = str(e)
+                        continue
+                    journal.write(json.dumps({'key': json_key(key), 'date': date, 'data': data}) + '\n')
+                    journal.flush()  # a record is durable once its request completes
+                    stats['completed'] += 1
+
+            await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return stats
+
+
+def collect_weather(requests, journal_path, concurrency=WEATHER_CONCURRENCY, rate=WEATHER_RATE_LIMIT,
+                    max_retries=WEATHER_MAX_RETRIES, backoff=WEATHER_BACKOFF_S, base_url=WEATHER_API_URL):
+    """ Collect raw weather concurrently over one pooled HTTP session. Every completed request is appended
+    to a json lines journal, and requests already in the journal are skipped, so a restart resumes exactly
+    where the last run stopped. Failed requests are not journaled and are retried by the next run.
+    Args:
+        requests (list): (key, lat, long, date) tuples, key is e.g. Crash_ID or NonCrashIDX, date is %m/%d/%Y
+        journal_path (str): completion journal, read with load_journal
+        concurrency (int): open requests
+        rate (float): requests per second
+        max_retries (int): retries of throttled, failed or timed out requests
+        backoff (float): first retry delay in seconds
+        base_url (str): API root, see weather_data.weather_url
+    Returns:
+        stats (dict): request counts, failures by key, wall time and throughput
+    """
+    s = time.time()
+    stats = asyncio.run(collect_async(list(requests), journal_path, concurrency, rate, max_retries, backoff, base_url))
+    stats['wall_s'] = time.time() - s
+    stats['requests_per_s'] = stats['completed'] / stats['wall_s']
+    print(f"weather: {stats['completed']} collected, {stats['skipped']} already in journal, "
+          f"{len(stats['failed'])} failed, {stats['requests_per_s']:.1f} requests/s")
+    return stats
+
+
+def crash_weather_requests(tx_crash, stations=None):
+    """ Requests of save_weather_obj_files: weather on the day of every crash at its nearest weather station,
+    one request per station and date, see weather_planner.plan_requests.
+    Returns:
+        requests (list): (group key, lat, long, date) tuples
+        assignment (Series): group key of every Crash_ID, hand the responses out with weather_planner.fan_out
+    """
+    return weather_planner.plan_requests(tx_crash['Crash_ID'].values, tx_crash['Latitude'].values,
+                                         tx_crash['Longitude'].values, tx_crash['Crash_Date'].values, stations)
+
+
+def non_crash_weather_requests(stid2lat, stid2long, seed=None, shard_dir=NON_CRASH_SHARD_DIR, stations=None):
+    """ Requests of collect_raw_weather_data: weather on a random date matching the year, month and weekday of
+    every non-crash sample, read shard by shard from the output of non_crash_sampler.generate_sharded and
+    keyed by NonCrashIDX. The same seed gives the same dates, so a resumed run asks for the same days.
+    Samples are snapped to their nearest weather station, one request per station and date.
+    Returns:
+        requests (list): (group key, lat, long, date) tuples
+        assignment (Series): group key of every NonCrashIDX, hand the responses out with weather_planner.fan_out
+    """
+    keys, lats, longs, dates = [], [], [], []
+    for shard, df in enumerate(non_crash_sampler.iter_shards(shard_dir, ['STR_UNQ_ID', 'month', 'day', 'year'])):
+        shard_dates = random_dates(df.year.values, df.month.values, df.day.values,
+                                   None if seed is None else [seed, shard])
+        keys.append(df.NonCrashIDX.values)
+        lats.append(df.STR_UNQ_ID.map(stid2lat).values)
+        longs.append(df.STR_UNQ_ID.map(stid2long).values)
+        dates.append(pd.Series(shard_dates).dt.strftime('%m/%d/%Y').values)
+    return weather_planner.plan_requests(np.concatenate(keys), np.concatenate(lats), np.concatenate(longs),
+                                         np.concatenate(dates), stations)
@@ -1,5 +1,5 @@
 import calendar, random
-from shapely import wkt
+import shapely
 import geopandas as gpd
 import dload
 import datetime
@@ -8,20 +8,48 @@ import pandas as pd
 
 from src.constants import *
 from src.common_tools import load_obj, save_obj
+from src import geometry, temporal_features
 
 
-def randomdate(year, month, weekday_val):
+def randomdate(year, month, weekday_val, rng=random):
     """ Given a year, month and day of the week generate a date
     Args:
         year (int): e.g. 2017
-        month (int): month value. range 0-11
-        weekday_val (int): weekday value. range 0-5
+        month (int): month value. range 1-12
+        weekday_val (int): weekday value. range 0-6
+        rng (random.Random): source of randomness, seed one for repeatable dates
 
     Returns:
         date (str): %m/%d/%Y
     """
     dates = calendar.Calendar().itermonthdates(year, month)
-    return random.choice([date for date in dates if (date.month == month and date.weekday() == weekday_val)])
+    return rng.choice([date for date in dates if (date.month == month and date.weekday() == weekday_val)])
+
+
+def random_dates(years, months, weekdays, seed=None):
+    """ Vectorized randomdate: a uniformly drawn date with the given year, month and weekday for every row,
+    gathered from tables of the first matching day and the number of matching days of every distinct
+    year and month. The same inputs and seed always give the same dates.
+    Args:
+        years (array): e.g. 2017
+        months (array): month values, range 1-12
+        weekdays (array): weekday values, range 0-6, Monday is 0
+        seed (int): seed of the numpy Generator
+    Returns:
+        dates (array): datetime64[D] dates
+    """
+    years, months = np.asarray(years, dtype=np.int64), np.asarray(months, dtype=np.int64)
+    weekdays = np.asarray(weekdays, dtype=np.int64)
+    year_months, inverse = np.unique((years - 1970) * 12 + months - 1, return_inverse=True)
+    month_starts = year_months.astype('datetime64[M]').astype('datetime64[D]')
+    month_lengths = ((year_months + 1).astype('datetime64[M]').astype('datetime64[D]') - month_starts).astype(np.int64)
+    first_weekdays = (month_starts.astype(np.int64) + 3) % 7  # 1970-01-01 was a Thursday
+
+    inverse = inverse.ravel()
+    first_day = (weekdays - first_weekdays[inverse]) % 7  # days from the 1st to the first matching weekday
+    n_matching = (month_lengths[inverse] - 1 - first_day) // 7 + 1
+    week = (np.random.default_rng(seed).random(len(years)) * n_matching).astype(np.int64)
+    return month_starts[inverse] + first_day + 7 * week
 
 
 def get_weather_data(lat, long, date='03/01/2020'):
@@ -34,68 +62,98 @@ def get_weather_data(lat, long, date='03/01/2020'):
     Returns:
         weather data (dict):
     """
-    date = datetime.datetime.strptime(date, '%m/%d/%Y')
-    date = date.strftime('%Y%m%d')
-    url = f'https://api.weather.com/v1/geocode/{lat}/{long}/observations/historical.json?apiKey={API_KEY}startDate={date}&endDate={date}'
-    return dload.json(url)
+    return dload.json(weather_url(lat, long, date))
+
+
+def weather_url(lat, long, date, base_url=WEATHER_API_URL):
+    """ Historical observations url of one location and day.
+    Args:
+        lat (float): latitude
+        long (float): longitude
+        date (str): %m/%d/%Y
+        base_url (str): API root, point it at a local stub server to test collectors
+    """
+    date = datetime.datetime.strptime(date, '%m/%d/%Y').strftime('%Y%m%d')
+    return f'{base_url}/{lat}/{long}/observations/historical.json?apiKey={API_KEY}&startDate={date}&endDate={date}'
+
+
+def load_weather_stations():
+    """ Load weather station locations in the target state.
+    Returns:
+        stations (DataFrame): one row per station with Latitude and Longitude
+    """
+    stations = pd.read_csv(WEATHER_LOCATIONS_PATH)
+    stations = stations[stations.State == TARGET_STATE].reset_index(drop=True)
+    return stations
 
 
-def collect_raw_weather_data(df, start_val=0, stid2lat=None, stid2long=None):
+def collect_raw_weather_data(df, start_val=0, stid2lat=None, stid2long=None, response_store=None, seed=None):
     """ Collect and save's raw weather that is matched to a date and location of an incident (crash/non-crash).
     Args:
         df (DataFrame): df containing time and location information of all incidents.
         start_val (int): value used if you want to start from checkpoint.
         stid2lat (str): dict mapping incident to latitude
         stid2long (str): dict mapping incident to longitude
+        response_store (ResponseStore): stream every response to this store instead of pickled checkpoints,
+            incidents already in it are skipped
+        seed (int): seed of the random dates, the same seed asks for the same dates on a rerun
     """
     weather_data, date_data = {}, {}
+    dates = pd.Series(random_dates(df.year.values, df.month.values, df.day.values, seed), index=df.index)
+    dates = dates.dt.strftime('%m/%d/%Y')
     print('start')
     s = time.time()
     for idx, row in df.iterrows():
-        if idx <= start_val:
+        if idx <= start_val or (response_store is not None and row.NonCrashIDX in response_store):
             continue
         if idx % 1000 == 0:
             print(idx)
-        if idx % COLLECTION_SAVE_THRESH == 0 and idx != 0:
+        if idx % COLLECTION_SAVE_THRESH == 0 and idx != 0 and response_store is None:
             save_obj(weather_data, f'{PATH2WEATHER_OBJ_DIR}/data/weather_data-{idx}')
             save_obj(date_data, f'{PATH2WEATHER_OBJ_DIR}/meta/date_data-{idx}')
             print(f'loop time: {time.time() - s}')
             s = time.time()
             weather_data, date_data = {}, {}
 
-        random_gen_date = randomdate(row.year, row.month, row.day)
-        random_gen_date = random_gen_date.strftime('%m/%d/%Y')
+        random_gen_date = dates[idx]
         data = get_weather_data(
             stid2lat[row.STR_UNQ_ID],
             stid2long[row.STR_UNQ_ID],
             date=random_gen_date)
 
+        if response_store is not None:
+            response_store.put(row.NonCrashIDX, data, random_gen_date)
+            continue
         weather_data[row.NonCrashIDX] = data
         date_data[row.NonCrashIDX] = random_gen_date
 
 
-def geo_convert(df):
-    df['geometry'] = df['geometry'].apply(wkt.loads)
-    df = gpd.GeoDataFrame(df, geometry='geometry')
-    df['centroid'] = df.geometry.map(lambda x: x.centroid)
-    df['Latitude'] = df.centroid.map(lambda x: x.xy[1][0])
-    df['Longitude'] = df.centroid.map(lambda x: x.xy[0][0])
+def geo_convert(df, geometry_cache_dir=GEOMETRY_CACHE_DIR):
+    geoms = geometry.load_geometry(df['geometry'], geometry_cache_dir)
+    df = gpd.GeoDataFrame(df.assign(geometry=geoms['geometry'].values), geometry='geometry')
+    df['centroid'] = gpd.GeoSeries(shapely.points(geoms['centroid_x'].values, geoms['centroid_y'].values), index=df.index)
+    df['Latitude'] = geoms['centroid_y'].values
+    df['Longitude'] = geoms['centroid_x'].values
     return df
 
 
-def save_weather_obj_files(tx_crash, start_number=0, update_iter=1000):
+def save_weather_obj_files(tx_crash, start_number=0, update_iter=1000, response_store=None):
     """ Preprocesses raw data.
     Args:
         tx_crash (DataFrame):
         start_number (int): checkpoint
         update_iter (int): interval of update print out
+        response_store (ResponseStore): stream every response to this store instead of pickled checkpoints,
+            crashes already in it are skipped
     """
     weather_data = {}
     s = time.time()
     for f, idx in enumerate(range(start_number, len(tx_crash))):
         if idx % update_iter == 0:
             print(idx)
-        if idx % COLLECTION_SAVE_THRESH == 0 and f != 0:
+        if response_store is not None and tx_crash.loc[idx, 'Crash_ID'] in response_store:
+            continue
+        if idx % COLLECTION_SAVE_THRESH == 0 and f != 0 and response_store is None:
             save_obj(weather_data, f'weather_data-{idx}')
             print(f'loop time: {time.time() - s}')
             s = time.time()
@@ -103,17 +161,66 @@ def save_weather_obj_files(tx_crash, start_number=0, update_iter=1000):
 
         data = get_weather_data(tx_crash.loc[idx, 'Latitude'], tx_crash.loc[idx, 'Longitude'],
                                 date=tx_crash.loc[idx, 'Crash_Date'])
+        if response_store is not None:
+            response_store.put(tx_crash.loc[idx, 'Crash_ID'], data, tx_crash.loc[idx, 'Crash_Date'])
+            continue
         weather_data[tx_crash.loc[idx, 'Crash_ID']] = data
     return weather_data
 
 
-def convert_raw_weather_obj2csv(tx_crash, dicts, csvs, update_iter=1000):
-    """ Loads raw weather data and formats it for modeling. Also matches incident to exact times
+def observation_times(weather_dict, keys):
+    """ Flatten the observation times of raw weather responses into one columnar table.
+    Args:
+        weather_dict (dict): incident key -> raw API response
+        keys (array): incident keys to flatten, keys without observations are left out
+    Returns:
+        observations (DataFrame): row (position of its key in keys), obs_pos (position in its 'observations'
+            list) and local naive time
+    """
+    rows, obs_pos, epochs = [], [], []
+    for row, key in enumerate(keys):
+        observations = (weather_dict.get(key) or {}).get('observations') or []
+        rows.extend([row] * len(observations))
+        obs_pos.extend(range(len(observations)))
+        epochs.extend(obs['valid_time_gmt'] for obs in observations)
+    times = pd.to_datetime(np.asarray(epochs, dtype=np.int64), unit='s', utc=True)
+    return pd.DataFrame({'row': np.asarray(rows, dtype=np.int64), 'obs_pos': np.asarray(obs_pos, dtype=np.int64),
+                         'time': times.tz_convert(LOCAL_TIMEZONE).tz_localize(None).astype('datetime64[ns]')})
+
+
+def match_nearest_observations(keys, times, weather_dict, key_col='Crash_ID'):
+    """ Observation closest in time to every incident, through one as-of merge grouped by incident.
+    Args:
+        keys (array): incident keys of weather_dict
+        times (array): local naive incident datetimes
+        weather_dict (dict): incident key -> raw API response
+        key_col (str): name of the key column of the output
+    Returns:
+        matched (DataFrame): observation fields plus key_col, one row per incident in input order,
+            only key_col is set for incidents without observations
+    """
+    incidents = pd.DataFrame({'row': np.arange(len(keys)),
+                              'time': pd.to_datetime(np.asarray(times)).astype('datetime64[ns]')})
+    observations = observation_times(weather_dict, keys).sort_values('time', kind='stable')
+    matches = pd.merge_asof(incidents.sort_values('time', kind='stable'), observations, on='time', by='row',
+                            direction='nearest').sort_values('row')
+
+    records = []
+    for key, pos in zip(keys, matches['obs_pos'].values):
+        if pos == pos:  # NaN without observations
+            records.append(dict(weather_dict[key]['observations'][int(pos)], **{key_col: key}))
+        else:
+            records.append({key_col: key})
+    return pd.DataFrame.from_records(records)
+
+
+def convert_raw_weather_obj2csv(tx_crash, dicts, csvs):
+    """ Loads raw weather data and formats it for modeling. Also matches every incident to the observation
+    closest to its time, see match_nearest_observations
     Args:
         tx_crash (DataFrame):
         dicts (list): list of all saved raw weather data
         csvs (list): list of all processed weather data
-        update_iter (int): interval of update print out
     """
     for dict_name in dicts:
         if dict_name.replace('.pkl','.csv') in csvs:
@@ -121,42 +228,12 @@ def convert_raw_weather_obj2csv(tx_crash, dicts, csvs, update_iter=1000):
             continue
 
         print(f'processing: {dict_name} ...')
-        output = pd.DataFrame() # init dataframe
-
-        print(dict_name) # load weather dict
         number = int(dict_name.split('-')[-1].split('.')[0])
         weather_dict = load_obj(f'{PATH2WEATHER_OBJ_DIR}/data/weather_data-{number}')
 
-        for crash_idx in range((number-COLLECTION_SAVE_THRESH),number):
-            if crash_idx%update_iter == 0:
-                print(crash_idx)
-
-            crash_id = tx_crash.loc[crash_idx,'Crash_ID']
-            date_of_crash, time_of_crash = tx_crash.loc[crash_idx,'Crash_Date'], tx_crash.loc[crash_idx,'Crash_Time']
-            crash_time = datetime.datetime.strptime(f'{date_of_crash} {time_of_crash}', '%m/%d/%Y %I:%M %p')
-            # loop vals for weather loop
-            min_time = np.inf
-            best_weather_idx = 0
-            try:
-                weather_datalist = weather_dict[crash_id]['observations']
-            except KeyError:
-                # no 'observations' append crash ID and nan's to df
-                nan_dict = {'Crash_ID':crash_id}
-                output = output.append(nan_dict, ignore_index=True)
-                continue
-
-            for idx, data in enumerate(weather_datalist):
-                weather_epoch = data['valid_time_gmt']
-                weather_time = datetime.datetime.fromtimestamp(weather_epoch)
-                dif = (crash_time-weather_time).total_seconds()
-                if abs(dif) < min_time:
-                    min_time = dif
-                    best_weather_idx = idx
-
-            # add matching crash ID
-            weather_datalist[best_weather_idx]['Crash_ID'] = crash_id
-            # append to df
-            output = output.append(weather_datalist[best_weather_idx], ignore_index=True)
+        crashes = tx_crash.loc[number - COLLECTION_SAVE_THRESH:number - 1]
+        crash_times = temporal_features.parse_crash_datetimes(crashes)
+        output = match_nearest_observations(crash_times.index.values, crash_times.values, weather_dict)
         # save csv
         output.to_csv(f'{PATH2OUTPUT_CSV_NC_DIR}/weather_data-{number}.csv')
 
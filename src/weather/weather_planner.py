@@ -0,0 +1,104 @@
+import pandas as pd
+from scipy.spatial import cKDTree
+
+from src.constants import *
+from src.weather import weather_collector, weather_data
+
+
+def snap_to_cells(lats, longs, stations=None, cell_deg=WEATHER_CACHE_CELL_DEG):
+    """ Cell of every incident: its nearest weather station through a KD-tree, or a lat/long grid cell without
+    stations. Same cells as weather_cache.WeatherCache, for whole columns at once.
+    Coordinates must be finite, plan_requests drops incidents without a location first.
+    Args:
+        lats (array): incident latitudes
+        longs (array): incident longitudes
+        stations (DataFrame): weather station Latitude/Longitude, see weather_data.load_weather_stations
+        cell_deg (float): grid cell size in degrees, used without stations
+    Returns:
+        cells (array): cell index of every incident
+        cell_lat (array): latitude requested for every cell, the station or the cell center
+        cell_long (array): longitude requested for every cell
+        cell_names (array): name of every cell, as in WeatherCache.cell
+    """
+    points = np.column_stack([np.asarray(lats, dtype=np.float64), np.asarray(longs, dtype=np.float64)])
+    if stations is not None:
+        station_points = stations[['Latitude', 'Longitude']].values
+        _, cells = cKDTree(station_points).query(points)
+        cell_names = np.array([f'st{station}' for station in range(len(station_points))])
+        return cells, station_points[:, 0], station_points[:, 1], cell_names
+    grid = np.floor(points / cell_deg).astype(np.int64)
+    grid_codes, cells = np.unique((grid[:, 0] << 32) + grid[:, 1] + 2 ** 31, return_inverse=True)  # one int per cell
+    grid_cells = np.column_stack([grid_codes >> 32, (grid_codes & 0xffffffff) - 2 ** 31])
+    centers = (grid_cells + 0.5) * cell_deg
+    cell_names = np.array([f'{glat}:{glong}' for glat, glong in grid_cells])
+    return cells.ravel(), centers[:, 0], centers[:, 1], cell_names
+
+
+def plan_requests(keys, lats, longs, dates, stations=None, cell_deg=None):
+    """ One weather request per (station, date) instead of one per incident, since the API returns a whole day
+    of observations for a location. Incidents are snapped to their nearest weather station, incidents with a
+    missing latitude or longitude get no request and are left out of the assignment.
+    Args:
+        keys (array): incident keys, e.g. Crash_ID or NonCrashIDX
+        lats (array): incident latitudes
+        longs (array): incident longitudes
+        dates (array): incident dates, %m/%d/%Y
+        stations (DataFrame): weather stations, defaults to weather_data.load_weather_stations
+        cell_deg (float): snap to lat/long grid cells of this size in degrees instead of stations
+    Returns:
+        requests (list): (group key, lat, long, date) tuples for weather_collector.collect_weather
+        assignment (Series): group key of every incident, indexed by incident key
+    """
+    if cell_deg is not None:
+        stations = None
+    elif stations is None:
+        stations = weather_data.load_weather_stations()
+    keys, lats, longs, dates = np.asarray(keys), np.asarray(lats, dtype=np.float64), \
+        np.asarray(longs, dtype=np.float64), np.asarray(dates)
+    located = np.isfinite(lats) & np.isfinite(longs)
+    if not located.all():
+        print(f'weather plan: dropped {(~located).sum()} of {len(located)} incidents without coordinates')
+        keys, lats, longs, dates = keys[located], lats[located], longs[located], dates[located]
+    cells, cell_lat, cell_long, cell_names = snap_to_cells(lats, longs, stations, cell_deg)
+    date_codes, unique_dates = pd.factorize(dates)
+    groups, inverse = np.unique(cells.astype(np.int64) * len(unique_dates) + date_codes, return_inverse=True)
+    group_cells, group_dates = np.divmod(groups, len(unique_dates))
+
+    group_dates = unique_dates[group_dates]
+    group_keys = np.array([f'{cell}|{date}' for cell, date in zip(cell_names[group_cells], group_dates)])
+    requests = list(zip(group_keys, cell_lat[group_cells], cell_long[group_cells], group_dates))
+    assignment = pd.Series(group_keys[inverse.ravel()], index=keys, name='weather_group')
+    print(f'weather plan: {len(assignment)} incidents in {len(requests)} requests, '
+          f'reduction ratio {len(assignment) / max(len(requests), 1):.1f}x')
+    return requests, assignment
+
+
+def fan_out(group_data, assignment):
+    """ Hand every incident the observations of its group. Incidents share the group's response object.
+    Args:
+        group_data (dict): group key -> raw API response, see weather_collector.load_journal
+        assignment (Series): see plan_requests
+    Returns:
+        weather_data (dict): incident key -> raw API response, incidents of failed groups are left out
+    """
+    return {key: group_data[group] for key, group in assignment.items() if group in group_data}
+
+
+def collect_planned(keys, lats, longs, dates, journal_path, stations=None, cell_deg=None, **collector_kwargs):
+    """ Plan, collect and fan out weather for a set of incidents.
+    Args:
+        keys, lats, longs, dates, stations, cell_deg: see plan_requests
+        journal_path (str): journal of the group requests, see weather_collector.collect_weather
+        collector_kwargs: passed to weather_collector.collect_weather
+    Returns:
+        weather_data (dict): incident key -> raw API response
+        stats (dict): collector stats plus incidents, dropped incidents without coordinates, requests and
+            reduction_ratio
+    """
+    requests, assignment = plan_requests(keys, lats, longs, dates, stations, cell_deg)
+    stats = weather_collector.collect_weather(requests, journal_path, **collector_kwargs)
+    group_data, _ = weather_collector.load_journal(journal_path)
+    stats.update({'incidents': len(assignment), 'dropped_incidents': len(keys) - len(assignment),
+                  'planned_requests': len(requests),
+                  'reduction_ratio': len(assignment) / max(len(requests), 1)})
+    return fan_out(group_data, assignment), stats
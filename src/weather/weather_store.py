@@ -0,0 +1,150 @@
+import json
+import os
+from zoneinfo import ZoneInfo
+
+import pandas as pd
+from scipy.spatial import cKDTree
+
+from src.constants import *
+
+
+def flatten_observations(weather_dicts, locations):
+    """ All observations of collected raw responses as one columnar table.
+    Args:
+        weather_dicts (list): incident key -> raw API response dicts, e.g. the collection pickles
+            or weather_collector.load_journal
+        locations (DataFrame): Latitude and Longitude the response of every key was requested for, indexed by key
+    Returns:
+        observations (DataFrame): Latitude, Longitude, epoch (UTC seconds) and WEATHER_COLS
+    """
+    keys, epochs, values = [], [], []
+    for weather_dict in weather_dicts:
+        for key, data in weather_dict.items():
+            observations = (data or {}).get('observations') or []
+            keys.extend([key] * len(observations))
+            epochs.extend(obs['valid_time_gmt'] for obs in observations)
+            values.extend([obs.get(col) for col in WEATHER_COLS] for obs in observations)
+    rows = locations.index.get_indexer(keys)
+    if (rows < 0).any():
+        raise KeyError(f'Weather keys without a location: {np.asarray(keys)[rows < 0][:10].tolist()}')
+    observations = pd.DataFrame(np.array(values, dtype=np.float32).reshape(-1, len(WEATHER_COLS)), columns=WEATHER_COLS)
+    observations.insert(0, 'epoch', np.asarray(epochs, dtype=np.int64))
+    observations.insert(0, 'Longitude', locations['Longitude'].values[rows].astype(np.float64))
+    observations.insert(0, 'Latitude', locations['Latitude'].values[rows].astype(np.float64))
+    return observations
+
+
+def build_weather_store(observations, stations):
+    """ Pack observations into time sorted arrays per weather station, in CSR layout: the observations of
+    station i are rows offsets[i]:offsets[i + 1]. Every observation goes to the station nearest to the
+    location it was requested for, and observations collected more than once are kept once.
+    Args:
+        observations (DataFrame): see flatten_observations
+        stations (DataFrame): weather station Latitude/Longitude, see weather_data.load_weather_stations
+    Returns:
+        store (dict): station coordinates, offsets, int64 keys (station << 32 | epoch) and a float32 values block.
+            Stations without observations are left out, so a query always lands on a station with data
+    """
+    station_points = stations[['Latitude', 'Longitude']].values.astype(np.float64)
+    _, station = cKDTree(station_points).query(observations[['Latitude', 'Longitude']].values)
+    used, station = np.unique(station, return_inverse=True)
+    keys = (station.ravel().astype(np.int64) << 32) | observations['epoch'].values.astype(np.int64)
+    keys, first = np.unique(keys, return_index=True)  # sorted by station, then time
+    counts = np.bincount(keys >> 32, minlength=len(used))
+    return {
+        'station_lat': station_points[used, 0],
+        'station_long': station_points[used, 1],
+        'offsets': np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+        'keys': keys,
+        'cols': list(WEATHER_COLS),
+        'values': np.ascontiguousarray(observations[WEATHER_COLS].values[first], dtype=np.float32),
+    }
+
+
+def save_weather_store(store, path=WEATHER_STORE_PATH):
+    """ Save the store as one .npy file per array plus a json file of column names.
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+    for name in ['station_lat', 'station_long', 'offsets', 'keys', 'values']:
+        np.save(f'{path}/{name}.npy', store[name])
+    with open(f'{path}/columns.json', 'w') as f:
+        json.dump({'cols': store['cols']}, f)
+
+
+def load_weather_store(path=WEATHER_STORE_PATH, mmap_mode='r'):
+    """ Load a saved store, memory-mapped by default, and build its station KD-tree.
+    """
+    with open(f'{path}/columns.json') as f:
+        store = json.load(f)
+    for name in ['station_lat', 'station_long', 'offsets', 'keys', 'values']:
+        store[name] = np.load(f'{path}/{name}.npy', mmap_mode=mmap_mode)
+    station_tree(store)
+    return store
+
+
+def station_tree(store):
+    """ KD-tree over the stations of a store, built on first use.
+    """
+    if 'tree' not in store:
+        store['tree'] = cKDTree(np.column_stack([store['station_lat'], store['station_long']]))
+    return store['tree']
+
+
+def to_epochs(times):
+    """ UTC epoch seconds of datetimes, naive ones are local (LOCAL_TIMEZONE) time.
+    """
+    times = pd.DatetimeIndex(pd.to_datetime(np.atleast_1d(times)))
+    if times.tz is None:
+        times = times.tz_localize(LOCAL_TIMEZONE, ambiguous='NaT', nonexistent='shift_forward')
+    return times.tz_convert('UTC').values.astype('datetime64[s]').astype(np.int64)  # unit independent, pandas 1.3 has no as_unit
+
+
+def nearest_rows(store, station, epochs, max_gap_s):
+    """ Row of the observation of every station closest in time to its epoch, -1 beyond max_gap_s.
+    """
+    start, stop = store['offsets'][station], store['offsets'][station + 1]
+    # first observation of the station at or after the epoch, and the one before it
+    after = np.searchsorted(store['keys'], (station << 32) | epochs)
+    before = np.maximum(after - 1, start)
+    after = np.minimum(after, stop - 1)
+    gap_before = np.abs(epochs - (store['keys'][before] & 0xffffffff))
+    gap_after = np.abs(epochs - (store['keys'][after] & 0xffffffff))
+    rows = np.where(gap_after < gap_before, after, before)
+    return np.where(np.minimum(gap_before, gap_after) > max_gap_s, -1, rows)
+
+
+def query_weather(store, lats, longs, times, max_gap_s=WEATHER_STORE_MAX_GAP_S):
+    """ Conditions at many (lat, long, time) points at once: the observation of the nearest station
+    closest in time to every point.
+    Args:
+        store (dict): weather store, see load_weather_store
+        lats (array): latitudes
+        longs (array): longitudes
+        times (array): datetimes, naive ones are local time
+        max_gap_s (int): points further than this from every observation of their station get NaN
+    Returns:
+        weather (DataFrame): WEATHER_COLS values, one row per point
+    """
+    _, station = station_tree(store).query(np.column_stack([np.atleast_1d(lats), np.atleast_1d(longs)]))
+    epochs = np.clip(to_epochs(times), 0, 0xffffffff)  # NaT and pre-1970 points end up far from every observation
+    rows = nearest_rows(store, station.astype(np.int64), epochs, max_gap_s)
+    weather = pd.DataFrame(np.asarray(store['values'][rows]), columns=store['cols'])
+    weather.loc[rows < 0] = np.nan
+    return weather
+
+
+def weather_at(store, lat, long, date_now, max_gap_s=WEATHER_STORE_MAX_GAP_S):
+    """ Conditions at one location and time without any pandas overhead, same signature and format as
+    model_full.fetch_weather_now, so it can stand in for the live API, e.g. as the fetch of a WeatherCache.
+    Args:
+        date_now (datetime): naive ones are local time
+    Returns:
+        weather_data_now (dict): WEATHER_COLS values
+    """
+    if date_now.tzinfo is None:
+        date_now = date_now.replace(tzinfo=ZoneInfo(LOCAL_TIMEZONE))
+    _, station = station_tree(store).query([lat, long])
+    row = nearest_rows(store, np.int64(station), np.int64(date_now.timestamp()), max_gap_s)
+    values = store['values'][row] if row >= 0 else np.full(len(store['cols']), np.nan)
+    return dict(zip(store['cols'], values.tolist()))